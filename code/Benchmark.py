@@ -0,0 +1,200 @@
+"""
+Module runs the crawl pipeline offline against StubServer and reports how long
+each stage takes, so performance changes show up as numbers.
+
+For every region size the stages level_routes, get_routes, get_segments,
+populate_routes, write_region and the image download loop are timed
+separately. For each stage the harness reports wall time, throughput and peak
+Python memory (tracemalloc). It also reports latency percentiles for metadata
+and image requests. The result is printed, or written with --output, as JSON.
+
+Routes are loaded from synthetic directions pages recorded to disk. By default
+they are read with a plain HTTP client that stands in for the browser, which
+times route parsing without Chrome. Pass --browser to load them through a
+BrowserPool instead.
+
+Example: python Benchmark.py --radii 0.1 0.25 --destinations 16 --latency 0.02
+"""
+
+from Region import Region
+from MetadataEngine import MetadataEngine
+from Downloader import DownloadManager
+from Panorama import Panorama
+from StubServer import StubServer, record_directions
+from Metrics import metrics
+import urllib.request
+import contextlib
+import tracemalloc
+import tempfile
+import argparse
+import resource
+import json
+import time
+import io
+import os
+
+
+class HTTPDriver():
+    """
+    A minimal stand-in for a Selenium driver that loads pages over plain HTTP.
+    It supports what Region.fetch_route uses: get and page_source.
+    """
+
+    def __init__(self):
+        self.page_source = ""
+
+    def get(self,url):
+        self.page_source = urllib.request.urlopen(url).read().decode('utf-8')
+
+
+class TimedEngine(MetadataEngine):
+    """
+    MetadataEngine that records the latency of every fetch.
+    """
+
+    def __init__(self,*args,**kwargs):
+        MetadataEngine.__init__(self,*args,**kwargs)
+        self.latencies = []
+
+    def fetch(self,point):
+        start = time.perf_counter()
+        result = MetadataEngine.fetch(self,point)
+        self.latencies.append(time.perf_counter()-start) # list append is atomic
+        return result
+
+
+class TimedDownloads(DownloadManager):
+    """
+    DownloadManager that records the latency of every image.
+    """
+
+    def __init__(self,*args,**kwargs):
+        DownloadManager.__init__(self,*args,**kwargs)
+        self.latencies = []
+
+    def fetch(self,url,path):
+        start = time.perf_counter()
+        result = DownloadManager.fetch(self,url,path)
+        self.latencies.append(time.perf_counter()-start)
+        return result
+
+
+def percentiles(samples):
+    """
+    Returns count, p50, p90, p99 and max of latency samples in milliseconds.
+
+    Parameter samples: list of seconds
+    """
+    if not samples:
+        return {'count':0}
+    ordered = sorted(samples)
+    pick = lambda q: round(ordered[min(len(ordered)-1,int(q*len(ordered)))]*1000,3)
+    return {'count':len(ordered),'p50':pick(0.5),'p90':pick(0.9),'p99':pick(0.99),
+            'max':round(ordered[-1]*1000,3)}
+
+def measure(func,*args,**kwargs):
+    """
+    Run func and return its result with wall time and peak traced memory.
+
+    Parameter func: stage to run
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # stages print their whole state
+        result = func(*args,**kwargs)
+    elapsed = time.perf_counter()-start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds':round(elapsed,4),'peak_bytes':peak}
+
+def bench_region(stub,radius,destinations,center,options):
+    """
+    Run every stage for one region size and return the report.
+
+    Parameter stub: running StubServer
+    Parameter radius: region radius in miles
+    Parameter destinations: number of destinations around the center
+    Parameter center: (lat,lng) tuple
+    Parameter options: parsed command line arguments
+    """
+    name = "bench-"+str(radius)+"-"+str(destinations)
+    region = Region(name,center[0],center[1])
+    stages = {}
+    _, stages['level_routes'] = measure(region.level_routes,(radius,),destinations,360.0/destinations)
+    record_directions(stub.pages,center,region.destinations)
+
+    if options.browser:
+        from BrowserPool import BrowserPool # selenium is only needed with --browser
+        driver = BrowserPool(options.browsers,timeout=10,retries=0)
+    else:
+        driver = HTTPDriver()
+    _, stages['get_routes'] = measure(region.get_routes,driver,10,stub.maps_base)
+    if options.browser:
+        driver.close()
+    _, stages['get_segments'] = measure(region.get_segments)
+    _, stages['populate_routes'] = measure(region.populate_routes)
+
+    engine = TimedEngine(qps=options.qps,max_inflight=options.inflight,base=stub.base,retry_delay=0.01)
+    points, stages['write_region'] = measure(region.write_region,engine)
+
+    with open("../data/"+name+"-points.csv") as f:
+        rows = [line.split(",") for line in f]
+    panoramas = [Panorama(r[0],r[5],r[6],r[7],r[8],r[4]) for r in rows if r[5] != "0"]
+    manager = TimedDownloads(workers=options.workers,base=stub.base,root="../images")
+    _, stages['download'] = measure(manager.run,panoramas)
+
+    sampled = sum(len(i.points) for i in region.streets)
+    throughput = {'routes_per_sec':len(region.destinations)/max(stages['get_routes']['seconds'],1e-9),
+                  'streets_per_sec':len(region.streets)/max(stages['populate_routes']['seconds'],1e-9),
+                  'metadata_per_sec':len(engine.latencies)/max(stages['write_region']['seconds'],1e-9),
+                  'images_per_sec':manager.images/max(stages['download']['seconds'],1e-9),
+                  'bytes_per_sec':manager.bytes/max(stages['download']['seconds'],1e-9)}
+    return {'region':name,'radius_miles':radius,'destinations':len(region.destinations),
+            'streets':len(region.streets),'sample_points':sampled,'points_written':points,
+            'panoramas':len(panoramas),'stages':stages,
+            'throughput':{k:round(v,2) for k,v in throughput.items()},
+            'latency_ms':{'metadata':percentiles(engine.latencies),'image':percentiles(manager.latencies)}}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the crawl pipeline against local stub services.")
+    parser.add_argument("--radii",type=float,nargs="+",default=[0.05,0.1,0.25],help="region radii in miles")
+    parser.add_argument("--destinations",type=int,default=8,help="destinations per region")
+    parser.add_argument("--latency",type=float,default=0.01,help="stub response latency in seconds")
+    parser.add_argument("--error-rate",type=float,default=0.0,help="fraction of stub requests failing")
+    parser.add_argument("--density",type=float,default=10.0,help="panorama spacing in meters")
+    parser.add_argument("--coverage",type=float,default=0.9,help="fraction of locations with a panorama")
+    parser.add_argument("--qps",type=float,default=1000,help="metadata calls per second")
+    parser.add_argument("--inflight",type=int,default=16,help="concurrent metadata calls")
+    parser.add_argument("--workers",type=int,default=8,help="concurrent image downloads")
+    parser.add_argument("--browser",action="store_true",help="load routes with headless Chrome")
+    parser.add_argument("--browsers",type=int,default=2,help="drivers in the pool with --browser")
+    parser.add_argument("--output",help="write JSON report to this file")
+    options = parser.parse_args(argv)
+
+    workspace = tempfile.mkdtemp(prefix="gsv-bench-")
+    for folder in ("data","images","run","pages"):
+        os.makedirs(os.path.join(workspace,folder))
+    output = os.path.abspath(options.output) if options.output else None
+    os.chdir(os.path.join(workspace,"run")) # stages write to ../data and ../images
+
+    stub = StubServer(latency=options.latency,error_rate=options.error_rate,density=options.density,
+                      coverage=options.coverage,pages=os.path.join(workspace,"pages"))
+    report = {'config':vars(options),'workspace':workspace,'regions':[]}
+    try:
+        for radius in options.radii:
+            report['regions'].append(bench_region(stub,radius,options.destinations,(34.041842,-118.244583),options))
+    finally:
+        stub.close()
+    report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report['metrics'] = json.loads(metrics.export_json())
+    text = json.dumps(report,indent=2)
+    if output:
+        with open(output,"w") as f:
+            f.write(text)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Module defines the BrowserPool class, a set of headless Chrome drivers that
+share page loads between worker threads.
+
+Work items are handed to whichever driver is free. Each item gets its own time
+limit and a number of retries. A timed out item is retried on the same driver
+while a driver that crashes is replaced before the next attempt, so one stuck
+browser does not stall the whole batch. An item that still fails gets a default
+result and is listed in failures instead of stopping the batch. Callers are
+expected to wait on a page condition with WebDriverWait instead of sleeping for
+a fixed time.
+"""
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException, TimeoutException
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import metrics
+import threading
+import queue
+
+CHROMEDRIVER = '../miscellaneous/chromedriver'
+
+def make_driver(headless=True,path=CHROMEDRIVER):
+    """
+    Returns a new Chrome driver with the options used across the project.
+
+    Parameter headless: run the browser without a window
+    Parameter path: location of chromedriver executable
+    """
+    options = Options()
+    options.add_argument("--disable-extensions")
+    options.add_argument("--disable-gpu")
+    if headless:
+        options.add_argument("--headless") # run in background
+    return webdriver.Chrome(path,options=options)
+
+
+class BrowserPool():
+    """
+    A class representing a pool of Selenium drivers.
+
+    Attribute size: number of drivers and worker threads.
+
+    Attribute factory: function returning a new driver, make_driver by default.
+
+    Attribute timeout: seconds allowed per page load and per wait.
+
+    Attribute retries: extra attempts per item after the first one fails.
+
+    Attribute failures: items that failed every attempt in the last map call.
+    """
+
+    def __init__(self,size=4,factory=make_driver,timeout=20,retries=2):
+        """
+        Initialize pool. Drivers are started on first use.
+
+        Parameter size: number of drivers
+        Parameter factory: function returning a new driver
+        Parameter timeout: seconds allowed per item attempt
+        Parameter retries: extra attempts per item
+        """
+        self.size = size
+        self.factory = factory
+        self.timeout = timeout
+        self.retries = retries
+        self.failures = []
+        self.idle = queue.Queue()
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def _take(self):
+        """
+        Returns an idle driver, starting a new one if the pool is not full.
+        """
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                start = self.started < self.size
+                if start:
+                    self.started += 1
+            if start:
+                return self._start()
+            try:
+                return self.idle.get(timeout=1.0)
+            except queue.Empty:
+                pass # look again, a driver that failed to start frees its slot
+
+    def _start(self):
+        """
+        Returns a new driver for a slot already counted in started. The slot is
+        given back if the driver cannot be started.
+        """
+        try:
+            driver = self.factory()
+            driver.set_page_load_timeout(self.timeout)
+        except Exception:
+            with self.lock:
+                self.started -= 1
+            raise
+        return driver
+
+    def _discard(self,driver):
+        """
+        Quit a broken driver and free its slot, so the next _take can start a
+        fresh one.
+
+        Parameter driver: driver to discard
+        """
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        with self.lock:
+            self.started -= 1
+
+    def _run(self,func,item,default):
+        """
+        Run func(driver, item, timeout) with retries on a pooled driver. An item
+        that fails every attempt, or raises anything but a WebDriverException,
+        is added to failures and gets default, the rest of the batch goes on.
+
+        Parameter func: work function
+        Parameter item: work item
+        Parameter default: value returned when every attempt fails
+        """
+        driver = None
+        try:
+            for attempt in range(self.retries+1):
+                try:
+                    if driver is None:
+                        driver = self._take() # raises WebDriverException if Chrome cannot start
+                    return func(driver,item,self.timeout)
+                except TimeoutException: # slow page, the driver itself is fine
+                    metrics.count("browser_retries_total",reason="timeout")
+                except WebDriverException:
+                    metrics.count("browser_retries_total",reason="crash")
+                    if driver is not None:
+                        broken, driver = driver, None # never pooled again
+                        self._discard(broken)
+                except Exception: # not a browser problem, retrying will not help
+                    metrics.count("browser_retries_total",reason="error")
+                    break
+            metrics.count("browser_failed_total")
+            self.failures.append(item)
+            return default
+        finally:
+            if driver is not None:
+                self.idle.put(driver)
+
+    def map(self,func,items,default=None):
+        """
+        Apply func to every item across the pool and return results in item order.
+
+        func is called as func(driver, item, timeout) and should raise a
+        WebDriverException subclass, such as TimeoutException, to ask for a retry.
+        TimeoutException keeps the driver, other WebDriverExceptions replace it.
+        Items that still fail get default and are listed in failures.
+
+        Parameter func: work function
+        Parameter items: iterable of work items
+        Parameter default: result for items that failed every attempt
+        """
+        self.failures = []
+        with ThreadPoolExecutor(max_workers=self.size) as pool:
+            futures = [pool.submit(self._run,func,item,default) for item in items]
+            return [f.result() for f in futures]
+
+    def close(self):
+        """
+        Quit every driver in the pool.
+        """
+        while not self.idle.empty():
+            try:
+                self.idle.get_nowait().quit()
+            except WebDriverException:
+                pass
+        self.started = 0
@@ -0,0 +1,201 @@
+"""
+Module defines the CoveragePlanner class, which chooses route destinations for a
+Region by how much unseen road they are expected to add, instead of loading a
+route to every destination level_routes places on fixed circles.
+
+The planner keeps a grid of cells about cell meters wide over the region. A
+cell is covered once a segment of a loaded route passes through it. Candidates
+are the same circles of destinations level_routes would use, and every candidate
+has a corridor, the cells along the straight line from the center to it. The
+expected gain of a candidate is the number of corridor cells that are neither
+covered nor in the corridor of a route already loaded. Routes are loaded in
+small batches of the highest expected gains. Planning stops when the new cells
+per route of a batch, or the best expected gain left, falls below min_gain.
+
+history records coverage after every batch, so coverage can be plotted against
+the number of route fetches.
+"""
+
+from SpatialIndex import METERS_PER_DEGREE, meters
+from Helper import radial_distance
+from Metrics import metrics
+from math import cos,radians,ceil,floor
+
+
+class CoveragePlanner():
+    """
+    A class choosing and loading route destinations for a Region.
+
+    Attribute region: Region whose destinations, intersections or segments are filled.
+
+    Attribute cell: grid cell size in meters.
+
+    Attribute min_gain: new cells per route below which planning stops.
+
+    Attribute batch: routes loaded between coverage updates, e.g. the size of
+    a BrowserPool.
+
+    Attribute candidates: destinations not loaded yet, mapped to their corridor.
+
+    Attribute covered: set of grid cells with a loaded road segment.
+
+    Attribute explored: set of grid cells in corridors of loaded routes.
+
+    Attribute history: list of coverage records, one per batch.
+    """
+
+    def __init__(self,region,radii=(0.25,0.5,0.75,1.0),count=90,step=4,cell=25.0,corridor=1,
+                 min_gain=4,batch=4):
+        """
+        Initialize planner with candidate destinations.
+
+        Parameter region: Region object
+        Parameter radii: candidate distances in miles, see Region.level_routes
+        Parameter count: candidates per distance
+        Parameter step: degrees between candidates
+        Parameter cell: grid cell size in meters
+        Parameter corridor: cells on each side of the line counted as a corridor
+        Parameter min_gain: smallest worthwhile number of new cells per route
+        Parameter batch: routes loaded at a time
+        """
+        self.region = region
+        self.cell = cell
+        self.min_gain = min_gain
+        self.batch = batch
+        self.scale = cos(radians(region.center[0])) # longitude degrees shrink with latitude
+        self.covered = set()
+        self.explored = set()
+        self.history = []
+        self.candidates = {}
+        for r in radii:
+            for i in range(count):
+                destination = radial_distance(region.center[0],region.center[1],i*step,r)
+                self.candidates[destination] = self.line_cells(region.center,destination,corridor)
+
+    def cell_of(self,lat,lng):
+        """
+        Returns the (row, column) grid cell of a coordinate.
+
+        Parameters lat,lng: coordinate
+        """
+        size = self.cell/METERS_PER_DEGREE
+        return (int(floor(lat/size)),int(floor(lng*self.scale/size)))
+
+    def line_cells(self,A,B,width=0):
+        """
+        Returns the set of cells a straight line passes through, widened by
+        width cells on every side.
+
+        Parameters A,B: (lat,lng) end points
+        Parameter width: extra cells around each cell on the line
+        """
+        n = max(1,int(ceil(meters(A[0],A[1],B[0],B[1])/(self.cell/2)))) # two samples per cell
+        cells = set()
+        for k in range(n+1):
+            row, col = self.cell_of(A[0]+(B[0]-A[0])*k/n,A[1]+(B[1]-A[1])*k/n)
+            for dr in range(-width,width+1):
+                for dc in range(-width,width+1):
+                    cells.add((row+dr,col+dc))
+        return cells
+
+    def gain(self,destination):
+        """
+        Returns the expected new cells of loading the route to a candidate.
+
+        Parameter destination: candidate (lat,lng)
+        """
+        return len(self.candidates[destination] - self.covered - self.explored)
+
+    def add_segments(self,segments):
+        """
+        Mark the cells of a route's segments as covered. Returns the number of
+        cells that were not covered before.
+
+        Parameter segments: list of intersection segments, see Region.route_segments
+        """
+        before = len(self.covered)
+        for intersection in segments:
+            for A,B in intersection:
+                self.covered |= self.line_cells(A,B)
+        return len(self.covered) - before
+
+    def next_batch(self):
+        """
+        Returns up to batch candidates with the highest expected gain, at least
+        min_gain each.
+        """
+        ranked = sorted(((self.gain(d),d) for d in self.candidates),reverse=True)
+        return [d for g,d in ranked[:self.batch] if g >= self.min_gain]
+
+    def load(self,destinations,driver=None,graph=None,timeout=20,base=None,cache=None,bend=20):
+        """
+        Load routes to destinations into the region. Returns, for every route,
+        its list of intersection segments.
+
+        Parameter destinations: list of (lat,lng)
+        Parameter driver: Selenium driver or BrowserPool for Google Maps routes
+        Parameter graph: OSMRouter.RoadGraph for offline routes
+        Parameter timeout: seconds per route
+        Parameter base: Maps directions root, Region's default if None
+        Parameter cache: RouteCache or None
+        Parameter bend: see OSMRouter.RoadGraph.corners
+        """
+        self.region.destinations.extend(destinations)
+        if graph is not None:
+            segments = [graph.route_segments(self.region.center,d,bend) for d in destinations]
+            self.region.segments.extend(segments) # as Region.get_routes_osm does
+            return [[s] for s in segments] # one intersection per offline route
+        kwargs = {'cache':cache,'destinations':destinations}
+        if base is not None:
+            kwargs['base'] = base
+        self.region.get_routes(driver,timeout,**kwargs)
+        return [self.region.route_segments(r) for r in self.region.intersections[-len(destinations):]]
+
+    def run(self,driver=None,graph=None,timeout=20,base=None,cache=None,max_routes=None,bend=20):
+        """
+        Load routes in batches of the best candidates until the gain runs out.
+        Returns the coverage history.
+
+        With a driver, the region's intersections are filled and get_segments
+        runs as before. With a graph, segments are filled directly and
+        get_segments must not be called, like Region.get_routes_osm.
+
+        Parameter driver: Selenium driver or BrowserPool
+        Parameter graph: OSMRouter.RoadGraph
+        Parameter timeout: seconds per route
+        Parameter base: Maps directions root
+        Parameter cache: RouteCache or None
+        Parameter max_routes: stop after this many routes, no limit by default
+        Parameter bend: see OSMRouter.RoadGraph.corners
+        """
+        fetches = 0
+        while self.candidates:
+            chosen = self.next_batch()
+            if max_routes is not None:
+                chosen = chosen[:max_routes-fetches]
+            if not chosen:
+                break # every candidate left is expected to add too little
+            expected = sum(self.gain(d) for d in chosen)
+            for d in chosen:
+                self.explored |= self.candidates.pop(d)
+            new = 0
+            for segments in self.load(chosen,driver,graph,timeout,base,cache,bend):
+                new += self.add_segments(segments)
+            fetches += len(chosen)
+            metrics.count("coverage_routes_total",len(chosen))
+            self.history.append({'fetches':fetches,'covered_cells':len(self.covered),
+                                 'covered_km2':round(len(self.covered)*self.cell**2/1e6,4),
+                                 'new_cells':new,'expected_cells':expected})
+            if float(new)/len(chosen) < self.min_gain:
+                break # routes stopped finding new road
+        return self.history
+
+    def report(self):
+        """
+        Returns the coverage history with the route fetches saved against
+        loading every candidate.
+        """
+        fetches = self.history[-1]['fetches'] if self.history else 0
+        total = fetches + len(self.candidates)
+        return {'fetches':fetches,'candidates':total,'saved':total-fetches,
+                'covered_cells':len(self.covered),'history':self.history}
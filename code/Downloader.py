@@ -0,0 +1,237 @@
+"""
+Module defines the DownloadManager class. It replaces calling Panorama.download
+in a loop, which opens two fresh connections per panorama and waits for each
+image in turn.
+
+Images for many panoramas are fetched in parallel from a bounded thread pool.
+Each worker thread keeps its own keep-alive connection per host, so the TLS
+handshake is paid once per worker instead of once per image. Files are written
+to a temporary name and renamed into place, so an image on disk is always
+complete. Images already present are skipped, which makes an interrupted batch
+resume where it stopped when it is run again. With an ImageDedup index,
+placeholder images are not written or requested again, and an image identical
+to one already on disk is stored as a hard link to it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from collections import deque
+from Panorama import HEADINGS, BASE
+from Helper import backoff
+from Metrics import metrics
+import http.client
+import threading
+import glob
+import time
+import os
+
+
+class DownloadManager():
+    """
+    A class downloading side images for batches of Panorama objects.
+
+    Attribute workers: maximum number of images downloading at once.
+
+    Attribute base: StreetView API root. Point it at a local server for testing.
+
+    Attribute root: images folder, one sub folder per region.
+
+    Attribute timeout: socket timeout in seconds.
+
+    Attribute retries: attempts per image before it is reported as failed.
+
+    Attribute quota: optional QuotaGuard every image request goes through.
+
+    Attribute dedup: optional ImageDedup consulted before an image is written.
+
+    Attribute images,skipped,failed,bytes: counters for the current batch.
+    """
+
+    def __init__(self,workers=8,base=BASE,root="../images",timeout=30,retries=3,quota=None,dedup=None):
+        """
+        Initialize manager with concurrency limit and storage location.
+
+        Parameter workers: number of parallel downloads
+        Parameter base: StreetView API root
+        Parameter root: images folder
+        Parameter timeout: socket timeout in seconds
+        Parameter retries: attempts per image
+        Parameter quota: QuotaGuard shared with other workers, or None
+        Parameter dedup: ImageDedup index, or None
+        """
+        self.workers = workers
+        self.base = base
+        self.root = root
+        self.timeout = timeout
+        self.retries = retries
+        self.quota = quota
+        self.dedup = dedup
+        self.local = threading.local() # per thread connection pool
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero the batch counters.
+        """
+        self.images = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def _connection(self,scheme,host):
+        """
+        Return this thread's keep-alive connection to host, opening it if needed.
+
+        Parameter scheme: "http" or "https"
+        Parameter host: network location of the server
+        """
+        pool = self.local.__dict__.setdefault('pool',{})
+        conn = pool.get((scheme,host))
+        if conn is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host,timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host,timeout=self.timeout)
+            pool[(scheme,host)] = conn
+        return conn
+
+    def _get(self,url):
+        """
+        Return the body of url over a pooled connection.
+
+        Parameter url: link to request
+        """
+        parts = urlsplit(url)
+        path = parts.path + ("?"+parts.query if parts.query else "")
+        conn = self._connection(parts.scheme,parts.netloc)
+        try:
+            conn.request("GET",path)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException,OSError):
+            conn.close() # drop broken connection, next request reconnects
+            raise
+        if response.status != 200:
+            raise IOError("HTTP "+str(response.status)+" for "+url)
+        return body
+
+    def fetch(self,url,path):
+        """
+        Download one image to path atomically. Existing files are skipped.
+
+        Returns the number of bytes written, 0 if skipped.
+
+        Parameter url: image link
+        Parameter path: destination file
+        """
+        if os.path.exists(path) or (self.dedup is not None and self.dedup.skip(path)):
+            with self.lock:
+                self.skipped += 1
+            return 0
+        for attempt in range(self.retries):
+            if self.quota is not None:
+                self.quota.acquire("image")
+            start = time.perf_counter()
+            try:
+                body = self._get(url)
+                break
+            except (http.client.HTTPException,OSError):
+                metrics.count("image_requests_total",status="IOError")
+                if attempt == self.retries-1:
+                    metrics.count("image_failed_total")
+                    with self.lock:
+                        self.failed.append(path)
+                    return 0
+                metrics.count("image_retries_total")
+                time.sleep(backoff(attempt))
+        metrics.observe("image_latency_seconds",time.perf_counter()-start)
+        metrics.count("image_requests_total",status="OK")
+        metrics.count("image_bytes_total",len(body))
+        action, canonical = self.dedup.check(path,body) if self.dedup is not None else ("write",None)
+        if action == "placeholder":
+            metrics.count("image_placeholders_total")
+            with self.lock:
+                self.skipped += 1
+            return 0
+        tmp = path + ".part"
+        if action == "link":
+            os.link(canonical,tmp) # identical image already on disk
+        else:
+            with open(tmp,"wb") as f:
+                f.write(body)
+        os.replace(tmp,path) # rename is atomic, readers never see half an image
+        with self.lock:
+            self.images += 1
+            self.bytes += len(body)
+        return len(body)
+
+    def tasks(self,panoramas):
+        """
+        Generate (url, path) pairs for the side images of each panorama.
+
+        Parameter panoramas: iterable of Panorama objects
+        """
+        for p in panoramas:
+            folder = self.root+"/"+p.region
+            if not os.path.isdir(folder):
+                os.makedirs(folder,exist_ok=True)
+            for heading in HEADINGS:
+                yield (p.image_url(heading,self.base),p.image_path(heading,self.root))
+
+    def cleanup(self,region):
+        """
+        Remove temporary files left over by an interrupted batch.
+
+        Parameter region: region name
+        """
+        for tmp in glob.glob(self.root+"/"+region+"/*.part"):
+            os.remove(tmp)
+
+    @metrics.timed("download")
+    def run(self,panoramas,done=None):
+        """
+        Download both side images for every panorama and return batch statistics.
+
+        The input is consumed lazily with at most a few tasks queued per worker,
+        so it can be a generator fed by an earlier stage.
+
+        Parameter panoramas: iterable of Panorama objects
+        Parameter done: optional function called with each panorama once both of
+        its images are on disk
+        """
+        self.reset()
+        pending = deque()
+
+        def finished(p,path,remaining,future):
+            if future.exception() is not None or path in self.failed:
+                return
+            with self.lock:
+                remaining[0] -= 1
+                complete = remaining[0] == 0
+            if complete:
+                done(p)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for p in panoramas:
+                remaining = [len(HEADINGS)] # images of p still to finish
+                for url,path in self.tasks([p]):
+                    if len(pending) >= 2*self.workers:
+                        pending.popleft().result()
+                    future = pool.submit(self.fetch,url,path)
+                    if done is not None:
+                        future.add_done_callback(lambda f,p=p,path=path,r=remaining: finished(p,path,r,f))
+                    pending.append(future)
+            while pending:
+                pending.popleft().result()
+        return self.stats()
+
+    def stats(self):
+        """
+        Return batch counters with bytes/sec and images/sec throughput.
+        """
+        elapsed = max(time.monotonic()-self.start,1e-9)
+        return {'images':self.images,'skipped':self.skipped,'failed':len(self.failed),
+                'bytes':self.bytes,'seconds':round(elapsed,3),
+                'bytes_per_sec':round(self.bytes/elapsed,1),'images_per_sec':round(self.images/elapsed,2)}
@@ -2,31 +2,71 @@
 Module contains static functions used in the project.
 
 If there is a function not pertinent to a particular class, it is defined here.
+
+Each geodesy function has a *_batch counterpart that takes NumPy arrays and
+computes every pair in one vectorized call. The scalar functions are thin
+wrappers around the batch ones so both always agree.
 """
 
-from math import asin,cos,pi,sin,atan2,degrees,radians,sqrt
+from math import pi
+import numpy as np
+import random
 
 
 RADIUS_EARTH = 6371.01 # earth's radius in kilometers
 EPSILON = 0.000001 # threshold parameter for distance calculation
 
+def direction_batch(lat1,lng1,lat2,lng2):
+    """
+    Returns the directions from points A to points B in degrees (0-360) as an array.
+
+    Parameters lat1,lng1: arrays of coordinates of points A
+    Parameters lat2,lng2: arrays of coordinates of points B
+    Formula derived from https://www.movable-type.co.uk/scripts/latlong.html
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    lng_diff = np.radians(np.subtract(lng2,lng1))
+    x = np.sin(lng_diff) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) * np.cos(lng_diff))
+    initial_bearing = np.degrees(np.arctan2(x, y))
+    return (initial_bearing + 360) % 360
+
 def direction(lat1,lng1,lat2,lng2):
     """
     Returns the direction from point A to B in degrees (0-360)
 
     Parameters lat1,lng1: coordinates of point A
     Parameters lat2,lng2: coordinates of point B
-    Formula derived from https://www.movable-type.co.uk/scripts/latlong.html
     """
-    lat1 = radians(lat1)
-    lat2 = radians(lat2)
-    lng_diff = radians(lng2 - lng1)
-    x = sin(lng_diff) * cos(lat2)
-    y = cos(lat1) * sin(lat2) - (sin(lat1)* cos(lat2) * cos(lng_diff))
-    initial_bearing = atan2(x, y)
-    initial_bearing = degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
-    return(compass_bearing)
+    return float(direction_batch(lat1,lng1,lat2,lng2))
+
+def interpolate_batch(A,B,spacing=15):
+    """
+    Returns coordinates between every pair of points A[i] and B[i] in a straight
+    line, 15 meters apart, generated in one pass.
+
+    The result is a tuple (points, offsets). points is a contiguous (N,2) array of
+    lat,lng values for all segments and the samples of segment i are
+    points[offsets[i]:offsets[i+1]].
+
+    Parameter A: (M,2) array of first end points
+    Parameter B: (M,2) array of second end points
+    Parameter spacing: distance between samples in meters
+    """
+    A = np.asarray(A,dtype=np.float64).reshape(-1,2)
+    B = np.asarray(B,dtype=np.float64).reshape(-1,2)
+    distance = haversine_batch(A[:,0],A[:,1],B[:,0],B[:,1])*1000 # get distances in meters
+    split = (distance/spacing).astype(np.int64) # how many unique points per segment
+    offsets = np.zeros(len(A)+1,dtype=np.int64)
+    np.cumsum(split,out=offsets[1:])
+    owner = np.repeat(np.arange(len(A)),split) # segment index of every sample
+    i = np.arange(offsets[-1]) - offsets[owner] # index of sample within its segment
+    frac = i / split[owner]
+    points = np.empty((offsets[-1],2),dtype=np.float64)
+    points[:,0] = A[owner,0] + (B[owner,0]-A[owner,0]) * frac
+    points[:,1] = A[owner,1] + (B[owner,1]-A[owner,1]) * frac
+    return points, offsets
 
 def interpolate(lat1,lng1,lat2,lng2):
     """
@@ -35,30 +75,53 @@ def interpolate(lat1,lng1,lat2,lng2):
     Parameters lat1,lng1: coordinates of point A
     Parameters lat2,lng2: coordinates of point B
     """
-    segments = []
-    distance = haversine(lat1,lng1,lat2,lng2)*1000 # get distance in meters
-    split = int(distance/15) # how many unique points need to be generated
-    for i in range(split): # find x and y coordinates for each point
-        x = lat1 + (lat2-lat1) * (i/split)
-        y = lng1 + (lng2-lng1) * (i/split)
-        segments.append((x,y)) # generate list of points --> [(x1,y1),(x2,y2),...]
-    return segments
+    points, offsets = interpolate_batch([lat1,lng1],[lat2,lng2])
+    return [tuple(p) for p in points.tolist()] # list of points --> [(x1,y1),(x2,y2),...]
 
-def haversine(lat1,lng1,lat2,lng2):
+def haversine_batch(lat1,lng1,lat2,lng2):
     """
-    Returns haversine distance between 2 points A and B in kilometers.
+    Returns haversine distances between points A and B in kilometers as an array.
 
-    Parameters lat1,lng1: coordinates of point A
-    Parameters lat2,lng2: coordinates of point B
+    Parameters lat1,lng1: arrays of coordinates of points A
+    Parameters lat2,lng2: arrays of coordinates of points B
     Formula derived from https://www.movable-type.co.uk/scripts/latlong.html
     """
-    lng1, lat1, lng2, lat2 = map(radians, [lng1, lat1, lng2, lat2])
+    lng1, lat1, lng2, lat2 = map(np.radians, [lng1, lat1, lng2, lat2])
     delta_lng = lng2 - lng1
     delta_lat = lat2 - lat1
-    a = sin(delta_lat/2)**2 + cos(lat1) * cos(lat2) * sin(delta_lng/2)**2
-    c = 2 * asin(sqrt(a))
+    a = np.sin(delta_lat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(delta_lng/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     return c * RADIUS_EARTH
 
+def haversine(lat1,lng1,lat2,lng2):
+    """
+    Returns haversine distance between 2 points A and B in kilometers.
+
+    Parameters lat1,lng1: coordinates of point A
+    Parameters lat2,lng2: coordinates of point B
+    """
+    return float(haversine_batch(lat1,lng1,lat2,lng2))
+
+def radial_distance_batch(lat,lng,bearing,dist):
+    """
+    Returns arrays of spatial coordinates some degrees and distance away from points.
+
+    Parameters lat,lng: arrays of coordinates of starting points
+    Parameter bearing: array of directions in degrees
+    Parameter dist: array of distances in miles
+    Formula derived from https://www.movable-type.co.uk/scripts/latlong.html
+    """
+    radian_lat1 = np.radians(lat)
+    radian_lng1 = np.radians(lng)
+    radian_bearing = np.radians(bearing)
+    norm_distance = np.divide(dist, RADIUS_EARTH) # normalize linear distance to radian angle
+    radian_lat = np.arcsin( np.sin(radian_lat1) * np.cos(norm_distance) + np.cos(radian_lat1) * np.sin(norm_distance) * np.cos(radian_bearing) )
+    cos_lat = np.cos(radian_lat)
+    pole = np.abs(cos_lat) < EPSILON # endpoint a pole
+    with np.errstate(divide='ignore',invalid='ignore'):
+        radian_lng = ( (radian_lng1 - np.arcsin( np.sin(radian_bearing)* np.sin(norm_distance) / cos_lat ) + pi ) % (2*pi) ) - pi
+    radian_lng = np.where(pole,radian_lng1,radian_lng)
+    return (np.degrees(radian_lat), np.degrees(radian_lng))
 
 def radial_distance(lat,lng,bearing, dist):
     """
@@ -67,17 +130,17 @@ def radial_distance(lat,lng,bearing, dist):
     Parameters lat,lng: coordinates of point A
     Parameter bearing: direction in degrees
     Parameter dist: distance in miles
-    Formula derived from https://www.movable-type.co.uk/scripts/latlong.html
     """
-    radian_lat1 = radians(lat)
-    radian_lng1 = radians(lng)
-    radian_bearing = radians(bearing)
-    norm_distance = dist / RADIUS_EARTH # normalize linear distance to radian angle
-    radian_lat = asin( sin(radian_lat1) * cos(norm_distance) + cos(radian_lat1) * sin(norm_distance) * cos(radian_bearing) )
-    if cos(radian_lat) == 0 or abs(cos(radian_lat)) < EPSILON: # endpoint a pole
-        radian_lng=radian_lng1
-    else:
-        radian_lng = ( (radian_lng1 - asin( sin(radian_bearing)* sin(norm_distance) / cos(radian_lat) ) + pi ) % (2*pi) ) - pi
-    lat = degrees(radian_lat)
-    lng = degrees(radian_lng)
-    return (lat, lng)
+    lat, lng = radial_distance_batch(lat,lng,bearing,dist)
+    return (float(lat), float(lng))
+
+def backoff(attempt,base=1.0,cap=60.0):
+    """
+    Returns seconds to wait before retry number attempt, using exponential backoff
+    with full jitter so many workers failing together do not retry in lockstep.
+
+    Parameter attempt: retry number, starting at 0
+    Parameter base: wait before the first retry in seconds
+    Parameter cap: longest wait in seconds
+    """
+    return random.uniform(0,min(cap,base*2**attempt))
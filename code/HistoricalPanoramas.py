@@ -8,88 +8,220 @@ click the timemachine button, if present, then use JS script to fetch the total
 number of historical panoramas. Iterate through them one by one and fetch the
 date and panorama ID for those panoramas.
 
+HistoricalHarvester runs this for every row of a region's points file across a
+BrowserPool. Each finished panorama is appended to <region>-history.jsonl right
+away, keyed by its current panorama ID, and panoramas already in that file are
+skipped, so a crashed run resumes where it stopped.
+
 TODO: Pipeline to server to join with relevant panoramas.
 TODO: Incorporate within Panorama class as set of functions.
 """
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import JavascriptException
+from PointStore import PointStore, store_path
+from Metrics import metrics
+import threading
 import time
-import pandas as pd
-
+import json
+import os
 
-# Selenium driver connection
-options = Options()
-options.add_argument("--disable-extensions")
-options.add_argument("--disable-gpu")
-driver = webdriver.Chrome('../miscellaneous/chromedriver',options=options)
+TIMELINE_BUTTON = "b4tYeb-icon noprint"
+TIMELINE_LIST = "var x = document.getElementsByClassName('T6Hn3d')[0].childNodes[7].getElementsByTagName('li');"
+THUMBNAIL = "eWNdlf-AHe6Kc-JUCs7e"
+DATE_LABEL = "kXDede"
 
 
-def fetch_panorama(panoID,lat,lng):
+def fetch_panorama(driver,panoID,lat,lng,timeout=10):
     """
     Fetch the ID and date of old panoramas given the location of a current panorama.
 
     This works by first finding X number of buttons for X historical panoramas. Then
     find the list view object in the site that holds the buttons for historical panoramas
     and click on them one by one. fetch_info is called for each index of historical
-    panorama.
+    panorama. Returns a list of (date, panorama ID) tuples, empty if the location
+    has no older panoramas.
 
+    Parameter driver: Selenium Chrome driver
     Parameter panoID: ID of latest panorama for location
     Parameters lat,lng: Location of panorama
+    Parameter timeout: seconds to wait for each page element
     """
+    from selenium.common.exceptions import TimeoutException # selenium loads with the first page
+    from selenium.webdriver.support.ui import WebDriverWait
 
+    start = time.perf_counter()
     # go to street view link for current panorama
     link = "https://www.google.com/maps?q="+str(lat)+","+str(lng)+"&layer=c&cbll="+str(lat)+","+str(lng)+"&cbp=11,90,0,0,0"
     driver.get(link)
-    time.sleep(5) # give time to load completely
-    try: # click on timeline button on site if exists
-        driver.execute_script('document.getElementsByClassName("b4tYeb-icon noprint")[0].click()')
-    except JavascriptException:
-        print("no older panos") # some locations do not have old panoramas
-        return
+    try: # wait for timeline button on site, some locations do not have old panoramas
+        WebDriverWait(driver,timeout).until(
+            lambda d: d.execute_script('return document.getElementsByClassName("'+TIMELINE_BUTTON+'").length') > 0)
+    except TimeoutException:
+        metrics.count("history_lookups_total",result="none")
+        return []
+    driver.execute_script('document.getElementsByClassName("'+TIMELINE_BUTTON+'")[0].click()')
 
     # execute JS code in browser to fetch count of buttons for historical panoramas
-    js_code = "var x = document.getElementsByClassName('T6Hn3d')[0].childNodes[7].getElementsByTagName('li');"
-    js_code+="return x.length"
-    pano_count = driver.execute_script(js_code)
+    WebDriverWait(driver,timeout).until(lambda d: d.execute_script(
+        "return document.getElementsByClassName('T6Hn3d').length") > 0)
+    pano_count = driver.execute_script(TIMELINE_LIST+"return x.length")
 
-    for index in range(pano_count):
-        info = fetch_info(index) # fetch information for each old panorama
-        print(panoID,lat,lng,info[0],info[1])
+    history = [fetch_info(driver,index,timeout) for index in range(pano_count)]
+    metrics.observe("history_lookup_seconds",time.perf_counter()-start)
+    metrics.count("history_lookups_total",result="found")
+    metrics.count("history_panoramas_total",len(history))
+    return history
 
 
-def fetch_info(index):
+def fetch_info(driver,index,timeout=10):
     """
     Fetch the ID and date of an old panorama given an index value.
 
     Click on panorama button then click on window to load the panorama. Then store
-    the date and ID of panorama from JS objects.
+    the date and ID of panorama from JS objects. Each click waits for the page to
+    show its result instead of sleeping. Raises TimeoutException when the
+    thumbnail has no panorama ID, so BrowserPool retries the row on the same
+    browser and records it as failed instead of stopping the harvest.
 
+    Parameter driver: Selenium Chrome driver
     Parameter index: which button in list to press to fetch current historical panorama.
+    Parameter timeout: seconds to wait for each page element
     """
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.support.ui import WebDriverWait
 
-    js_code="var x = document.getElementsByClassName('T6Hn3d')[0].childNodes[7].getElementsByTagName('li');"
-    js_code+="x["+str(index)+"].getElementsByClassName('NKAWqe')[0].click()" # click on button
+    def thumbnail_src(d):
+        found = d.find_elements_by_class_name(THUMBNAIL)
+        return found[0].get_attribute("src") if found else None
+
+    previous = thumbnail_src(driver)
+    js_code = TIMELINE_LIST+"x["+str(index)+"].getElementsByClassName('NKAWqe')[0].click()" # click on button
     driver.execute_script(js_code)
-    time.sleep(1)
-    driver.execute_script("document.getElementsByClassName('eWNdlf-AHe6Kc-JUCs7e')[0].click()") # expand panorama
-    time.sleep(2)
+    try: # thumbnail switches to the selected panorama
+        WebDriverWait(driver,timeout).until(lambda d: (thumbnail_src(d) or previous) != previous)
+    except TimeoutException:
+        pass # selected panorama was already showing
+    driver.execute_script("document.getElementsByClassName('"+THUMBNAIL+"')[0].click()") # expand panorama
+    WebDriverWait(driver,timeout).until(lambda d: len(d.find_elements_by_class_name(DATE_LABEL)) > 1
+                                        and d.find_elements_by_class_name(DATE_LABEL)[1].get_attribute("innerText"))
 
     # now date and panorama ID of historical panorama should be stored
-    date = driver.find_elements_by_class_name("kXDede")[1].get_attribute("innerText")
+    date = driver.find_elements_by_class_name(DATE_LABEL)[1].get_attribute("innerText")
     date = date.replace("Currently shown: ","")
-    src = driver.find_elements_by_class_name("eWNdlf-AHe6Kc-JUCs7e")[0].get_attribute("src")
+    src = thumbnail_src(driver)
+    if not src or "panoid" not in src: # page changed under us, let BrowserPool retry the row
+        raise TimeoutException("no panorama ID in thumbnail "+str(src))
     src = src[src.index("panoid")+7:-7]
     return(date,src)
 
 
-# read points file and only select important attributes into rows list
-columns = ['region', 'streetID', 'lat','lng','direction','panoID','pano_date','pano_lat','pano_lng']
-df = pd.read_csv("../data/DowntownLA-points.csv",header=None,names=columns)
-rows = list(zip(df.panoID,df.pano_lat,df.pano_lng,df.pano_date,df.direction))
+def read_points(region):
+    """
+    Read points file and only select important attributes into rows list. The
+    columnar store is used when the region has one, the CSV otherwise.
+
+    Parameter region: region name
+    """
+    if os.path.exists(store_path(region)):
+        store = PointStore(region)
+        rows = store.panorama_records()
+        return [(store.pano_id(r['pano']),float(r['pano_lat']),float(r['pano_lng']),str(r['date']),
+                 float(r['direction'])) for r in rows]
+    import pandas as pd
+    columns = ['region', 'streetID', 'lat','lng','direction','panoID','pano_date','pano_lat','pano_lng']
+    df = pd.read_csv("../data/"+region+"-points.csv",header=None,names=columns)
+    return list(zip(df.panoID,df.pano_lat,df.pano_lng,df.pano_date,df.direction))
+
+
+class HistoricalHarvester():
+    """
+    A class fetching historical panoramas for every panorama of a region.
+
+    Attribute region: region name, selects the points file.
+
+    Attribute pool: BrowserPool running the page loads.
 
-# testing on just the first row
-fetch_panorama(rows[0][0],rows[0][1],rows[0][2])
+    Attribute output: JSON lines file, one record per current panorama.
+
+    Attribute done: set of current panorama IDs already in output.
+    """
 
-driver.close()
+    def __init__(self,region,pool,output=None):
+        """
+        Initialize harvester and load checkpoint from output file.
+
+        Parameter region: region name
+        Parameter pool: BrowserPool to use
+        Parameter output: output file, ../data/<region>-history.jsonl by default
+        """
+        self.region = region
+        self.pool = pool
+        self.output = output or "../data/"+region+"-history.jsonl"
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(self.output):
+            with open(self.output) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['panoID'])
+                    except ValueError:
+                        pass # last line cut off by a crash, it will be fetched again
+
+    def record(self,row,history):
+        """
+        Append one panorama's history to the output file.
+
+        Parameter row: (panoID, lat, lng, date, direction) tuple from points file
+        Parameter history: list of (date, panorama ID) tuples
+        """
+        entry = {'panoID':row[0],'lat':row[1],'lng':row[2],'date':row[3],
+                 'history':[{'date':h[0],'panoID':h[1]} for h in history]}
+        with self.lock:
+            with open(self.output,"a") as f:
+                print(json.dumps(entry),file=f)
+            self.done.add(row[0])
+
+    @metrics.timed("history")
+    def harvest(self,rows=None):
+        """
+        Fetch history for every row not already in output. Returns rows that
+        failed every attempt, they are picked up again on the next run.
+
+        Parameter rows: rows to process, the whole points file by default
+        """
+        rows = rows if rows is not None else read_points(self.region)
+        todo = []
+        seen = set()
+        for row in rows:
+            if row[0] in self.done or row[0] in seen or str(row[0]) == "0":
+                continue # finished earlier, repeated or no panorama at point
+            seen.add(row[0])
+            todo.append(row)
+
+        def work(driver,row,timeout):
+            self.record(row,fetch_panorama(driver,row[0],row[1],row[2],timeout))
+            return True
+
+        self.pool.map(work,todo,default=False)
+        return list(self.pool.failures)
+
+
+def main(region="DowntownLA",browsers=4):
+    """
+    Harvest the history of every panorama of a region.
+
+    Parameter region: region name
+    Parameter browsers: drivers in the BrowserPool
+    """
+    from BrowserPool import BrowserPool
+    pool = BrowserPool(browsers)
+    try:
+        failed = HistoricalHarvester(region,pool).harvest()
+    finally:
+        pool.close()
+    print(len(failed),"panoramas failed")
+    metrics.write("../data/"+region+"-history-metrics.json")
+    return failed
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+Module defines the ImageDedup class, an index of downloaded side images that
+finds exact and near duplicates.
+
+Different panorama IDs and headings often return the same picture, most often
+the "no imagery" placeholder, and adjacent captures can give frames that only
+differ by compression noise. Every image is hashed with SHA-256 for exact
+matches and with a 64 bit difference hash (dHash) for near matches. Near
+matches are looked up in a BK-tree, which only visits hashes within a given
+Hamming distance instead of comparing against every image.
+
+An exact duplicate on disk is replaced by a hard link to the first copy, so it
+takes no extra space. A near duplicate is kept but recorded with a reference to
+the image it matches, so later stages can skip it. SHA-256 hashes shared by many
+different panoramas are placeholders. DownloadManager asks the index before
+writing an image: placeholders are not written and are not requested again on
+the next crawl, and exact duplicates are linked instead of written.
+
+The perceptual hash needs the optional Pillow package. Exact matching and
+placeholder detection work without it.
+"""
+
+from Metrics import metrics
+import threading
+import hashlib
+import sqlite3
+import glob
+import os
+
+MASK = (1 << 64) - 1 # dHash values are stored as signed 64 bit SQLite integers
+
+def sha256(body):
+    """
+    Returns the hex SHA-256 digest of image bytes.
+
+    Parameter body: image bytes
+    """
+    return hashlib.sha256(body).hexdigest()
+
+def dhash(path,size=8):
+    """
+    Returns the difference hash of an image as a size*size bit integer. Each bit
+    says whether a pixel of the shrunk grayscale image is brighter than its right
+    neighbour, so small changes in compression or exposure keep the same hash.
+
+    Parameter path: image file
+    Parameter size: hash side length
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("perceptual hashing requires the Pillow package")
+    with Image.open(path) as image:
+        pixels = list(image.convert("L").resize((size+1,size),Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            value = (value << 1) | (pixels[row*(size+1)+col] > pixels[row*(size+1)+col+1])
+    return value
+
+def hamming(a,b):
+    """
+    Returns the number of bits two hashes differ in.
+
+    Parameters a,b: integer hashes
+    """
+    return bin(a ^ b).count("1")
+
+
+class BKTree():
+    """
+    A class representing a BK-tree over integer hashes with Hamming distance.
+
+    Every node keeps its children by their distance to it. The triangle
+    inequality means a search within radius r of a query at distance d from a
+    node only has to follow children at distances d-r to d+r.
+
+    Attribute root: [hash, value, {distance: child node}] or None.
+
+    Attribute size: number of hashes added.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self,value,item):
+        """
+        Insert a hash.
+
+        Parameter value: integer hash
+        Parameter item: anything returned by search for this hash
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [value,item,{}]
+            return
+        node = self.root
+        while True:
+            d = hamming(value,node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value,item,{}]
+                return
+            node = child
+
+    def search(self,value,radius):
+        """
+        Returns (distance, item) pairs of hashes within radius, closest first.
+
+        Parameter value: integer hash
+        Parameter radius: maximum Hamming distance
+        """
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(value,node[0])
+            if d <= radius:
+                found.append((d,node[1]))
+            for k,child in node[2].items():
+                if d-radius <= k <= d+radius:
+                    stack.append(child)
+        return sorted(found)
+
+
+class ImageDedup():
+    """
+    A class recording content hashes of images and their duplicates.
+
+    Attribute path: SQLite file shared by crawls.
+
+    Attribute radius: dHash Hamming distance up to which images count as near
+    duplicates.
+
+    Attribute threshold: distinct panoramas sharing one SHA-256 hash before it
+    is treated as a placeholder.
+
+    Attribute placeholders: set of placeholder SHA-256 hashes.
+
+    Attribute tree: BKTree of the dHash of every canonical image, built by scan.
+    """
+
+    def __init__(self,path="../data/image-dedup.sqlite",radius=4,threshold=5):
+        """
+        Open or create the index.
+
+        Parameter path: SQLite file location
+        Parameter radius: near duplicate distance in bits out of 64
+        Parameter threshold: panoramas per hash that make a placeholder
+        """
+        self.path = path
+        self.radius = radius
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,timeout=30,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, sha TEXT, dhash INTEGER,
+                canonical TEXT, distance INTEGER);
+            CREATE INDEX IF NOT EXISTS images_sha ON images (sha);
+            CREATE TABLE IF NOT EXISTS placeholders (sha TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS skipped (path TEXT PRIMARY KEY, sha TEXT);
+        """)
+        self.db.commit()
+        self.placeholders = set(r[0] for r in self.db.execute("SELECT sha FROM placeholders"))
+        self.tree = None
+
+    def _panorama(self,path):
+        return os.path.basename(path).rsplit("-",1)[0] # <panoID>-<heading>.jpg
+
+    def skip(self,path):
+        """
+        Returns True if path was a placeholder before, so it need not be requested.
+
+        Parameter path: image file
+        """
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM skipped WHERE path=?",(path,)).fetchone() is not None
+
+    def check(self,path,body):
+        """
+        Decide what to do with a downloaded image before it is written. Returns
+        ("placeholder", None) if it must not be written, ("link", canonical) if
+        an identical image is already on disk, ("write", None) otherwise. The
+        image is recorded in every case.
+
+        Parameter path: destination file
+        Parameter body: image bytes
+        """
+        digest = sha256(body)
+        with self.lock:
+            if digest not in self.placeholders:
+                # any copy with these bytes will do, near duplicates included, unique images first
+                rows = self.db.execute("SELECT path FROM images WHERE sha=? ORDER BY canonical IS NOT NULL",
+                                       (digest,)).fetchall()
+                canonical = next((r[0] for r in rows if os.path.exists(r[0]) and r[0] != path),None)
+                self.db.execute("INSERT OR REPLACE INTO images VALUES (?,?,NULL,?,?)",
+                                (path,digest,canonical,0 if canonical else None))
+                self._learn(digest)
+            if digest in self.placeholders: # known, or just learned from this image
+                self.db.execute("INSERT OR REPLACE INTO skipped VALUES (?,?)",(path,digest))
+                self.db.commit()
+                return "placeholder", None
+            self.db.commit()
+        if canonical is not None:
+            return "link", canonical
+        return "write", None
+
+    def _learn(self,digest):
+        """
+        Mark a hash as a placeholder once enough panoramas share it. Caller
+        holds the lock.
+        """
+        if digest in self.placeholders:
+            return
+        paths = [r[0] for r in self.db.execute("SELECT path FROM images WHERE sha=?",(digest,))]
+        if len(set(self._panorama(p) for p in paths)) >= self.threshold:
+            self.placeholders.add(digest)
+            self.db.execute("INSERT OR IGNORE INTO placeholders VALUES (?)",(digest,))
+            metrics.count("image_placeholder_hashes_total")
+
+    def add_placeholder(self,body):
+        """
+        Register a known placeholder image.
+
+        Parameter body: image bytes
+        """
+        digest = sha256(body)
+        with self.lock:
+            self.placeholders.add(digest)
+            self.db.execute("INSERT OR IGNORE INTO placeholders VALUES (?)",(digest,))
+            self.db.commit()
+
+    def scan(self,region,root="../images",perceptual=None):
+        """
+        Hash every image of a region not indexed yet. Exact duplicates are
+        replaced by hard links, near duplicates get a reference to the image they
+        match, and placeholders are removed from disk. Images recorded by check
+        while downloading only get their dHash here. Returns counts.
+
+        Parameter region: region name
+        Parameter root: images folder
+        Parameter perceptual: also compute dHash and look for near duplicates,
+        by default when Pillow is installed
+        """
+        if perceptual is None:
+            try:
+                import PIL
+                perceptual = True
+            except ImportError:
+                perceptual = False
+        if perceptual and self.tree is None:
+            self.tree = BKTree()
+            for path,value in self.db.execute("SELECT path,dhash FROM images WHERE dhash IS NOT NULL "
+                                              "AND canonical IS NULL"):
+                self.tree.add(value & MASK,path)
+        counts = {'images':0,'exact':0,'near':0,'placeholders':0}
+        with self.lock:
+            known = set(r[0] for r in self.db.execute("SELECT path FROM images"))
+            # written through check by DownloadManager, SHA-256 only
+            unhashed = set(r[0] for r in self.db.execute("SELECT path FROM images WHERE dhash IS NULL "
+                                                         "AND canonical IS NULL")) if perceptual else set()
+        for path in sorted(glob.glob(root+"/"+region+"/*.jpg")):
+            if path in unhashed:
+                action = "write"
+            elif path in known:
+                continue
+            else:
+                counts['images'] += 1
+                with open(path,"rb") as f:
+                    action, canonical = self.check(path,f.read())
+            if action == "placeholder":
+                os.remove(path)
+                counts['placeholders'] += 1
+            elif action == "link":
+                tmp = path+".part"
+                os.link(canonical,tmp)
+                os.replace(tmp,path) # same bytes, now stored once
+                counts['exact'] += 1
+            elif perceptual:
+                try:
+                    value = dhash(path)
+                except OSError:
+                    continue # not a readable image, keeps only its SHA-256
+                near = self.tree.search(value,self.radius)
+                stored = value - (1 << 64) if value > MASK >> 1 else value
+                with self.lock:
+                    if near: # keep the file, point it at the image it repeats
+                        self.db.execute("UPDATE images SET dhash=?, canonical=?, distance=? WHERE path=?",
+                                        (stored,near[0][1],near[0][0],path))
+                    else:
+                        self.db.execute("UPDATE images SET dhash=? WHERE path=?",(stored,path))
+                    self.db.commit()
+                if near:
+                    counts['near'] += 1
+                else:
+                    self.tree.add(value,path)
+        with self.lock: # copies written before their hash was known to be a placeholder
+            rows = self.db.execute("SELECT path,sha FROM images WHERE sha IN (SELECT sha FROM placeholders)").fetchall()
+            for path,digest in rows:
+                if os.path.exists(path):
+                    os.remove(path)
+                    counts['placeholders'] += 1
+                self.db.execute("INSERT OR REPLACE INTO skipped VALUES (?,?)",(path,digest))
+            self.db.execute("DELETE FROM images WHERE sha IN (SELECT sha FROM placeholders)")
+            self.db.commit()
+        metrics.count("image_duplicates_total",counts['exact'],kind="exact")
+        metrics.count("image_duplicates_total",counts['near'],kind="near")
+        return counts
+
+    def canonical(self,path):
+        """
+        Returns the image path is a duplicate of, or path itself if it is unique.
+
+        Parameter path: image file
+        """
+        with self.lock:
+            row = self.db.execute("SELECT canonical FROM images WHERE path=?",(path,)).fetchone()
+        return row[0] if row and row[0] else path
+
+    def unique(self,region,root="../images"):
+        """
+        Returns the images of a region that are not duplicates, for stages that
+        should only process each picture once.
+
+        Parameter region: region name
+        Parameter root: images folder
+        """
+        folder = root+"/"+region+"/"
+        with self.lock:
+            rows = self.db.execute("SELECT path FROM images WHERE canonical IS NULL AND substr(path,1,?)=?",
+                                   (len(folder),folder)).fetchall()
+        return sorted(r[0] for r in rows if os.path.exists(r[0]))
+
+    def close(self):
+        self.db.close()
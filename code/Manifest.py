@@ -0,0 +1,224 @@
+"""
+Module defines the Manifest class, a per-region SQLite record of crawl progress.
+
+The manifest stores which stages have finished, the streets of the region, the
+metadata result of every point and which panoramas have had their images
+downloaded. A run that dies part way can start again from the stored streets,
+points that were already resolved are answered from the manifest, and images
+that are already on disk are skipped.
+
+For a periodic refresh, points whose result is older than a given age are
+queried again, bypassing any shared cache, and images are only downloaded for
+panorama IDs that are new or come back with a newer date.
+"""
+
+from MetadataCache import MetadataCache, CACHED_STATUSES
+import sqlite3
+import threading
+import time
+
+
+class Manifest():
+    """
+    A class representing the progress of one region's crawl.
+
+    Attribute region: region name, the file is ../data/<region>-manifest.sqlite.
+
+    Attribute cache: optional MetadataCache behind the manifest.
+
+    Attribute max_age: seconds after which a point result is re-queried, None
+    to reuse results of any age.
+    """
+
+    def __init__(self,region,path=None,cache=None,max_age=None):
+        """
+        Open or create a region's manifest.
+
+        Parameter region: region name
+        Parameter path: SQLite file location, ../data/<region>-manifest.sqlite by default
+        Parameter cache: MetadataCache to consult for points not in the manifest
+        Parameter max_age: seconds before a stored point result is stale
+        """
+        self.region = region
+        self.cache = cache
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path or "../data/"+region+"-manifest.sqlite",timeout=30,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # one commit per point must stay cheap
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS stages (name TEXT PRIMARY KEY, status TEXT, updated REAL);
+            CREATE TABLE IF NOT EXISTS streets (street_id INTEGER PRIMARY KEY, a_lat REAL, a_lng REAL,
+                b_lat REAL, b_lng REAL, status TEXT, updated REAL);
+            CREATE TABLE IF NOT EXISTS points (lat_q INTEGER, lng_q INTEGER, heading_q INTEGER,
+                status TEXT, pano_id TEXT, pano_date TEXT, pano_lat REAL, pano_lng REAL, queried REAL,
+                PRIMARY KEY (lat_q,lng_q,heading_q));
+            CREATE TABLE IF NOT EXISTS downloads (pano_id TEXT PRIMARY KEY, pano_date TEXT, downloaded REAL);
+        """)
+        self.db.commit()
+
+    def _read(self,sql,args=()):
+        with self.lock:
+            return self.db.execute(sql,args).fetchone()
+
+    def _write(self,sql,args=()):
+        with self.lock:
+            self.db.execute(sql,args)
+            self.db.commit()
+
+    def stage(self,name):
+        """
+        Returns the status of a stage, None if it never started.
+
+        Parameter name: stage name, e.g. "streets", "points", "download"
+        """
+        row = self._read("SELECT status FROM stages WHERE name=?",(name,))
+        return row[0] if row else None
+
+    def set_stage(self,name,status):
+        """
+        Record the status of a stage.
+
+        Parameter name: stage name
+        Parameter status: "running" or "done"
+        """
+        self._write("INSERT OR REPLACE INTO stages VALUES (?,?,?)",(name,status,time.time()))
+
+    def save_streets(self,streets):
+        """
+        Store the end points of every street so later runs can skip routing.
+
+        Parameter streets: list of Street objects
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("DELETE FROM streets")
+            self.db.executemany("INSERT INTO streets VALUES (?,?,?,?,?,?,?)",
+                                [(s.ID,s.A[0],s.A[1],s.B[0],s.B[1],"pending",now) for s in streets])
+            self.db.commit()
+        self.set_stage("streets","done")
+
+    def load_streets(self):
+        """
+        Returns stored streets as (streetID, A, B) tuples in streetID order.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT street_id,a_lat,a_lng,b_lat,b_lng FROM streets ORDER BY street_id").fetchall()
+        return [(r[0],[r[1],r[2]],[r[3],r[4]]) for r in rows]
+
+    def street_done(self,streetID):
+        """
+        Mark every point of a street as resolved.
+
+        Parameter streetID: street UID
+        """
+        self._write("UPDATE streets SET status='done', updated=? WHERE street_id=?",(time.time(),streetID))
+
+    def progress(self):
+        """
+        Returns counts of done and total streets, points and downloads.
+        """
+        streets = self._read("SELECT COUNT(*), SUM(status='done') FROM streets")
+        points = self._read("SELECT COUNT(*) FROM points")[0]
+        downloads = self._read("SELECT COUNT(*) FROM downloads")[0]
+        return {'streets':streets[0],'streets_done':streets[1] or 0,'points':points,'downloads':downloads}
+
+    def get(self,lat,lng,heading):
+        """
+        Returns the stored metadata for a point in the shape of an API response,
+        or None if it has to be queried. Points never seen fall through to the
+        cache. Stale points return None without the cache, so they are re-queried.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        """
+        k = MetadataCache.key(lat,lng,heading)
+        row = self._read("SELECT status,pano_id,pano_date,pano_lat,pano_lng,queried FROM points "
+                         "WHERE lat_q=? AND lng_q=? AND heading_q=?",k)
+        if row is not None:
+            if self.max_age is not None and row[5] < time.time()-self.max_age:
+                return None # stale, ask the API again
+            json_data = {'status':row[0]}
+            if row[1] is not None:
+                json_data['pano_id'] = row[1]
+                json_data['location'] = {'lat':row[3],'lng':row[4]}
+            if row[2] is not None:
+                json_data['date'] = row[2]
+            return json_data
+        if self.cache is not None:
+            json_data = self.cache.get(lat,lng,heading)
+            if json_data is not None:
+                self.record(lat,lng,heading,json_data)
+            return json_data
+        return None
+
+    def peek(self,lat,lng,heading):
+        """
+        Return (status, pano_id) of a point that would not be queried, without
+        recording anything, None if it would be. Used for planning.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        """
+        row = self._read("SELECT status,pano_id,queried FROM points WHERE lat_q=? AND lng_q=? AND heading_q=?",
+                         MetadataCache.key(lat,lng,heading))
+        if row is not None:
+            if self.max_age is not None and row[2] < time.time()-self.max_age:
+                return None
+            return (row[0],row[1])
+        if self.cache is not None:
+            return self.cache.peek(lat,lng,heading)
+        return None
+
+    def put(self,lat,lng,heading,json_data):
+        """
+        Store a fresh API response in the manifest and the cache.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        Parameter json_data: dictionary decoded from the metadata API response
+        """
+        self.record(lat,lng,heading,json_data)
+        if self.cache is not None:
+            self.cache.put(lat,lng,heading,json_data)
+
+    def record(self,lat,lng,heading,json_data):
+        """
+        Store a point result in the manifest only. Transient errors are not stored.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        Parameter json_data: dictionary in the shape of an API response
+        """
+        if json_data.get('status') not in CACHED_STATUSES:
+            return
+        lcn = json_data.get('location',{})
+        self._write("INSERT OR REPLACE INTO points VALUES (?,?,?,?,?,?,?,?,?)",
+                    MetadataCache.key(lat,lng,heading) + (json_data['status'],json_data.get('pano_id'),
+                    json_data.get('date'),lcn.get('lat'),lcn.get('lng'),time.time()))
+
+    def needs_download(self,panoID,date):
+        """
+        Returns "new" if a panorama's images were never downloaded, "newer" if
+        they were but for an older date, None if they are up to date.
+
+        Parameter panoID: panorama ID
+        Parameter date: panorama date, YYYY-MM
+        """
+        row = self._read("SELECT pano_date FROM downloads WHERE pano_id=?",(panoID,))
+        if row is None:
+            return "new"
+        if str(date) > str(row[0]): # YYYY-MM strings sort by date
+            return "newer"
+        return None
+
+    def downloaded(self,panorama):
+        """
+        Record that both images of a panorama are on disk.
+
+        Parameter panorama: Panorama object
+        """
+        self._write("INSERT OR REPLACE INTO downloads VALUES (?,?,?)",(panorama.ID,str(panorama.date),time.time()))
+
+    def close(self):
+        self.db.close()
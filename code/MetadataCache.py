@@ -0,0 +1,182 @@
+"""
+Module defines the MetadataCache class. It is a persistent SQLite store for
+StreetView metadata responses so repeat crawls and overlapping regions do not
+pay for the same API call twice.
+
+Entries are keyed on lat,lng quantized to 6 decimals (about 10 cm) and heading
+quantized to a tenth of a degree. Both panoramas and ZERO_RESULTS negatives are
+stored. Every entry carries its own expiry time, and the table is kept under a
+maximum size by evicting the least recently used rows.
+"""
+
+import sqlite3
+import threading
+import time
+
+DAY = 86400 # seconds
+CACHED_STATUSES = ('OK','ZERO_RESULTS','NOT_FOUND') # other statuses are transient
+
+class MetadataCache():
+    """
+    A class representing an on-disk metadata cache.
+
+    Attribute path: SQLite file location.
+
+    Attribute ttl: seconds a panorama entry stays valid.
+
+    Attribute negative_ttl: seconds a ZERO_RESULTS entry stays valid. Coverage
+    changes more often than existing panoramas so this is shorter.
+
+    Attribute max_entries: size bound, least recently used rows go first.
+
+    Attribute mode: "normal" reads and writes, "refresh" skips reads but stores
+    new results, "bypass" neither reads nor writes.
+
+    Attribute hits,misses,stores,evictions: counters for the current process.
+    """
+
+    def __init__(self,path="../data/metadata-cache.sqlite",ttl=180*DAY,negative_ttl=30*DAY,
+                 max_entries=1000000,mode="normal"):
+        """
+        Open or create the cache file.
+
+        Parameter path: SQLite file location
+        Parameter ttl: lifetime of panorama entries in seconds
+        Parameter negative_ttl: lifetime of ZERO_RESULTS entries in seconds
+        Parameter max_entries: maximum rows kept
+        Parameter mode: "normal", "refresh" or "bypass"
+        """
+        if mode not in ("normal","refresh","bypass"):
+            raise ValueError("unknown cache mode: "+str(mode))
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,timeout=30,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL") # lets several processes share the file
+        self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+            lat_q INTEGER, lng_q INTEGER, heading_q INTEGER,
+            status TEXT, pano_id TEXT, date TEXT, pano_lat REAL, pano_lng REAL,
+            expires REAL, accessed REAL,
+            PRIMARY KEY (lat_q,lng_q,heading_q))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)")
+        self.db.commit()
+
+    @staticmethod
+    def key(lat,lng,heading):
+        """
+        Return the quantized cache key for a request.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        """
+        return (int(round(float(lat)*1e6)),int(round(float(lng)*1e6)),int(round(float(heading)*10)) % 3600)
+
+    def get(self,lat,lng,heading):
+        """
+        Return the cached metadata dictionary for a request, None on a miss.
+
+        The dictionary has the same shape as the API response so it can be passed
+        straight to Point.setPanoramaInfo.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        """
+        if self.mode != "normal":
+            self.misses += 1
+            return None
+        k = self.key(lat,lng,heading)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT status,pano_id,date,pano_lat,pano_lng,expires FROM metadata "
+                                  "WHERE lat_q=? AND lng_q=? AND heading_q=?",k).fetchone()
+            if row is None or row[5] < now: # missing or expired
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE metadata SET accessed=? WHERE lat_q=? AND lng_q=? AND heading_q=?",(now,)+k)
+            self.db.commit()
+            self.hits += 1
+        json_data = {'status':row[0]}
+        if row[1] is not None:
+            json_data['pano_id'] = row[1]
+            json_data['location'] = {'lat':row[3],'lng':row[4]}
+        if row[2] is not None:
+            json_data['date'] = row[2]
+        return json_data
+
+    def peek(self,lat,lng,heading):
+        """
+        Return (status, pano_id) of a live entry without counting a hit or
+        refreshing its LRU time, None if there is none. Used for planning.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        """
+        if self.mode != "normal":
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT status,pano_id FROM metadata WHERE lat_q=? AND lng_q=? AND heading_q=? "
+                                  "AND expires >= ?",self.key(lat,lng,heading)+(time.time(),)).fetchone()
+        return tuple(row) if row else None
+
+    def put(self,lat,lng,heading,json_data):
+        """
+        Store a metadata response. Transient error statuses are not stored.
+
+        Parameters lat,lng: coordinates of the point
+        Parameter heading: direction in degrees
+        Parameter json_data: dictionary decoded from the metadata API response
+        """
+        if self.mode == "bypass" or json_data.get('status') not in CACHED_STATUSES:
+            return
+        now = time.time()
+        ttl = self.ttl if json_data['status'] == 'OK' else self.negative_ttl
+        lcn = json_data.get('location',{})
+        row = self.key(lat,lng,heading) + (json_data['status'],json_data.get('pano_id'),json_data.get('date'),
+                                           lcn.get('lat'),lcn.get('lng'),now+ttl,now)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?,?,?,?,?,?,?,?,?,?)",row)
+            self.stores += 1
+            if self.stores % 1000 == 0: # checking the size on every write is wasteful
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        """
+        Drop expired rows, then least recently used rows above max_entries.
+        Caller holds the lock.
+        """
+        cur = self.db.execute("DELETE FROM metadata WHERE expires < ?",(time.time(),))
+        self.evictions += cur.rowcount
+        count = self.db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        if count > self.max_entries:
+            cur = self.db.execute("DELETE FROM metadata WHERE rowid IN (SELECT rowid FROM metadata "
+                                  "ORDER BY accessed LIMIT ?)",(count-self.max_entries,))
+            self.evictions += cur.rowcount
+
+    def evict(self):
+        """
+        Enforce TTL and size bound now.
+        """
+        with self.lock:
+            self._evict()
+            self.db.commit()
+
+    def stats(self):
+        """
+        Return counters as a dictionary.
+        """
+        return {'hits':self.hits,'misses':self.misses,'stores':self.stores,'evictions':self.evictions}
+
+    def close(self):
+        """
+        Flush eviction and close the database.
+        """
+        self.evict()
+        self.db.close()
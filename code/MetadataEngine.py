@@ -0,0 +1,159 @@
+"""
+Module defines the MetadataEngine class. The engine resolves StreetView metadata
+for many points at once instead of one blocking call per Point.
+
+Requests are sent from a bounded thread pool. A token bucket caps the number of
+calls per second across all threads and a separate limit caps how many requests
+are in flight at the same time. Results are always handed back in the order the
+points were given, so pointCounter order in Region is unchanged. An optional
+MetadataCache is checked first and cache hits never touch the network. An
+optional QuotaGuard adds a daily limit and QPS shared with other processes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from Point import BASE, query_metadata
+from Metrics import metrics
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    A thread safe token bucket used to rate limit API calls.
+
+    Attribute rate: tokens added per second (QPS).
+
+    Attribute capacity: maximum tokens that can be saved up for a burst.
+    """
+
+    def __init__(self,rate,capacity=None):
+        """
+        Initialize bucket full.
+
+        Parameter rate: queries per second allowed
+        Parameter capacity: burst size, defaults to one second worth of tokens
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1,rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available, then take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,self.tokens + (now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class MetadataEngine():
+    """
+    A class resolving panorama metadata for batches of Point objects.
+
+    Attribute bucket: TokenBucket limiting requests per second.
+
+    Attribute max_inflight: maximum number of concurrent requests.
+
+    Attribute base: StreetView API root. Point it at a local server for testing.
+
+    Attribute timeout: seconds before a single request is abandoned and retried.
+
+    Attribute retries: retries per point after a connection error.
+
+    Attribute retry_delay: wait before the first retry, doubled for each later one.
+
+    Attribute cache: optional MetadataCache in front of the API.
+
+    Attribute quota: optional QuotaGuard every call, retries included, goes through.
+    """
+
+    def __init__(self,qps=25,max_inflight=8,base=BASE,timeout=10,retries=5,retry_delay=1.0,cache=None,
+                 quota=None):
+        """
+        Initialize engine with rate and concurrency limits.
+
+        Parameter qps: maximum metadata calls per second
+        Parameter max_inflight: maximum metadata calls running at once
+        Parameter base: StreetView API root
+        Parameter timeout: per request timeout in seconds
+        Parameter retries: retries per point before giving up
+        Parameter retry_delay: seconds to sleep before the first retry
+        Parameter cache: MetadataCache to read from and write to, or None
+        Parameter quota: QuotaGuard shared with other workers, or None
+        """
+        self.bucket = TokenBucket(qps)
+        self.max_inflight = max_inflight
+        self.base = base
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.cache = cache
+        self.quota = quota
+
+    def before(self):
+        """
+        Wait for the local rate limit, then for the shared quota.
+        """
+        self.bucket.acquire()
+        if self.quota is not None:
+            self.quota.acquire("metadata")
+
+    def fetch(self,point):
+        """
+        Call StreetView metadata API for a single point and store the result on it.
+
+        Retries on connection errors with backoff, see Point.query_metadata.
+
+        Parameter point: Point object to fill with panorama information
+        """
+        if self.cache is not None:
+            json_data = self.cache.get(point.lat,point.lng,point.direction)
+            if json_data is not None:
+                metrics.count("metadata_cache_total",result="hit")
+                point.setPanoramaInfo(json_data)
+                return point
+            metrics.count("metadata_cache_total",result="miss")
+        json_data = query_metadata(point.metadata_url(self.base),self.timeout,self.retries,
+                                   self.retry_delay,self.before)
+        if json_data is None:
+            return point # gave up, point keeps no panorama
+        if self.cache is not None:
+            self.cache.put(point.lat,point.lng,point.direction,json_data)
+        point.setPanoramaInfo(json_data)
+        return point
+
+    def imap(self,points):
+        """
+        Resolve points concurrently and yield them back in input order.
+
+        The input is consumed lazily and at most max_inflight requests are
+        outstanding at any time, so arbitrarily long iterables are fine.
+
+        Parameter points: iterable of Point objects
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.max_inflight) as pool:
+            for point in points:
+                if len(pending) >= self.max_inflight:
+                    yield pending.popleft().result() # oldest first keeps order
+                pending.append(pool.submit(self.fetch,point))
+            while pending:
+                yield pending.popleft().result()
+
+    def resolve(self,points):
+        """
+        Resolve a list of points and return them in the same order.
+
+        Parameter points: iterable of Point objects
+        """
+        return list(self.imap(points))
@@ -0,0 +1,195 @@
+"""
+Module defines the Metrics class, which records where a crawl spends its time.
+
+Counters count events such as metadata requests by status, retries and bytes
+downloaded. Histograms record latency distributions. Stage timers add up the
+wall time of pipeline stages like get_routes or write_region. Every module
+records into the shared metrics object defined here. At the end of a run it can
+be exported as JSON or Prometheus text, and serve() exposes it live on a local
+HTTP port while the crawl runs.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from bisect import bisect_left
+import functools
+import threading
+import json
+import time
+
+LATENCY_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30) # seconds
+
+def _key(name,labels):
+    return (name,tuple(sorted(labels.items())))
+
+def _labels(labels,extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{"+",".join(k+'="'+str(v)+'"' for k,v in pairs)+"}"
+
+
+class Metrics():
+    """
+    A class holding counters, histograms and stage timers.
+
+    Attribute counters: dictionary of (name, labels) to value.
+
+    Attribute histograms: dictionary of (name, labels) to [bucket counts, sum, count].
+
+    Attribute buckets: dictionary of histogram name to bucket upper bounds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drop everything recorded so far.
+        """
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.buckets = {}
+            self.started = time.time()
+
+    def count(self,name,value=1,**labels):
+        """
+        Add value to a counter.
+
+        Parameter name: counter name
+        Parameter value: amount to add
+        Parameter labels: label values, e.g. status="OK"
+        """
+        k = _key(name,labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k,0) + value
+
+    def observe(self,name,value,buckets=LATENCY_BUCKETS,**labels):
+        """
+        Record a value in a histogram.
+
+        Parameter name: histogram name
+        Parameter value: observed value, seconds for latencies
+        Parameter buckets: bucket upper bounds, used when the histogram is new
+        Parameter labels: label values
+        """
+        k = _key(name,labels)
+        with self.lock:
+            bounds = self.buckets.setdefault(name,tuple(buckets))
+            h = self.histograms.get(k)
+            if h is None:
+                h = self.histograms[k] = [[0]*(len(bounds)+1),0.0,0]
+            h[0][bisect_left(bounds,value)] += 1
+            h[1] += value
+            h[2] += 1
+
+    def timer(self,stage):
+        """
+        Returns a context manager adding its wall time to a stage.
+
+        Parameter stage: stage name
+        """
+        metrics = self
+
+        class Timer():
+            def __enter__(self):
+                self.start = time.perf_counter()
+                return self
+            def __exit__(self,*exc):
+                metrics.count("stage_seconds_total",time.perf_counter()-self.start,stage=stage)
+                metrics.count("stage_runs_total",stage=stage)
+        return Timer()
+
+    def timed(self,stage):
+        """
+        Returns a decorator timing every call of a function as a stage.
+
+        Parameter stage: stage name
+        """
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args,**kwargs):
+                with self.timer(stage):
+                    return func(*args,**kwargs)
+            return wrapper
+        return decorate
+
+    def export_json(self):
+        """
+        Returns all metrics as a JSON string.
+        """
+        with self.lock:
+            counters = [{'name':k[0],'labels':dict(k[1]),'value':v} for k,v in sorted(self.counters.items())]
+            histograms = []
+            for k,h in sorted(self.histograms.items()):
+                bounds = [str(b) for b in self.buckets[k[0]]] + ["+Inf"]
+                histograms.append({'name':k[0],'labels':dict(k[1]),'buckets':dict(zip(bounds,h[0])),
+                                   'sum':h[1],'count':h[2]})
+        return json.dumps({'started':self.started,'uptime':time.time()-self.started,
+                           'counters':counters,'histograms':histograms},indent=2)
+
+    def export_prometheus(self):
+        """
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name,labels),value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append("# TYPE gsv_"+name+" counter")
+                    typed.add(name)
+                lines.append("gsv_"+name+_labels(labels)+" "+repr(float(value)))
+            for (name,labels),h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append("# TYPE gsv_"+name+" histogram")
+                    typed.add(name)
+                total = 0
+                for bound,n in zip([repr(float(b)) for b in self.buckets[name]]+["+Inf"],h[0]):
+                    total += n # buckets are cumulative
+                    lines.append("gsv_"+name+"_bucket"+_labels(labels,[("le",bound)])+" "+str(total))
+                lines.append("gsv_"+name+"_sum"+_labels(labels)+" "+repr(h[1]))
+                lines.append("gsv_"+name+"_count"+_labels(labels)+" "+str(h[2]))
+        return "\n".join(lines)+"\n"
+
+    def write(self,path):
+        """
+        Write metrics to a file, Prometheus text if path ends in .prom, JSON otherwise.
+
+        Parameter path: output file
+        """
+        with open(path,"w") as f:
+            f.write(self.export_prometheus() if path.endswith(".prom") else self.export_json())
+
+    def serve(self,port=9108):
+        """
+        Expose metrics on http://127.0.0.1:port/metrics (Prometheus) and
+        /metrics.json from a background thread. Returns the server.
+
+        Parameter port: local port
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    body, kind = metrics.export_json().encode(), "application/json"
+                else:
+                    body, kind = metrics.export_prometheus().encode(), "text/plain; version=0.0.4"
+                self.send_response(200)
+                self.send_header("Content-Type",kind)
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1",port),Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        return server
+
+
+metrics = Metrics() # shared by every module of the project
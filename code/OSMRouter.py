@@ -0,0 +1,214 @@
+"""
+Module defines the RoadGraph class, an offline alternative to scraping routes
+from Google Maps with Selenium.
+
+A local OpenStreetMap extract is loaded into a compact graph: node coordinates
+in two arrays and edges in compressed sparse row form. Routes from the region
+center to each destination are found with A* using straight line distance as
+the heuristic, then reduced to the corners of the route: junctions and points
+where the road bends. These corners become the same segment structure that
+Region.get_segments produces, so Region.populate_routes works unchanged.
+
+XML extracts (.osm) are read with the standard library. PBF extracts (.pbf)
+need the optional osmium package.
+"""
+
+from SpatialIndex import meters
+from Helper import direction
+import xml.etree.ElementTree as ET
+import numpy as np
+import heapq
+
+# highway values that can have Street View coverage from a car
+ROAD_TYPES = {'motorway','trunk','primary','secondary','tertiary','unclassified','residential',
+              'motorway_link','trunk_link','primary_link','secondary_link','tertiary_link',
+              'living_street','service'}
+
+def read_xml(path):
+    """
+    Returns node coordinates and road ways from an OSM XML file.
+
+    Parameter path: location of .osm file
+    """
+    nodes = {}
+    ways = []
+    for event, elem in ET.iterparse(path,events=('end',)):
+        if elem.tag == 'node':
+            nodes[int(elem.get('id'))] = (float(elem.get('lat')),float(elem.get('lon')))
+            elem.clear()
+        elif elem.tag == 'way':
+            tags = {t.get('k'):t.get('v') for t in elem.iter('tag')}
+            if tags.get('highway') in ROAD_TYPES:
+                ways.append([int(nd.get('ref')) for nd in elem.iter('nd')])
+            elem.clear()
+    return nodes, ways
+
+def read_pbf(path):
+    """
+    Returns node coordinates and road ways from an OSM PBF file.
+
+    Parameter path: location of .pbf file
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("reading .pbf extracts requires the osmium package, "
+                          "install it or convert the extract to .osm XML")
+
+    class Handler(osmium.SimpleHandler):
+        def __init__(self):
+            osmium.SimpleHandler.__init__(self)
+            self.nodes = {}
+            self.ways = []
+        def way(self,w):
+            if w.tags.get('highway') in ROAD_TYPES:
+                refs = []
+                for n in w.nodes:
+                    self.nodes[n.ref] = (n.location.lat,n.location.lon)
+                    refs.append(n.ref)
+                self.ways.append(refs)
+
+    handler = Handler()
+    handler.apply_file(path,locations=True)
+    return handler.nodes, handler.ways
+
+
+class RoadGraph():
+    """
+    A class representing an undirected road graph.
+
+    Attribute lat,lng: arrays of node coordinates, indexed by node number.
+
+    Attribute offsets,targets,weights: compressed sparse row adjacency. The
+    neighbours of node i are targets[offsets[i]:offsets[i+1]] at the distances
+    in meters stored in weights.
+    """
+
+    def __init__(self,nodes,ways):
+        """
+        Build graph from node coordinates and ways. Only nodes used by a way
+        are kept.
+
+        Parameter nodes: dictionary of OSM node id to (lat,lng)
+        Parameter ways: list of lists of OSM node ids
+        """
+        index = {}
+        edges = []
+        for way in ways:
+            way = [n for n in way if n in nodes] # extracts can be clipped mid way
+            for n in way:
+                if n not in index:
+                    index[n] = len(index)
+            for a,b in zip(way,way[1:]):
+                if a != b:
+                    edges.append((index[a],index[b]))
+        self.lat = np.empty(len(index))
+        self.lng = np.empty(len(index))
+        for n,i in index.items():
+            self.lat[i], self.lng[i] = nodes[n]
+        edges = np.array(edges,dtype=np.int64).reshape(-1,2)
+        edges = np.concatenate([edges,edges[:,::-1]]) # undirected
+        edges = edges[np.argsort(edges[:,0],kind='stable')]
+        self.offsets = np.zeros(len(index)+1,dtype=np.int64)
+        np.cumsum(np.bincount(edges[:,0],minlength=len(index)),out=self.offsets[1:])
+        self.targets = edges[:,1].copy()
+        a, b = edges[:,0], edges[:,1]
+        x = (self.lng[b]-self.lng[a]) * np.cos(np.radians((self.lat[a]+self.lat[b])/2)) * 111320.0
+        y = (self.lat[b]-self.lat[a]) * 111320.0
+        self.weights = np.sqrt(x*x + y*y)
+
+    @classmethod
+    def load(cls,path):
+        """
+        Returns a RoadGraph built from an OSM extract, .osm XML or .pbf.
+
+        Parameter path: location of extract
+        """
+        if path.endswith('.pbf'):
+            return cls(*read_pbf(path))
+        return cls(*read_xml(path))
+
+    def __len__(self):
+        return len(self.lat)
+
+    def degree(self,i):
+        return int(self.offsets[i+1]-self.offsets[i])
+
+    def nearest(self,lat,lng):
+        """
+        Returns the node closest to a coordinate.
+
+        Parameters lat,lng: coordinates
+        """
+        x = (self.lng-lng) * np.cos(np.radians(lat))
+        y = self.lat-lat
+        return int(np.argmin(x*x + y*y))
+
+    def shortest_path(self,source,target):
+        """
+        Returns the node numbers on the shortest path from source to target using
+        A*, an empty list if target cannot be reached.
+
+        Parameter source: start node
+        Parameter target: end node
+        """
+        lat, lng = self.lat, self.lng
+        goal = (lat[target],lng[target])
+        best = {source:0.0}
+        previous = {source:None}
+        heap = [(meters(lat[source],lng[source],*goal),source)]
+        done = set()
+        while heap:
+            f, node = heapq.heappop(heap)
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = previous[node]
+                return path[::-1]
+            if node in done:
+                continue
+            done.add(node)
+            g = best[node]
+            for k in range(self.offsets[node],self.offsets[node+1]):
+                nxt = int(self.targets[k])
+                cost = g + self.weights[k]
+                if cost < best.get(nxt,float('inf')):
+                    best[nxt] = cost
+                    previous[nxt] = node
+                    heapq.heappush(heap,(cost+meters(lat[nxt],lng[nxt],*goal),nxt))
+        return []
+
+    def corners(self,path,bend=20):
+        """
+        Returns the nodes of a path where the route meets another road or turns
+        by more than bend degrees, plus both ends. Straight stretches between
+        them become a single segment.
+
+        Parameter path: list of node numbers
+        Parameter bend: smallest change of direction in degrees that counts as a turn
+        """
+        if len(path) < 3:
+            return list(path)
+        kept = [path[0]]
+        for prev,node,nxt in zip(path,path[1:],path[2:]):
+            turn = abs(direction(self.lat[node],self.lng[node],self.lat[nxt],self.lng[nxt]) -
+                       direction(self.lat[kept[-1]],self.lng[kept[-1]],self.lat[node],self.lng[node]))
+            turn = min(turn,360-turn)
+            if self.degree(node) > 2 or turn > bend:
+                kept.append(node)
+        kept.append(path[-1])
+        return kept
+
+    def route_segments(self,origin,destination,bend=20):
+        """
+        Returns the route from origin to destination as a list of segments
+        ([lat1,lng1],[lat2,lng2]) between corners, rounded like Region.get_segments.
+
+        Parameter origin: (lat,lng) tuple
+        Parameter destination: (lat,lng) tuple
+        Parameter bend: see corners
+        """
+        path = self.shortest_path(self.nearest(*origin),self.nearest(*destination))
+        points = [[round(float(self.lat[i]),6),round(float(self.lng[i]),6)] for i in self.corners(path,bend)]
+        return [i for i in zip(points,points[1:]) if i[0] != i[1]]
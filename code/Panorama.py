@@ -5,7 +5,12 @@ images.
 """
 
 import urllib.request
+import time
+import os
+from Metrics import metrics
 key = "&key=" + "XXXX"
+BASE = r"https://maps.googleapis.com/maps/api/streetview"
+HEADINGS = (90,270) # right and left of the street
 
 class Panorama():
     """
@@ -40,20 +45,39 @@ class Panorama():
         self.lng = float(lng)
         self.direction = float(direction)
 
+    def image_url(self,heading,base=BASE):
+        """
+        Return the Street View API link for a flat image at heading offset from
+        the panorama's street direction.
+
+        Parameter heading: offset in degrees, 90 (right) or 270 (left)
+        Parameter base: StreetView API root
+        """
+        # API call is similar to one for point but without the metadata attachement
+        size = r"?size=1200x800&fov=80&location="
+        end = str(self.lat) + "," + str(self.lng) + "&heading=" + str(self.direction+heading) + key
+        return base + size + end
+
+    def image_path(self,heading,root="../images"):
+        """
+        Return the file location of the image at heading offset.
+
+        Parameter heading: offset in degrees, 90 (right) or 270 (left)
+        Parameter root: images folder, one sub folder per region
+        """
+        return root+"/"+self.region+"/"+self.ID+"-"+str(heading)+".jpg"
+
     def download(self):
         """
         Call Street View API to store panorama screenshot.
 
         2 images are stored per panorama, at 90 and 270 degrees after offset from
         panorama's street direction. Ensures that flat images are taken of the left
-        and right for each point.
+        and right for each point. For many panoramas use DownloadManager instead.
         """
-        # API call is similar to one for point but without the metadata attachement
-        base = r"https://maps.googleapis.com/maps/api/streetview"
-        size = r"?size=1200x800&fov=80&location="
-        # generate and store image for bearing 90 degrees (right)
-        end = str(self.lat) + "," + str(self.lng) + "&heading=" + str(self.direction+90) + key
-        urllib.request.urlretrieve(base + size + end,"../images/"+self.region+"/"+self.ID+"-90"+".jpg")
-        # generate and store image for bearing 270 degrees (left)
-        end = str(self.lat) + "," + str(self.lng) + "&heading=" + str(self.direction+270) + key
-        urllib.request.urlretrieve(base + size + end,"../images/"+self.region+"/"+self.ID+"-270"+".jpg")
+        for heading in HEADINGS:
+            start = time.perf_counter()
+            path, headers = urllib.request.urlretrieve(self.image_url(heading),self.image_path(heading))
+            metrics.observe("image_latency_seconds",time.perf_counter()-start)
+            metrics.count("image_requests_total",status="OK")
+            metrics.count("image_bytes_total",os.path.getsize(path))
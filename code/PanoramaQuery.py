@@ -0,0 +1,363 @@
+"""
+Module defines the PanoramaIndex class, a KD-tree over the panoramas of one or
+more crawled regions, to answer which panoramas and side images cover a
+location or an area without scanning the points files.
+
+The index is built from the regions' PointStore files. Panoramas are projected
+to meters around the mean latitude, sorted into KD-tree order and saved as two
+arrays, the tree nodes and the panorama records, in ../data/<name>-panoramas/.
+Opening an index reads nothing. The first query loads the tree nodes and the
+projected coordinates, 16 bytes per panorama, and memory-maps the rest of the
+records. After that a query only visits the few tree leaves near it in plain
+Python, a few microseconds each, and only the matching records are read.
+Supported queries are k nearest, within a radius and within a bounding box.
+Each result carries the panorama ID, date, location and its image paths under
+images/<region>/.
+
+serve exposes the same queries as JSON on a local HTTP port, e.g.
+http://127.0.0.1:8810/knn?lat=34.0418&lng=-118.2445&k=5
+
+Example: python PanoramaQuery.py build DowntownLA DowntownLA
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from SpatialIndex import METERS_PER_DEGREE
+from PointStore import PointStore
+from Panorama import HEADINGS
+from math import cos,radians,sqrt,hypot
+import numpy as np
+import threading
+import argparse
+import heapq
+import json
+import os
+
+LEAF = 16 # panoramas per tree leaf
+NODE_DTYPE = np.dtype([('lo','<i8'),('hi','<i8'),('xmin','<f8'),('ymin','<f8'),('xmax','<f8'),('ymax','<f8')])
+
+def index_path(name,root="../data"):
+    """
+    Returns the folder an index is stored in.
+
+    Parameter name: index name
+    Parameter root: data folder
+    """
+    return root+"/"+name+"-panoramas"
+
+
+class PanoramaIndex():
+    """
+    A class answering spatial queries over stored panoramas.
+
+    Attribute path: index folder.
+
+    Attribute images: images folder the returned paths point into.
+
+    Attribute nodes: tree nodes as (lo, hi, xmin, ymin, xmax, ymax) tuples,
+    node i has children 2i+1 and 2i+2 and covers records lo to hi. Loaded on
+    first query.
+
+    Attribute records: panorama records in tree order, memory-mapped.
+
+    Attribute x,y: projected coordinates of the records in meters.
+
+    Attribute regions: region names the region column indexes.
+
+    Attribute scale: meters per degree of longitude at the index latitude.
+    """
+
+    def __init__(self,name,root="../data",images="../images"):
+        """
+        Open an index without loading it.
+
+        Parameter name: index name
+        Parameter root: data folder
+        Parameter images: images folder
+        """
+        self.path = index_path(name,root)
+        self.images = images
+        self.nodes = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build(name,regions,root="../data",images="../images"):
+        """
+        Build an index over the panoramas of regions and return it opened. A
+        panorama found in several regions is kept once.
+
+        Parameter name: index name
+        Parameter regions: list of region names with a PointStore
+        Parameter root: data folder
+        Parameter images: images folder
+        """
+        parts = []
+        for code,region in enumerate(regions):
+            store = PointStore(region,root)
+            rows = store.panorama_records()
+            ids = np.array(store.panoramas,dtype=np.bytes_)[rows['pano']] if len(rows) else np.zeros(0,'S1')
+            parts.append((code,rows,ids))
+        width = max([1]+[p[2].dtype.itemsize for p in parts])
+        dtype = np.dtype([('x','<f8'),('y','<f8'),('lat','<f8'),('lng','<f8'),('direction','<f8'),
+                          ('date','<M8[M]'),('region','<i4'),('pano','S'+str(width))])
+        records = np.zeros(sum(len(p[1]) for p in parts),dtype=dtype)
+        n = 0
+        for code,rows,ids in parts:
+            chunk = records[n:n+len(rows)]
+            chunk['lat'], chunk['lng'] = rows['pano_lat'], rows['pano_lng']
+            chunk['direction'], chunk['date'] = rows['direction'], rows['date']
+            chunk['region'], chunk['pano'] = code, ids
+            n += len(rows)
+        records = records[np.sort(np.unique(records['pano'],return_index=True)[1])] # one row per panorama
+        lat0 = float(records['lat'].mean()) if len(records) else 0.0
+        scale = cos(radians(lat0))*METERS_PER_DEGREE
+        records['x'] = records['lng']*scale
+        records['y'] = records['lat']*METERS_PER_DEGREE
+
+        depth = 0
+        while len(records) > LEAF*2**depth:
+            depth += 1
+        nodes = np.zeros(2**(depth+1)-1,dtype=NODE_DTYPE)
+        order = np.arange(len(records))
+        x, y = records['x'], records['y']
+        stack = [(0,0,len(records))] if len(records) else []
+        while stack: # split on the wider side at the median until leaves are small
+            i, lo, hi = stack.pop()
+            idx = order[lo:hi]
+            xs, ys = x[idx], y[idx]
+            nodes[i] = (lo,hi,xs.min(),ys.min(),xs.max(),ys.max())
+            if hi-lo <= LEAF:
+                continue
+            mid = (lo+hi)//2
+            side = xs if xs.max()-xs.min() >= ys.max()-ys.min() else ys
+            order[lo:hi] = idx[np.argpartition(side,mid-lo)]
+            stack.append((2*i+1,lo,mid))
+            stack.append((2*i+2,mid,hi))
+
+        path = index_path(name,root)
+        os.makedirs(path,exist_ok=True)
+        np.save(path+"/records.npy",records[order])
+        np.save(path+"/nodes.npy",nodes)
+        with open(path+"/meta.json","w") as f:
+            json.dump({'regions':list(regions),'scale':scale,'count':len(records)},f)
+        return PanoramaIndex(name,root,images)
+
+    def load(self):
+        """
+        Load the index on first use.
+        """
+        if self.nodes is not None:
+            return
+        with self.lock:
+            if self.nodes is not None:
+                return
+            with open(self.path+"/meta.json") as f:
+                meta = json.load(f)
+            self.regions = meta['regions']
+            self.scale = meta['scale']
+            self.records = np.load(self.path+"/records.npy",mmap_mode='r' if meta['count'] else None)
+            # lists are much faster than numpy scalars for the few items a query touches
+            self.x = self.records['x'].tolist()
+            self.y = self.records['y'].tolist()
+            self.nodes = np.load(self.path+"/nodes.npy").tolist()
+
+    def __len__(self):
+        self.load()
+        return len(self.records)
+
+    def _point(self,lat,lng):
+        return lng*self.scale, lat*METERS_PER_DEGREE
+
+    def _box_distance(self,i,px,py):
+        """
+        Returns the distance from a point to the box of node i, 0 inside it.
+        """
+        lo, hi, xmin, ymin, xmax, ymax = self.nodes[i]
+        dx = max(xmin-px,0.0,px-xmax)
+        dy = max(ymin-py,0.0,py-ymax)
+        return sqrt(dx*dx+dy*dy)
+
+    def _leaf(self,i):
+        return 2*i+1 >= len(self.nodes) or self.nodes[i][1]-self.nodes[i][0] <= LEAF
+
+    def _children(self,i):
+        return [c for c in (2*i+1,2*i+2) if self.nodes[c][1] > self.nodes[c][0]]
+
+    def result(self,index,distance=None):
+        """
+        Returns a record as a dictionary.
+
+        Parameter index: record position
+        Parameter distance: meters from the query point, if any
+        """
+        x, y, lat, lng, direction, date, region, panoID = self.records[index].item() # plain Python values
+        panoID = panoID.decode()
+        region = self.regions[region]
+        entry = {'panoID':panoID,'region':region,'date':date.strftime("%Y-%m") if date else None,
+                 'lat':lat,'lng':lng,'direction':direction,
+                 'images':[self.images+"/"+region+"/"+panoID+"-"+str(h)+".jpg" for h in HEADINGS]}
+        if distance is not None:
+            entry['meters'] = round(float(distance),3)
+        return entry
+
+    def nearest(self,lat,lng,k=1):
+        """
+        Returns the k panoramas closest to a location, nearest first.
+
+        Parameters lat,lng: query location
+        Parameter k: number of panoramas
+        """
+        self.load()
+        if not len(self.records) or k < 1:
+            return []
+        px, py = self._point(lat,lng)
+        best = [] # max heap of (-distance, record) holding the k closest so far
+        frontier = [(self._box_distance(0,px,py),0)]
+        while frontier:
+            d, i = heapq.heappop(frontier)
+            if len(best) == k and d > -best[0][0]:
+                break # every remaining box is further than the k-th best
+            if not self._leaf(i):
+                for c in self._children(i):
+                    heapq.heappush(frontier,(self._box_distance(c,px,py),c))
+                continue
+            for j in range(self.nodes[i][0],self.nodes[i][1]):
+                dist = hypot(self.x[j]-px,self.y[j]-py)
+                if len(best) < k:
+                    heapq.heappush(best,(-dist,j))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best,(-dist,j))
+        return [self.result(j,-d) for d,j in sorted(best,reverse=True)]
+
+    def within(self,lat,lng,meters):
+        """
+        Returns the panoramas within a radius of a location, nearest first.
+
+        Parameters lat,lng: query location
+        Parameter meters: radius
+        """
+        self.load()
+        if not len(self.records):
+            return []
+        px, py = self._point(lat,lng)
+        found = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            if self._box_distance(i,px,py) > meters:
+                continue
+            if not self._leaf(i):
+                stack.extend(self._children(i))
+                continue
+            for j in range(self.nodes[i][0],self.nodes[i][1]):
+                dist = hypot(self.x[j]-px,self.y[j]-py)
+                if dist <= meters:
+                    found.append((dist,j))
+        return [self.result(j,d) for d,j in sorted(found)]
+
+    def bbox(self,south,west,north,east):
+        """
+        Returns the panoramas inside a bounding box, in index order.
+
+        Parameters south,west,north,east: bounding box in degrees
+        """
+        self.load()
+        if not len(self.records):
+            return []
+        xmin, ymin = self._point(south,west)
+        xmax, ymax = self._point(north,east)
+        found = []
+        stack = [0]
+        while stack:
+            i = stack.pop()
+            lo, hi, x0, y0, x1, y1 = self.nodes[i]
+            if x0 > xmax or x1 < xmin or y0 > ymax or y1 < ymin:
+                continue
+            if xmin <= x0 and x1 <= xmax and ymin <= y0 and y1 <= ymax:
+                found.extend(range(lo,hi)) # box fully inside, no need to look further
+            elif not self._leaf(i):
+                stack.extend(self._children(i))
+            else:
+                found.extend(j for j in range(lo,hi) if xmin <= self.x[j] <= xmax and ymin <= self.y[j] <= ymax)
+        return [self.result(j) for j in sorted(found)]
+
+    def query(self,path):
+        """
+        Returns the JSON-ready answer to a request path such as
+        /knn?lat=..&lng=..&k=.., /radius?lat=..&lng=..&meters=.. or
+        /bbox?south=..&west=..&north=..&east=..
+
+        Parameter path: request path with query string
+        """
+        parts = urlsplit(path)
+        args = {k:float(v[0]) for k,v in parse_qs(parts.query).items()}
+        if parts.path == "/knn":
+            return self.nearest(args['lat'],args['lng'],int(args.get('k',1)))
+        if parts.path == "/radius":
+            return self.within(args['lat'],args['lng'],args['meters'])
+        if parts.path == "/bbox":
+            return self.bbox(args['south'],args['west'],args['north'],args['east'])
+        raise KeyError(parts.path)
+
+    def serve(self,port=8810):
+        """
+        Answer queries on http://127.0.0.1:port from a background thread.
+        Returns the server.
+
+        Parameter port: local port
+        """
+        index = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    status, body = 200, json.dumps(index.query(self.path))
+                except (KeyError,ValueError) as e:
+                    status, body = 400, json.dumps({'error':"bad query: "+str(e)})
+                body = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type","application/json")
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1",port),Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, query or serve a panorama index.")
+    sub = parser.add_subparsers(dest="command",required=True)
+    build = sub.add_parser("build",help="index the panoramas of regions")
+    build.add_argument("name")
+    build.add_argument("regions",nargs="+")
+    near = sub.add_parser("knn",help="nearest panoramas to a location")
+    near.add_argument("name")
+    near.add_argument("lat",type=float)
+    near.add_argument("lng",type=float)
+    near.add_argument("-k",type=int,default=5)
+    serve = sub.add_parser("serve",help="answer queries over HTTP")
+    serve.add_argument("name")
+    serve.add_argument("--port",type=int,default=8810)
+    options = parser.parse_args(argv)
+
+    if options.command == "build":
+        print(len(PanoramaIndex.build(options.name,options.regions)),"panoramas indexed")
+    elif options.command == "knn":
+        print(json.dumps(PanoramaIndex(options.name).nearest(options.lat,options.lng,options.k),indent=2))
+    else:
+        server = PanoramaIndex(options.name).serve(options.port)
+        print("serving on http://127.0.0.1:"+str(options.port))
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Module defines the Pipeline class, which streams a region from sample points to
+downloaded images instead of running each stage to completion first.
+
+Sample points are generated street by street and resolved by a MetadataEngine
+as they are produced. Each new unique panorama is appended to the points CSV
+and the columnar PointStore straight away and put on a bounded queue, where a
+DownloadManager running in a second thread picks it up. Image downloads start with the first resolved
+panorama, metadata calls and downloads overlap, and only a bounded number of
+points and panoramas are held in memory at any time.
+
+With a Manifest, finished streets and downloads are recorded as they happen and
+only panoramas that are new or have a newer date than last time are downloaded.
+"""
+
+from MetadataEngine import MetadataEngine
+from Downloader import DownloadManager
+from Panorama import Panorama, HEADINGS
+from PointStore import PointWriter
+from Metrics import metrics
+import threading
+import queue
+import os
+
+DONE = object() # marks the end of the panorama stream
+
+
+class Pipeline():
+    """
+    A class running point resolution, CSV output and image download concurrently.
+
+    Attribute region: Region object with streets already populated.
+
+    Attribute engine: MetadataEngine resolving points.
+
+    Attribute manager: DownloadManager fetching images.
+
+    Attribute panoramas: bounded queue between CSV writer and downloader.
+
+    Attribute tolerance: distance in meters for panoramas to count as the same.
+
+    Attribute sampling: "fixed" or "adaptive" street sampling, see Region.unique_points.
+
+    Attribute manifest: optional Manifest of the region.
+
+    Attribute formats: point files written, "npy" for PointStore and "csv".
+    """
+
+    def __init__(self,region,engine=None,manager=None,queue_size=256,tolerance=0.5,sampling="fixed",
+                 manifest=None,formats=("npy","csv")):
+        """
+        Initialize pipeline for a region.
+
+        Parameter region: Region object, populate_routes must have been called
+        Parameter engine: MetadataEngine, a default one is created if None
+        Parameter manager: DownloadManager, a default one is created if None
+        Parameter queue_size: maximum panoramas waiting for download
+        Parameter tolerance: distance in meters for panoramas to count as the same
+        Parameter sampling: "fixed" or "adaptive"
+        Parameter manifest: Manifest of the region, also used as the engine's cache
+        when a default engine is created
+        Parameter formats: point files to write
+        """
+        self.region = region
+        self.engine = engine if engine is not None else MetadataEngine(cache=manifest)
+        self.manager = manager if manager is not None else DownloadManager()
+        self.panoramas = queue.Queue(maxsize=queue_size)
+        self.tolerance = tolerance
+        self.sampling = sampling
+        self.manifest = manifest
+        self.formats = formats
+        self.download_stats = None
+        self.error = None
+
+    def _stream(self):
+        """
+        Generate panoramas from the queue until the end marker arrives.
+        """
+        while True:
+            p = self.panoramas.get()
+            if p is DONE:
+                return
+            yield p
+
+    def _download(self):
+        """
+        Download thread body. Keeps draining the queue after an error so the
+        writer never blocks on a full queue.
+        """
+        try:
+            done = self.manifest.downloaded if self.manifest is not None else None
+            self.download_stats = self.manager.run(self._stream(),done)
+        except Exception as e:
+            self.error = e
+            for p in self._stream():
+                pass
+
+    @metrics.timed("pipeline")
+    def run(self):
+        """
+        Resolve all points of the region, append unique ones to the point files
+        as they arrive and download their images. Returns the number of points
+        written and the download statistics.
+        """
+        self.manager.cleanup(self.region.region_name) # leftovers from an interrupted run
+        downloader = threading.Thread(target=self._download,daemon=True)
+        downloader.start()
+        if self.manifest is not None:
+            self.manifest.set_stage("points","running")
+        written = 0
+        name = self.region.region_name
+        store = PointWriter(name) if "npy" in self.formats else None
+        csv = open("../data/"+name+"-points.csv","w") if "csv" in self.formats else None
+        try:
+            for pt in self.region.unique_points(self.engine,self.tolerance,self.sampling,self.manifest):
+                if csv is not None:
+                    print(pt.strForm(),file=csv)
+                    csv.flush() # row is on disk before its images are requested
+                if store is not None:
+                    store.add(pt)
+                written += 1
+                if pt.panoramaID == 0:
+                    continue # no panorama at point, nothing to download
+                p = Panorama(pt.region,pt.panoramaID,pt.panorama_date,pt.panorama_lat,pt.panorama_lng,pt.direction)
+                if self.manifest is not None:
+                    change = self.manifest.needs_download(p.ID,p.date)
+                    if change is None:
+                        continue # images up to date
+                    if change == "newer": # stale images under the same ID
+                        for heading in HEADINGS:
+                            if os.path.exists(p.image_path(heading,self.manager.root)):
+                                os.remove(p.image_path(heading,self.manager.root))
+                self.panoramas.put(p)
+        finally:
+            if csv is not None:
+                csv.close()
+            self.panoramas.put(DONE)
+            downloader.join()
+        if store is not None:
+            store.close() # only a complete store replaces the previous one
+        if self.error is not None:
+            raise self.error
+        if self.manifest is not None:
+            self.manifest.set_stage("points","done")
+            self.manifest.set_stage("download","done")
+        return {'points':written,'sampling':self.region.sampling_stats,'downloads':self.download_stats}
@@ -6,12 +6,58 @@ The direction attribute of a point object ensures that when metadata is collecte
 for a panorama, it is when you are looking precisely to your left or right at a 90
 degree angle from your direction. Direction attribute will offset if street is at
 an angle for a point.
+
+Point objects are slotted records. For a whole region the points are held in a
+PointTable instead, one NumPy column per attribute, and a Point is only made
+when a single row is needed.
 """
 import urllib, os, json
 import urllib.request
+import urllib.parse
 import time
+import numpy as np
+from Helper import backoff
+from Metrics import metrics
+from PointStore import POINT_DTYPE, NO_PANORAMA
 
 key = "&key=" + "XXXX"
+BASE = r"https://maps.googleapis.com/maps/api/streetview"
+
+def query_metadata(url,timeout=10,retries=5,retry_delay=1.0,before=None):
+    """
+    Call the StreetView metadata API and return the decoded response, None if
+    every attempt failed.
+
+    Connection errors are retried with exponential backoff and jitter, at most
+    retries times. Requests are counted by status (OK, ZERO_RESULTS, IOError,
+    ...) and their latency is recorded in the shared metrics.
+
+    Parameter url: metadata link, see Point.metadata_url
+    Parameter timeout: seconds before a request is abandoned
+    Parameter retries: retries after the first attempt
+    Parameter retry_delay: wait before the first retry in seconds
+    Parameter before: optional function called before every attempt, e.g. a rate limiter
+    """
+    for attempt in range(retries+1):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        try: # request StreetView API for metadata
+            response = urllib.request.urlopen(url,timeout=timeout) # API call
+            json_data = json.loads(response.read().decode('utf-8'))
+        except (IOError,ValueError): # possible connection error or cut off response
+            metrics.count("metadata_requests_total",status="IOError")
+            if attempt < retries:
+                metrics.count("metadata_retries_total")
+                time.sleep(backoff(attempt,retry_delay))
+            continue
+        metrics.observe("metadata_latency_seconds",time.perf_counter()-start)
+        metrics.count("metadata_requests_total",status=json_data.get('status','UNKNOWN'))
+        return json_data
+    location = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('location',["?"])[0]
+    print("ERROR metadata request failed at",location) # the url carries the API key
+    metrics.count("metadata_failed_total")
+    return None
 
 class Point():
     """
@@ -35,6 +81,9 @@ class Point():
     for this point location.
     """
 
+    __slots__ = ('ID','region','streetID','lat','lng','direction',
+                 'panoramaID','panorama_date','panorama_lat','panorama_lng') # no per object dict
+
     def __init__(self,ID,region,streetID,lat,lng,direction):
         """
         Initialize Street object with information coming from point's street.
@@ -54,7 +103,6 @@ class Point():
         self.panorama_date = 0
         self.panorama_lat = 0
         self.panorama_lng = 0
-        self.populatePanoramaInfo()
 
     def strForm(self):
         """
@@ -64,30 +112,147 @@ class Point():
         ","+str(self.direction)+","+str(self.panoramaID)+","+str(self.panorama_date)+ \
         ","+str(self.panorama_lat)+","+str(self.panorama_lng)
 
-    def populatePanoramaInfo(self):
+    def metadata_url(self,base=BASE):
         """
-        Call StreetView API for point given direction and API key.
+        Return the StreetView metadata API link for point given direction and API key.
 
-        The API is called to extract the metadata for a panorama stored for this
-        point location. Panorama ID, date, lat,lng values are stored.
+        Parameter base: StreetView API root, overridable to point at a local server
         """
-        base = r"https://maps.googleapis.com/maps/api/streetview"
         size = r"?size=1200x800&fov=80&location="
         end = str(self.lat) + "," + str(self.lng) + "&heading=" + str(self.direction) + key
-        while True:
-            try: # request StreetView API for metadata
-                response = urllib.request.urlopen(base + r"/metadata" + size + end) # API call
-                json_raw = response.read().decode('utf-8')
-                json_data = json.loads(json_raw)
-                if json_data['status'] != 'ZERO_RESULTS' and 'date' in json_data:
-                    #print(json_data['pano_id'])
-                    lcn = json_data['location']
-                    self.panoramaID = json_data['pano_id']
-                    self.panorama_date = json_data['date'] # important for project
-                    self.panorama_lat = lcn['lat']
-                    self.panorama_lng = lcn['lng']
-                break
-            except IOError: # possible connection error, retry in 5 seconds
-                print("ERROR")
-                time.sleep(5)
-                continue
+        return base + r"/metadata" + size + end
+
+    def setPanoramaInfo(self,json_data):
+        """
+        Store panorama ID, date, lat,lng values from a decoded metadata response.
+
+        Responses with ZERO_RESULTS or without a date leave the defaults in place.
+
+        Parameter json_data: dictionary decoded from the metadata API response
+        """
+        if json_data['status'] != 'ZERO_RESULTS' and 'date' in json_data:
+            lcn = json_data['location']
+            self.panoramaID = json_data['pano_id']
+            self.panorama_date = json_data['date'] # important for project
+            self.panorama_lat = lcn['lat']
+            self.panorama_lng = lcn['lng']
+
+    def populatePanoramaInfo(self,base=BASE,cache=None):
+        """
+        Call StreetView API for point given direction and API key.
+
+        The API is called to extract the metadata for a panorama stored for this
+        point location. Panorama ID, date, lat,lng values are stored. This is the
+        blocking single point path, Region resolves points in batch through
+        MetadataEngine instead.
+
+        Parameter base: StreetView API root
+        Parameter cache: optional MetadataCache consulted before calling the API
+        """
+        if cache is not None:
+            json_data = cache.get(self.lat,self.lng,self.direction)
+            if json_data is not None:
+                self.setPanoramaInfo(json_data)
+                return
+        json_data = query_metadata(self.metadata_url(base))
+        if json_data is None:
+            return # gave up, point keeps no panorama and is queried again next run
+        if cache is not None:
+            cache.put(self.lat,self.lng,self.direction,json_data)
+        self.setPanoramaInfo(json_data)
+
+
+class PointTable():
+    """
+    A class holding many points as one structured NumPy array, with the same
+    columns as PointStore. A row takes 72 bytes, half of a slotted Point with
+    its float values and a fraction of an object with a __dict__.
+
+    Attribute region: name of the region the points belong to.
+
+    Attribute rows: structured array of POINT_DTYPE, only the first len(self)
+    rows are in use.
+
+    Attribute panoramas: panorama IDs, the pano column holds the index.
+    """
+
+    def __init__(self,region,capacity=1024):
+        """
+        Initialize an empty table.
+
+        Parameter region: region name
+        Parameter capacity: rows allocated up front, grown by doubling
+        """
+        self.region = region
+        self.rows = np.zeros(capacity,dtype=POINT_DTYPE)
+        self.rows['pano'] = NO_PANORAMA
+        self.rows['date'] = np.datetime64('NaT','M')
+        self.count = 0
+        self.panoramas = []
+        self.codes = {}
+
+    @staticmethod
+    def from_streets(region,streets):
+        """
+        Returns the unresolved sample points of streets as a table, in street order.
+
+        Parameter region: region name
+        Parameter streets: list of Street objects with points filled
+        """
+        lengths = np.array([len(i.points) for i in streets],dtype=np.int64)
+        table = PointTable(region,max(1,int(lengths.sum())))
+        if lengths.sum():
+            coords = np.concatenate([np.asarray(i.points,dtype=np.float64).reshape(-1,2) for i in streets])
+            rows = table.rows
+            rows['id'] = -1
+            rows['street'] = np.repeat([i.ID for i in streets],lengths)
+            rows['direction'] = np.repeat([i.direction for i in streets],lengths)
+            rows['lat'] = coords[:,0]
+            rows['lng'] = coords[:,1]
+            table.count = len(coords)
+        return table
+
+    def __len__(self):
+        return self.count
+
+    def append(self,point):
+        """
+        Add a resolved point as a new row.
+
+        Parameter point: Point object
+        """
+        if self.count == len(self.rows):
+            grown = np.zeros(2*len(self.rows),dtype=POINT_DTYPE)
+            grown[:self.count] = self.rows
+            self.rows = grown
+        found = point.panoramaID != 0
+        if found and point.panoramaID not in self.codes:
+            self.codes[point.panoramaID] = len(self.panoramas)
+            self.panoramas.append(point.panoramaID)
+        self.rows[self.count] = (point.ID if point.ID is not None else -1,0,point.streetID,point.lat,point.lng,
+                                 point.direction,self.codes[point.panoramaID] if found else NO_PANORAMA,
+                                 np.datetime64(str(point.panorama_date),'M') if found else np.datetime64('NaT','M'),
+                                 point.panorama_lat,point.panorama_lng)
+        self.count += 1
+
+    def __getitem__(self,i):
+        """
+        Returns row i as a Point.
+
+        Parameter i: row index
+        """
+        if not -self.count <= i < self.count:
+            raise IndexError("point index out of range")
+        r = self.rows[i % self.count]
+        pt = Point(None if r['id'] < 0 else int(r['id']),self.region,int(r['street']),float(r['lat']),
+                   float(r['lng']),float(r['direction']))
+        if r['pano'] != NO_PANORAMA:
+            pt.panoramaID = self.panoramas[r['pano']]
+            pt.panorama_date = str(r['date'])
+            pt.panorama_lat = float(r['pano_lat'])
+            pt.panorama_lng = float(r['pano_lng'])
+        return pt
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
@@ -0,0 +1,288 @@
+"""
+Module defines a typed, columnar store for the points of a region, next to the
+points CSV file.
+
+Points are kept in a NumPy structured array saved as ../data/<region>-points.npy
+with float64 coordinates, integer street IDs and month precision dates. Region
+names and panorama IDs are categorical: the array holds integer codes and the
+strings live once in the ../data/<region>-points.json sidecar, together with the
+row count and the bounding box of the file.
+
+PointWriter appends points in batches of rows and only renames the finished
+file into place, so a reader never sees a partial store. PointStore opens the
+array memory-mapped, which costs the same few milliseconds for any file size,
+and the columns are read straight from the page cache without parsing. to_csv
+exports the same rows the CSV writer produces for tools that need the old file.
+"""
+
+import numpy as np
+import struct
+import json
+import os
+
+POINT_DTYPE = np.dtype([('id','<i8'),('region','<i4'),('street','<i8'),('lat','<f8'),('lng','<f8'),
+                        ('direction','<f8'),('pano','<i4'),('date','<M8[M]'),
+                        ('pano_lat','<f8'),('pano_lng','<f8')])
+HEADER_SIZE = 512 # bytes, fixed so the row count can be filled in after writing
+NO_PANORAMA = -1 # pano code of points without a panorama
+
+def _header(count):
+    """
+    Returns a version 1.0 .npy header of HEADER_SIZE bytes for count rows.
+
+    Parameter count: number of rows
+    """
+    text = repr({'descr':np.lib.format.dtype_to_descr(POINT_DTYPE),'fortran_order':False,'shape':(count,)})
+    text = text.ljust(HEADER_SIZE-11) + "\n" # magic, version and length take 10 bytes
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H",len(text)) + text.encode('latin1')
+
+def store_path(region,root="../data"):
+    """
+    Returns the array file of a region, the sidecar has the same name with .json.
+
+    Parameter region: region name
+    Parameter root: data folder
+    """
+    return root+"/"+region+"-points.npy"
+
+
+class PointWriter():
+    """
+    A class writing points to a region's columnar store in batches.
+
+    Attribute path: array file being written.
+
+    Attribute batch: rows buffered before they are written.
+
+    Attribute regions,panoramas: category lists, a row holds the index.
+
+    Attribute count: rows written so far.
+    """
+
+    def __init__(self,region,root="../data",batch=4096):
+        """
+        Start a new store for a region, replacing the old one when closed.
+
+        Parameter region: region name
+        Parameter root: data folder
+        Parameter batch: rows per write
+        """
+        self.path = store_path(region,root)
+        self.batch = batch
+        self.buffer = np.zeros(batch,dtype=POINT_DTYPE)
+        self.filled = 0
+        self.count = 0
+        self.regions = []
+        self.panoramas = []
+        self.codes = {} # category string to code, regions and panoramas kept apart by key
+        self.bbox = [np.inf,np.inf,-np.inf,-np.inf]
+        self.file = open(self.path+".part","wb")
+        self.file.write(_header(0))
+
+    def _code(self,kind,values,value):
+        code = self.codes.get((kind,value))
+        if code is None:
+            code = self.codes[(kind,value)] = len(values)
+            values.append(value)
+        return code
+
+    def add_row(self,region,streetID,lat,lng,direction,panoID,date,pano_lat,pano_lng,ID=-1):
+        """
+        Append one point given its CSV columns.
+
+        Parameter region: region name
+        Parameter streetID: UID of the point's street
+        Parameters lat,lng: coordinates of the point
+        Parameter direction: street direction in degrees
+        Parameter panoID: panorama ID, 0 if the point has none
+        Parameter date: panorama date YYYY-MM, 0 if the point has none
+        Parameters pano_lat,pano_lng: coordinates of the panorama
+        Parameter ID: point UID
+        """
+        found = str(panoID) != "0"
+        self.buffer[self.filled] = (ID,self._code('region',self.regions,str(region)),streetID,lat,lng,direction,
+                                    self._code('pano',self.panoramas,str(panoID)) if found else NO_PANORAMA,
+                                    np.datetime64(str(date),'M') if found else np.datetime64('NaT','M'),
+                                    pano_lat,pano_lng)
+        self.filled += 1
+        if self.filled == self.batch:
+            self.flush()
+
+    def add(self,point):
+        """
+        Append a resolved Point.
+
+        Parameter point: Point object
+        """
+        self.add_row(point.region,point.streetID,point.lat,point.lng,point.direction,point.panoramaID,
+                     point.panorama_date,point.panorama_lat,point.panorama_lng,
+                     point.ID if point.ID is not None else -1)
+
+    def add_table(self,table):
+        """
+        Append every row of a Point.PointTable in one write.
+
+        Parameter table: PointTable of the region
+        """
+        self.flush()
+        if not len(table):
+            return
+        rows = table.rows[:len(table)].copy()
+        rows['region'] = self._code('region',self.regions,str(table.region))
+        # table codes to store codes, NO_PANORAMA (-1) picks the last entry
+        remap = np.array([self._code('pano',self.panoramas,p) for p in table.panoramas]+[NO_PANORAMA],dtype='<i4')
+        rows['pano'] = remap[rows['pano']]
+        self._write(rows)
+
+    def flush(self):
+        """
+        Write buffered rows.
+        """
+        if not self.filled:
+            return
+        self._write(self.buffer[:self.filled])
+        self.filled = 0
+
+    def _write(self,rows):
+        """
+        Write rows to the file and extend the bounding box.
+
+        Parameter rows: structured array of POINT_DTYPE
+        """
+        self.bbox = [min(self.bbox[0],float(rows['lat'].min())),min(self.bbox[1],float(rows['lng'].min())),
+                     max(self.bbox[2],float(rows['lat'].max())),max(self.bbox[3],float(rows['lng'].max()))]
+        self.file.write(rows.tobytes())
+        self.count += len(rows)
+
+    def close(self):
+        """
+        Write the final header and sidecar and move both into place.
+        """
+        self.flush()
+        self.file.seek(0)
+        self.file.write(_header(self.count))
+        self.file.close()
+        meta = {'count':self.count,'regions':self.regions,'panoramas':self.panoramas,
+                'bbox':self.bbox if self.count else None}
+        sidecar = self.path[:-4]+".json"
+        with open(sidecar+".part","w") as f:
+            json.dump(meta,f)
+        os.replace(self.path+".part",self.path)
+        os.replace(sidecar+".part",sidecar)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+
+class PointStore():
+    """
+    A class reading a region's columnar store.
+
+    Attribute points: memory-mapped structured array, one row per point.
+
+    Attribute regions,panoramas: category lists the region and pano codes index.
+
+    Attribute bbox: [south, west, north, east] of the points, None if empty.
+    """
+
+    def __init__(self,region,root="../data"):
+        """
+        Open a region's store.
+
+        Parameter region: region name
+        Parameter root: data folder
+        """
+        path = store_path(region,root)
+        with open(path[:-4]+".json") as f:
+            meta = json.load(f)
+        self.region = region
+        self.points = np.load(path,mmap_mode='r') if meta['count'] else np.zeros(0,dtype=POINT_DTYPE)
+        self.regions = meta['regions']
+        self.panoramas = meta['panoramas']
+        self.bbox = meta['bbox']
+
+    def __len__(self):
+        return len(self.points)
+
+    def pano_id(self,code):
+        """
+        Returns the panorama ID of a pano code, 0 for NO_PANORAMA like the CSV.
+
+        Parameter code: pano column value
+        """
+        return self.panoramas[code] if code != NO_PANORAMA else 0
+
+    def panorama_records(self):
+        """
+        Returns the rows that have a panorama.
+        """
+        return self.points[self.points['pano'] != NO_PANORAMA]
+
+    def within(self,south,west,north,east):
+        """
+        Returns the rows inside a bounding box.
+
+        Parameters south,west,north,east: bounding box in degrees
+        """
+        if self.bbox is None or self.bbox[0] > north or self.bbox[2] < south \
+           or self.bbox[1] > east or self.bbox[3] < west:
+            return self.points[:0] # whole file outside, columns never touched
+        lat, lng = self.points['lat'], self.points['lng']
+        return self.points[(lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)]
+
+    def rows(self):
+        """
+        Generate each point as the list of its CSV columns.
+        """
+        for r in self.points:
+            found = r['pano'] != NO_PANORAMA
+            yield [self.regions[r['region']],int(r['street']),float(r['lat']),float(r['lng']),float(r['direction']),
+                   self.pano_id(r['pano']),str(r['date']) if found else 0,
+                   float(r['pano_lat']) if found else 0,float(r['pano_lng']) if found else 0]
+
+    def to_csv(self,path=None):
+        """
+        Write the points CSV, in the format of Point.strForm. Returns the path.
+
+        Parameter path: output file, ../data/<region>-points.csv by default
+        """
+        path = path or "../data/"+self.region+"-points.csv"
+        with open(path,"w") as f:
+            for row in self.rows():
+                print(",".join(str(c) for c in row),file=f)
+        return path
+
+    @staticmethod
+    def from_csv(region,root="../data"):
+        """
+        Build a region's store from its points CSV and return it opened.
+
+        Parameter region: region name
+        Parameter root: data folder
+        """
+        with open(root+"/"+region+"-points.csv") as f, PointWriter(region,root) as writer:
+            for line in f:
+                row = line.rstrip("\n").split(",")
+                writer.add_row(row[0],int(row[1]),float(row[2]),float(row[3]),float(row[4]),row[5],row[6],
+                               float(row[7]),float(row[8]))
+        return PointStore(region,root)
+
+
+def load_dataset(regions,root="../data"):
+    """
+    Open the stores of many regions, building any that only have a CSV.
+    Returns a dictionary of region name to PointStore.
+
+    Parameter regions: list of region names
+    Parameter root: data folder
+    """
+    stores = {}
+    for region in regions:
+        if os.path.exists(store_path(region,root)):
+            stores[region] = PointStore(region,root)
+        else:
+            stores[region] = PointStore.from_csv(region,root)
+    return stores
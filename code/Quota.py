@@ -0,0 +1,184 @@
+"""
+Module plans and enforces the StreetView API cost of a crawl.
+
+The cost of a region is known before any call is made. Every 15 meter point of
+every street is one metadata call unless the manifest or cache already has its
+answer, and every unique panorama takes two image calls, one per side of the
+street. plan_region counts both from the region's streets and the cache state
+without touching the network.
+
+QuotaGuard enforces daily call limits and a combined QPS for each API across
+every thread and process of a crawl. The counters live in a small SQLite file
+that all workers share. When a daily limit is reached, callers sleep until the
+quota window resets and then carry on, so a long crawl pauses overnight instead
+of failing on throttled requests.
+"""
+
+from Metrics import metrics
+import sqlite3
+import threading
+import time
+
+DAY = 86400 # seconds
+
+def plan_region(region,store=None):
+    """
+    Returns the expected metadata and image calls of crawling a region.
+
+    Points that store can already answer cost no metadata call. Panoramas seen
+    in store are counted exactly, and for the remaining points the number of
+    new panoramas is estimated from the share of known points that had one.
+    Without any known points every remaining point is assumed to find a new
+    panorama, which is the upper bound. Adaptive sampling makes fewer metadata
+    calls than planned here.
+
+    Parameter region: Region with streets, or segments to build them from
+    Parameter store: Manifest or MetadataCache to check, anything with peek
+    """
+    if not region.streets and region.segments:
+        region.populate_routes()
+    points = 0
+    unknown = 0
+    known = 0
+    found = 0
+    panoramas = set()
+    for i in region.streets:
+        for j in i.points:
+            points += 1
+            row = store.peek(float(j[0]),float(j[1]),i.direction) if store is not None else None
+            if row is None:
+                unknown += 1
+                continue
+            known += 1
+            if row[0] == 'OK':
+                found += 1
+                panoramas.add(row[1])
+    ratio = float(len(panoramas))/known if known else 1.0
+    estimated = int(round(unknown*ratio))
+    downloaded = 0
+    if hasattr(store,'needs_download'):
+        # an empty date is never newer, so only panoramas never downloaded count
+        downloaded = sum(1 for p in panoramas if store.needs_download(p,"") is None)
+    images = 2*(len(panoramas)-downloaded+estimated)
+    return {'region':region.region_name,'streets':len(region.streets),'points':points,
+            'metadata_cached':known,'metadata_calls':unknown,'panoramas_known':len(panoramas),
+            'panoramas_downloaded':downloaded,'panoramas_estimated':estimated,
+            'image_calls':images,'image_calls_max':2*(found+unknown)}
+
+
+class QuotaGuard():
+    """
+    A class sharing API call limits between every worker of a crawl.
+
+    Attribute path: SQLite file shared by all processes.
+
+    Attribute limits: dictionary of API name to calls allowed per quota window,
+    e.g. {'metadata':25000,'image':25000}. APIs not listed are unlimited.
+
+    Attribute qps: dictionary of API name to calls per second across all
+    workers. APIs not listed are not paced.
+
+    Attribute reset_hour: UTC hour at which the daily window starts. Google
+    quotas reset at midnight Pacific time, 8 UTC.
+    """
+
+    def __init__(self,path="../data/quota.sqlite",limits=None,qps=None,reset_hour=8):
+        """
+        Open or create the shared counters.
+
+        Parameter path: SQLite file location
+        Parameter limits: daily call limit per API
+        Parameter qps: calls per second per API
+        Parameter reset_hour: UTC hour the quota window resets
+        """
+        self.path = path
+        self.limits = dict(limits or {})
+        self.qps = dict(qps or {})
+        self.reset_hour = reset_hour
+        self.lock = threading.Lock()
+        # autocommit mode, transactions are opened by hand with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path,timeout=60,check_same_thread=False,isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS usage (api TEXT, window INTEGER, calls INTEGER,
+            PRIMARY KEY (api,window))""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pacing (api TEXT PRIMARY KEY, next REAL)")
+
+    def window(self,now=None):
+        """
+        Returns the index of the quota window containing a time and when it ends.
+
+        Parameter now: epoch seconds, the current time by default
+        """
+        now = time.time() if now is None else now
+        offset = self.reset_hour*3600
+        index = int((now-offset)//DAY)
+        return index, (index+1)*DAY+offset
+
+    def _reserve(self,api):
+        """
+        Take one call from the current window and a pacing slot in one
+        transaction. Returns (seconds to wait, paused) where paused means the
+        limit is reached and nothing was taken.
+
+        Parameter api: API name
+        """
+        now = time.time()
+        index, end = self.window(now)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE") # one writer at a time across processes
+            try:
+                row = self.db.execute("SELECT calls FROM usage WHERE api=? AND window=?",(api,index)).fetchone()
+                calls = row[0] if row else 0
+                limit = self.limits.get(api)
+                if limit is not None and calls >= limit:
+                    self.db.execute("COMMIT")
+                    return end-now, True
+                slot = now
+                if self.qps.get(api):
+                    row = self.db.execute("SELECT next FROM pacing WHERE api=?",(api,)).fetchone()
+                    slot = max(now,row[0]) if row else now
+                    self.db.execute("INSERT OR REPLACE INTO pacing VALUES (?,?)",(api,slot+1.0/self.qps[api]))
+                self.db.execute("INSERT OR REPLACE INTO usage VALUES (?,?,?)",(api,index,calls+1))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return slot-now, False
+
+    def acquire(self,api):
+        """
+        Block until a call of api is allowed, then count it.
+
+        Parameter api: API name, "metadata" or "image"
+        """
+        while True:
+            wait, paused = self._reserve(api)
+            if not paused:
+                break
+            metrics.count("quota_pauses_total",api=api)
+            print("daily",api,"quota reached, pausing until",time.strftime("%Y-%m-%d %H:%M UTC",
+                  time.gmtime(time.time()+wait)))
+            metrics.count("quota_wait_seconds_total",wait,api=api)
+            time.sleep(wait+1) # past the reset, the next window has a fresh count
+        if wait > 0:
+            metrics.count("quota_wait_seconds_total",wait,api=api)
+            time.sleep(wait)
+
+    def usage(self):
+        """
+        Returns calls made and remaining for every API in the current window.
+        """
+        index, end = self.window()
+        with self.lock:
+            rows = self.db.execute("SELECT api,calls FROM usage WHERE window=?",(index,)).fetchall()
+        used = dict(rows)
+        result = {}
+        for api in set(used) | set(self.limits):
+            limit = self.limits.get(api)
+            result[api] = {'calls':used.get(api,0),
+                           'remaining':None if limit is None else max(0,limit-used.get(api,0))}
+        return {'resets':end,'apis':result}
+
+    def close(self):
+        self.db.close()
@@ -13,9 +13,52 @@ of a street as you walk down it in a straight line.
 
 from Helper import *
 from Street import *
+from MetadataEngine import MetadataEngine
+from SpatialIndex import SpatialIndex
+from SegmentGraph import SegmentGraph
+from PointStore import PointWriter
+from Metrics import metrics
 import re
 import time
 import ast
+import json
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+MAPS_BASE = "https://www.google.com/maps/dir/"
+ROUTE_PATTERN = re.compile(r'\[null,null,-?\d+\.?\d+,-?\d+\.?\d+]') # [null,null,33.453,-121.23522]
+
+def wait_for(driver,timeout,condition):
+    """
+    Wait until condition(driver) is true. Uses WebDriverWait when selenium is
+    installed and polls otherwise, for page loaders such as Benchmark.HTTPDriver.
+    Raises TimeoutException, or TimeoutError without selenium, after timeout seconds.
+
+    Parameter driver: Selenium driver or an object with get and page_source
+    Parameter timeout: seconds to wait
+    Parameter condition: function of the driver
+    """
+    try:
+        from selenium.webdriver.support.ui import WebDriverWait
+    except ImportError:
+        deadline = time.monotonic()+timeout
+        while not condition(driver):
+            if time.monotonic() > deadline:
+                raise TimeoutError("page condition not met in "+str(timeout)+" seconds")
+            time.sleep(0.1)
+        return
+    WebDriverWait(driver,timeout).until(condition)
+
+def artifact_path(region,stage,root="../data"):
+    """
+    Returns the file a stage's output is kept in, e.g. ../data/<region>-routes.json.
+
+    Parameter region: region name
+    Parameter stage: "routes" or "segments"
+    Parameter root: data folder
+    """
+    return root+"/"+region+"-"+stage+".json"
 
 class Region():
     """
@@ -44,6 +87,9 @@ class Region():
 
 
     Attribute streets: List of all points that are 15 meters apart in all routes.
+
+    Attribute sampling_stats: metadata calls made against the fixed 15 meter grid
+    by the last unique_points run.
     """
 
     def __init__(self,name,lat,lng):
@@ -60,44 +106,114 @@ class Region():
         self.intersections = []
         self.segments = []
         self.streets = []
+        self.sampling_stats = {}
 
-    def level_routes(self):
+    @metrics.timed("level_routes")
+    def level_routes(self,radii=(0.25,),count=4,step=4):
         """
         Generate destination coordinates that are some radius away from center.
 
         For each distance value, generate 90 destinations around the center and
         append to destinations list. Destinations are generated in complete circle
         using 360/90 = 4 as the multiplier for each range value.
+
+        Parameter radii: distances in miles, 0.25,0.5,0.75,1.0 for a full region
+        Parameter count: destinations per distance, 90 for a complete circle
+        Parameter step: degrees between destinations
         """
-        radii = [0.25]#,0.5,0.75,1.0] # distance in miles
         for r in radii:
-            for i in range(0,4): # generate 90 destinations
-                self.destinations.append(radial_distance(self.center[0],self.center[1],i*4,r))
+            for i in range(0,count): # generate 90 destinations
+                self.destinations.append(radial_distance(self.center[0],self.center[1],i*step,r))
+
+    def route_url(self,destination,base=MAPS_BASE):
+        """
+        Returns the Google Maps directions link from center to a destination.
+
+        Parameter destination: (lat,lng) tuple
+        Parameter base: Maps directions root, overridable to point at a local server
+        """
+        placeholder = base+str(self.center[0])+","+str(self.center[1])+"/"
+        return placeholder+str(destination[0])+","+str(destination[1])+"/data=!3m1!4b1!4m2!4m1!3e0"
+
+    def fetch_route(self,driver,destination,timeout=20,base=MAPS_BASE):
+        """
+        Load the route from center to destination and return the potential
+        intersections found in the page.
+
+        Instead of sleeping for a fixed time, wait until the route coordinates show
+        up in the HTML, which can be well under a second on a fast connection.
+        Raises TimeoutException if nothing shows up within timeout seconds, see wait_for.
+
+        Parameter driver: Selenium Chrome driver
+        Parameter destination: (lat,lng) tuple
+        Parameter timeout: seconds to wait for the coordinates
+        Parameter base: Maps directions root
+        """
+        driver.get(self.route_url(destination,base)) # selenium web driver
+        wait_for(driver,timeout,lambda d: ROUTE_PATTERN.search(d.page_source))
+        source = driver.page_source # get HTML
+        matches = ROUTE_PATTERN.findall(source) # look for pattern
+        return [m.replace("null,null,","") for m in matches] # remove the null part from the matched value
 
-    def get_routes(self,driver):
+    @metrics.timed("get_routes")
+    def get_routes(self,driver,timeout=20,base=MAPS_BASE,cache=None,destinations=None):
         """
         Functions uses Selenium webdriver to access Google Maps link to extract
         the route between acenter and a destination.
 
         The link using center and destination coordinates is first constructed
-        and loaded. After 3 seconds (time for page to load on slow speed internet)
-        extract the HTML and look for the pattern that matches coordinates like
-        [null,null,33.453,-121.23522]. These are potential intersections in the route
+        and loaded. Once the HTML contains coordinates like [null,null,33.453,-121.23522]
+        all of them are extracted. These are potential intersections in the route
         between center and destination.
 
-        Parameters driver: Selenium Chrome driver
+        A BrowserPool can be passed instead of a single driver, then destinations
+        are loaded in parallel with the pool's timeout and retries. Routes that
+        fail every attempt are stored as empty lists. Intersections are always in
+        destination order. Routes found in cache are not loaded again.
+
+        Parameters driver: Selenium Chrome driver or BrowserPool
+        Parameter timeout: seconds to wait per route for a single driver
+        Parameter base: Maps directions root
+        Parameter cache: RouteCache shared between runs and processes, or None
+        Parameter destinations: only load these, all destinations by default
+        """
+        destinations = self.destinations if destinations is None else destinations
+        found = {}
+        if cache is not None:
+            for i in destinations:
+                routes = cache.get(self.center,i)
+                if routes is not None:
+                    found[i] = routes
+        missing = [i for i in destinations if i not in found]
+        if getattr(driver,'map',None) is not None: # a BrowserPool, known without importing selenium
+            fetch = lambda d,destination,t: self.fetch_route(d,destination,t,base)
+            fetched = driver.map(fetch,missing,default=[])
+        else:
+            fetched = [self.fetch_route(driver,i,timeout,base) for i in missing]
+        for i,routes in zip(missing,fetched):
+            found[i] = routes
+            if cache is not None:
+                cache.put(self.center,i,routes)
+        for i in destinations:
+            self.intersections.append(found[i])
+
+    @metrics.timed("get_routes")
+    def get_routes_osm(self,graph,bend=20):
+        """
+        Generate route segments from a local OpenStreetMap road graph instead of
+        Google Maps.
+
+        The shortest path from center to each destination is computed offline
+        and its corners are stored directly in segments, in the same structure
+        get_segments produces, so get_segments must not be called afterwards.
+
+        Parameter graph: OSMRouter.RoadGraph loaded from an extract
+        Parameter bend: smallest change of direction in degrees kept as a corner
         """
         for i in self.destinations:
-            placeholder = "https://www.google.com/maps/dir/"+str(self.center[0])+","+str(self.center[1])+"/"
-            site = placeholder+str(i[0])+","+str(i[1])+"/data=!3m1!4b1!4m2!4m1!3e0"
-            driver.get(site) # selenium web driver
-            time.sleep(3) # allow time for website to load completely
-            source = driver.page_source # get HTML
-            matches = (re.findall('\[null,null,-?\d+\.?\d+,-?\d+\.?\d+]',source)) # look for pattern
-            for i in range(len(matches)): # remove the null part from the matched value
-                matches[i]=matches[i].replace("null,null,","")
-            self.intersections.append(matches)
+            self.segments.append(graph.route_segments(self.center,i,bend))
 
+    @metrics.timed("get_segments")
     def get_segments(self):
         """
         Generate a list of intersection segments from the intersections list.
@@ -109,72 +225,226 @@ class Region():
         """
         print(self.intersections)
         for route in self.intersections:
-            doubles = []
-            for i in range(len(route)-1):
-                if route[i] == route[i+1]: # if a duplicate is found, then it is an intersection
-                    pair = ast.literal_eval(route[i]) # string literal to list
-                    doubles.append([round(pair[0],6),round(pair[1],6)]) # round off decimals
-            source = doubles[0] # starting element in doubles is always the origin in the route
-            starting_indices = [] # since the origin can differ a few 100th of a lat/lng value, compare
-                                    # only upto the first 3 decimal points
-            starting_indices = [i for i in range(len(doubles)) if (round(doubles[i][0],3) == round(source[0],3)) and (round(doubles[i][1],3) == round(source[1],3))]
-            starting_indices.append(len(doubles)+1) # this is a list of indices of origins in doubles
-            indices = list(zip(starting_indices,starting_indices[1:])) # stagger indices [1,2,3] --> [(1,2),(2,3)]
-            for i in indices:
-                minilist = doubles[i[0]:i[1]] # grab an intersection
-                l = list(zip(minilist,minilist[1:])) # convert into segment
-                l = [i for i in l if i[0]!=i[1]] # make sure that a segment is not a dud, (lat1,lng1) to (lat1,lng1)
-                self.segments.append(l)
-
-    def populate_routes(self):
+            self.segments.extend(self.route_segments(route))
+
+    def route_segments(self,route):
+        """
+        Returns the intersection segments of a single route, see get_segments.
+
+        Parameter route: list of coordinate strings from get_routes
+        """
+        segments = []
+        doubles = []
+        for i in range(len(route)-1):
+            if route[i] == route[i+1]: # if a duplicate is found, then it is an intersection
+                pair = ast.literal_eval(route[i]) # string literal to list
+                doubles.append([round(pair[0],6),round(pair[1],6)]) # round off decimals
+        if not doubles:
+            return segments # route failed to load or has no corners
+        source = doubles[0] # starting element in doubles is always the origin in the route
+        starting_indices = [] # since the origin can differ a few 100th of a lat/lng value, compare
+                                # only upto the first 3 decimal points
+        starting_indices = [i for i in range(len(doubles)) if (round(doubles[i][0],3) == round(source[0],3)) and (round(doubles[i][1],3) == round(source[1],3))]
+        starting_indices.append(len(doubles)+1) # this is a list of indices of origins in doubles
+        indices = list(zip(starting_indices,starting_indices[1:])) # stagger indices [1,2,3] --> [(1,2),(2,3)]
+        for i in indices:
+            minilist = doubles[i[0]:i[1]] # grab an intersection
+            l = list(zip(minilist,minilist[1:])) # convert into segment
+            l = [i for i in l if i[0]!=i[1]] # make sure that a segment is not a dud, (lat1,lng1) to (lat1,lng1)
+            segments.append(l)
+        return segments
+
+    @metrics.timed("populate_routes")
+    def populate_routes(self,tolerance=1.0):
         """
         Generate all points between intersection segments that are 15 meters apart.
 
         The spatial coordinates are stored in a list with a unique street ID to
         be used later for matching streetwise panoramas. Street objects also store
         the coordinates to the end points of a street for referencing later.
+        Segments of all routes go through a SegmentGraph first, so reversed,
+        repeated and overlapping segments become one Street per stretch of road.
+
+        Parameter tolerance: distance in meters for end points to match
         """
-        streets = []
+        graph = SegmentGraph(tolerance) # routes share road, keep each stretch once
         print(self.segments)
         for segment in self.segments: # store unique coordinate points of intersections
             for point in segment:
-                if point not in streets:
-                    streets.append(point)
+                graph.add(point[0],point[1])
+        graph.merge()
+        streets = graph.segments()
         for i in range(len(streets)): # create street object for each spatial point
             streetID = i
             A = streets[i][0]
             B = streets[i][1]
             self.streets.append(Street(streetID,A,B))
-        for i in self.streets:
-            i.populate_points() # fills street object.points with interpolated points
+        self.interpolate_streets()
 
-    def write_region(self):
+    def load_streets(self,manifest):
         """
-        Write every single point's information to a csv file.
+        Rebuild streets stored in a Manifest by an earlier run, so routing and
+        segment extraction can be skipped when resuming.
 
-        For every spatial coordinate in street's points, a Point object is created
-        which is queried against the Static Maps API to find information about
-        the panorama for that coordinate. All this information is then added to a
-        csv file.
+        Parameter manifest: Manifest of this region
         """
-        points_list = []
-        panoramas_list = []
+        self.streets = [Street(streetID,A,B) for streetID,A,B in manifest.load_streets()]
+        self.interpolate_streets()
+
+    def save_artifact(self,stage,root="../data"):
+        """
+        Store the output of a routing stage so later stages can start from it
+        without a browser. "routes" keeps the destinations and the raw
+        intersections from get_routes, "segments" keeps the segments from
+        get_segments or get_routes_osm. Returns the file written.
+
+        Parameter stage: "routes" or "segments"
+        Parameter root: data folder
+        """
+        data = {'center':list(self.center)}
+        if stage == "routes":
+            data['destinations'] = [list(i) for i in self.destinations]
+            data['intersections'] = self.intersections
+        elif stage == "segments":
+            data['segments'] = self.segments
+        else:
+            raise ValueError("unknown stage: "+str(stage))
+        path = artifact_path(self.region_name,stage,root)
+        with open(path+".part","w") as f:
+            json.dump(data,f)
+        os.replace(path+".part",path) # a reader never sees half a file
+        return path
+
+    @staticmethod
+    def from_artifact(name,stage,root="../data"):
+        """
+        Returns a Region restored from a file written by save_artifact.
+
+        Parameter name: region name
+        Parameter stage: "routes" or "segments"
+        Parameter root: data folder
+        """
+        with open(artifact_path(name,stage,root)) as f:
+            data = json.load(f)
+        region = Region(name,data['center'][0],data['center'][1])
+        region.destinations = [tuple(i) for i in data.get('destinations',[])]
+        region.intersections = data.get('intersections',[])
+        region.segments = data.get('segments',[])
+        return region
+
+    def interpolate_streets(self):
+        """
+        Fill every street's direction and 15 meter points.
+        """
+        if not self.streets:
+            return
+        # direction and interpolated points for all streets in one vectorized pass
+        A = np.array([i.A for i in self.streets],dtype=np.float64)
+        B = np.array([i.B for i in self.streets],dtype=np.float64)
+        directions = direction_batch(A[:,0],A[:,1],B[:,0],B[:,1])
+        points, offsets = interpolate_batch(A,B)
+        for n,i in enumerate(self.streets): # each street gets a view into the shared array
+            i.direction = float(directions[n])
+            i.points = points[offsets[n]:offsets[n+1]]
+
+    def iter_points(self):
+        """
+        Generate a Point for every spatial coordinate in every street's points.
+
+        Points are created lazily and without panorama information, which is
+        filled in later by a MetadataEngine. The coordinates of all of them sit
+        in one PointTable, a Point only exists while it is being resolved.
+        """
+        for pt in PointTable.from_streets(self.region_name,self.streets):
+            yield pt
+
+    def adaptive_points(self,engine):
+        """
+        Generate resolved points by sampling every street adaptively.
+
+        Streets are bisected concurrently, one per engine worker, and their
+        points are yielded in street order.
+
+        Parameter engine: MetadataEngine to use
+        """
+        with ThreadPoolExecutor(max_workers=engine.max_inflight) as pool:
+            for points in pool.map(lambda i: i.sample_adaptive(engine,self.region_name),self.streets):
+                for pt in points:
+                    yield pt
+
+    def unique_points(self,engine,tolerance=0.5,sampling="fixed",manifest=None):
+        """
+        Generate resolved points whose panorama has not been seen before.
+
+        Points are resolved through engine as they are generated, in order, and
+        numbered with pointCounter. Panoramas within tolerance of one already
+        kept are skipped. With adaptive sampling only the points needed to find
+        where the panorama changes along each street are queried. The calls made
+        and saved against the fixed grid are stored in sampling_stats.
+
+        To resume or refresh a crawl, give the engine the region's Manifest as its
+        cache and pass it here as well so finished streets are marked.
+
+        Parameter engine: MetadataEngine to use
+        Parameter tolerance: distance in meters for panoramas to count as the same
+        Parameter sampling: "fixed" queries every 15 meter point, "adaptive" bisects
+        Parameter manifest: Manifest recording street completion, or None
+        """
+        grid = sum(len(i.points) for i in self.streets)
+        if sampling == "adaptive":
+            resolved = self.adaptive_points(engine)
+        elif sampling == "fixed":
+            resolved = engine.imap(self.iter_points()) # results come back in the order submitted
+        else:
+            raise ValueError("unknown sampling mode: "+str(sampling))
+        panoramas = SpatialIndex(tolerance)
         pointCounter = 0 # unique identifier for Point ID
-        for i in self.streets: # for each street, get direction between ends
-            streetID = i.ID
-            A = i.A
-            B = i.B
-            direction = i.direction
-            region = self.region_name
-            for j in i.points: # for each point in street, get panorama information
-                pt = Point(pointCounter,region,streetID,j[0],j[1],direction)
-                if (pt.panorama_lat,pt.panorama_lng) in panoramas_list:
-                    continue # rare but if already have panorama, skip
-                else:
-                    points_list.append(pt)
-                    panoramas_list.append((pt.panorama_lat,pt.panorama_lng))
-                    pointCounter +=1
-        f = open("../data/"+self.region_name+"-points.csv","w")
-        for p in points_list:
-            print(p.strForm(),file=f)
-        f.close()
+        street = None
+        for pt in resolved:
+            if manifest is not None and pt.streetID != street:
+                if street is not None:
+                    manifest.street_done(street) # points come in street order
+                street = pt.streetID
+            pt.ID = pointCounter
+            if not panoramas.add_unique(pt.panorama_lat,pt.panorama_lng):
+                continue # rare but if already have panorama, skip
+            pointCounter +=1
+            yield pt
+        if manifest is not None and street is not None:
+            manifest.street_done(street)
+        calls = sum(i.calls for i in self.streets) if sampling == "adaptive" else grid
+        self.sampling_stats = {'sampling':sampling,'grid_points':grid,'calls':calls,'saved':grid-calls}
+
+    @metrics.timed("write_region")
+    def write_region(self,engine=None,tolerance=0.5,sampling="fixed",formats=("npy","csv"),manifest=None):
+        """
+        Write every single point's information to the region's point files.
+
+        For every spatial coordinate in street's points, a Point object is created.
+        All points are then queried in one batch against the Static Maps API through
+        a MetadataEngine to find information about the panorama for that coordinate.
+        All this information is then added to the columnar store and, for tools
+        that still read it, the csv file. Panoramas within
+        tolerance of one already kept are skipped. Pipeline does the same while
+        downloading images at the same time. Returns the number of points written.
+
+        Parameter engine: MetadataEngine to use, a default one is created if None
+        Parameter tolerance: distance in meters for panoramas to count as the same
+        Parameter sampling: "fixed" or "adaptive", see unique_points
+        Parameter formats: files to write, "npy" for PointStore and "csv"
+        Parameter manifest: Manifest recording street completion, or None
+        """
+        if engine is None:
+            engine = MetadataEngine()
+        points_list = PointTable(self.region_name) # resolved points kept as rows, not objects
+        for p in self.unique_points(engine,tolerance,sampling,manifest):
+            points_list.append(p)
+        if "npy" in formats:
+            with PointWriter(self.region_name) as store:
+                store.add_table(points_list)
+        if "csv" in formats:
+            f = open("../data/"+self.region_name+"-points.csv","w")
+            for p in points_list:
+                print(p.strForm(),file=f)
+            f.close()
+        return len(points_list)
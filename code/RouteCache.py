@@ -0,0 +1,84 @@
+"""
+Module defines the RouteCache class, a SQLite store of raw route scrapes.
+
+Loading a Google Maps route in a browser is the slowest per item step of a
+crawl. Regions that share a center or destination, reruns, and several worker
+processes tiling one area ask for the same routes, so the potential
+intersections returned for each center and destination pair are kept here and
+reused.
+"""
+
+import sqlite3
+import threading
+import json
+import time
+
+
+class RouteCache():
+    """
+    A class representing an on-disk cache of route intersections.
+
+    Attribute path: SQLite file location, safe to share between processes.
+
+    Attribute hits,misses: counters for the current process.
+    """
+
+    def __init__(self,path="../data/route-cache.sqlite"):
+        """
+        Open or create the cache file.
+
+        Parameter path: SQLite file location
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,timeout=30,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS routes (
+            origin TEXT, destination TEXT, intersections TEXT, fetched REAL,
+            PRIMARY KEY (origin,destination))""")
+        self.db.commit()
+
+    @staticmethod
+    def key(coordinate):
+        """
+        Returns a coordinate as text rounded to 6 decimals.
+
+        Parameter coordinate: (lat,lng) tuple
+        """
+        return "%.6f,%.6f" % (coordinate[0],coordinate[1])
+
+    def get(self,origin,destination):
+        """
+        Returns the stored intersections of a route, None on a miss.
+
+        Parameter origin: (lat,lng) tuple
+        Parameter destination: (lat,lng) tuple
+        """
+        with self.lock:
+            row = self.db.execute("SELECT intersections FROM routes WHERE origin=? AND destination=?",
+                                  (self.key(origin),self.key(destination))).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self,origin,destination,intersections):
+        """
+        Store the intersections of a route. Empty scrapes are not stored.
+
+        Parameter origin: (lat,lng) tuple
+        Parameter destination: (lat,lng) tuple
+        Parameter intersections: list of coordinate strings from Region.fetch_route
+        """
+        if not intersections:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO routes VALUES (?,?,?,?)",
+                            (self.key(origin),self.key(destination),json.dumps(intersections),time.time()))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
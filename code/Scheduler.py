@@ -0,0 +1,219 @@
+"""
+Module defines the Scheduler class, which covers an area larger than one Region
+by splitting it into tiles and crawling the tiles in a pool of processes.
+
+Each tile is an ordinary Region with its own points file. All worker processes
+share one MetadataCache and one RouteCache file, so a point or route that lies
+in two overlapping tiles is only fetched once. With a quota, they also share one
+QuotaGuard file, so daily limits and QPS hold for the whole crawl. When every
+tile is done, merge combines the tile points into one dataset, CSV and
+PointStore, in which every panorama appears once, even if it was found from
+several tiles.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import cos,radians,sqrt,ceil
+from SpatialIndex import SpatialIndex
+from Region import Region
+from MetadataEngine import MetadataEngine
+from MetadataCache import MetadataCache
+from RouteCache import RouteCache
+from Quota import QuotaGuard
+from OSMRouter import RoadGraph
+from Point import BASE
+from PointStore import PointStore, PointWriter, store_path
+import time
+import os
+
+MILES_PER_DEGREE = 69.0 # miles in one degree of latitude
+
+def tile_centers(south,west,north,east,radius=0.25,prefix="tile"):
+    """
+    Returns (name, lat, lng) tile centers covering a bounding box.
+
+    Centers are placed on a square grid sqrt(2)*radius apart, so the circles
+    of radius around them leave no gaps.
+
+    Parameters south,west,north,east: bounding box in degrees
+    Parameter radius: region radius in miles, see Region.level_routes
+    Parameter prefix: tile name prefix
+    """
+    step = sqrt(2)*radius
+    lat_step = step / MILES_PER_DEGREE
+    lng_step = step / (MILES_PER_DEGREE*cos(radians((south+north)/2)))
+    rows = max(1,int(ceil((north-south)/lat_step)))
+    cols = max(1,int(ceil((east-west)/lng_step)))
+    tiles = []
+    for r in range(rows):
+        for c in range(cols):
+            lat = south + (r+0.5)*(north-south)/rows
+            lng = west + (c+0.5)*(east-west)/cols
+            tiles.append((prefix+"-"+str(r)+"-"+str(c),lat,lng))
+    return tiles
+
+_graph = None # road graph, loaded once per worker process
+
+def run_tile(tile,options):
+    """
+    Crawl a single tile and return its statistics. Runs in a worker process.
+
+    Parameter tile: (name, lat, lng) tuple
+    Parameter options: dictionary of Scheduler settings
+    """
+    global _graph
+    start = time.monotonic()
+    name, lat, lng = tile
+    region = Region(name,lat,lng)
+    region.level_routes()
+    if options.get('osm'): # offline routes
+        if _graph is None:
+            _graph = RoadGraph.load(options['osm'])
+        region.get_routes_osm(_graph)
+    else:
+        from BrowserPool import BrowserPool # selenium is only needed without osm
+        routes = RouteCache(options['route_cache'])
+        pool = BrowserPool(options['browsers'])
+        try:
+            region.get_routes(pool,cache=routes)
+        finally:
+            pool.close()
+            routes.close()
+        region.get_segments()
+    region.populate_routes()
+    routed = time.monotonic()
+    cache = MetadataCache(options['metadata_cache'])
+    quota = QuotaGuard(**options['quota']) if options.get('quota') else None
+    engine = MetadataEngine(qps=options['qps'],max_inflight=options['max_inflight'],
+                            base=options['base'],cache=cache,quota=quota)
+    points = region.write_region(engine,sampling=options['sampling'])
+    stats = cache.stats()
+    cache.close()
+    if quota is not None:
+        quota.close()
+    elapsed = time.monotonic()-start
+    return {'tile':name,'streets':len(region.streets),'points':points,
+            'route_seconds':round(routed-start,3),'seconds':round(elapsed,3),
+            'points_per_sec':round(points/max(elapsed,1e-9),2),'cache':stats,
+            'sampling':region.sampling_stats}
+
+
+class Scheduler():
+    """
+    A class crawling many tiles across processes.
+
+    Attribute tiles: list of (name, lat, lng) tile centers.
+
+    Attribute processes: number of worker processes.
+
+    Attribute options: settings passed to every worker.
+
+    Attribute results: statistics of finished tiles, in tile order after run.
+    """
+
+    def __init__(self,tiles,processes=None,qps=25,max_inflight=8,base=None,osm=None,browsers=1,
+                 sampling="fixed",metadata_cache="../data/metadata-cache.sqlite",
+                 route_cache="../data/route-cache.sqlite",quota=None):
+        """
+        Initialize scheduler.
+
+        Parameter tiles: list of (name, lat, lng) tuples, see tile_centers
+        Parameter processes: number of worker processes, all cores by default
+        Parameter qps: total metadata calls per second, split between workers
+        Parameter max_inflight: concurrent metadata calls per worker
+        Parameter base: StreetView API root, the real API by default
+        Parameter osm: OSM extract for offline routes, browser routes if None
+        Parameter browsers: headless drivers per worker for browser routes
+        Parameter sampling: "fixed" or "adaptive", see Region.unique_points
+        Parameter metadata_cache: shared MetadataCache file
+        Parameter route_cache: shared RouteCache file
+        Parameter quota: QuotaGuard keyword arguments, e.g. {'limits':{'metadata':25000}},
+        shared by every worker, or None for no limit
+        """
+        self.tiles = list(tiles)
+        self.processes = processes or os.cpu_count()
+        self.options = {'qps':float(qps)/self.processes,'max_inflight':max_inflight,
+                        'base':base or BASE,'osm':osm,'browsers':browsers,'sampling':sampling,
+                        'metadata_cache':metadata_cache,'route_cache':route_cache,'quota':quota}
+        self.results = []
+
+    def run(self):
+        """
+        Crawl every tile, printing progress and throughput as each one finishes.
+        A tile that raises is recorded with its error and 0 points. Returns the
+        per tile statistics and the totals.
+        """
+        start = time.monotonic()
+        results = {}
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            futures = {pool.submit(run_tile,tile,self.options):tile for tile in self.tiles}
+            for future in as_completed(futures):
+                try:
+                    stats = future.result()
+                except Exception as e: # one tile failing must not lose the others
+                    stats = {'tile':futures[future][0],'points':0,'error':repr(e)}
+                    results[stats['tile']] = stats
+                    print("["+str(len(results))+"/"+str(len(self.tiles))+"]",stats['tile'],"failed:",stats['error'])
+                    continue
+                results[stats['tile']] = stats
+                print("["+str(len(results))+"/"+str(len(self.tiles))+"]",stats['tile'],
+                      stats['points'],"points in",stats['seconds'],"s,",stats['points_per_sec'],"points/s")
+        self.results = [results[t[0]] for t in self.tiles]
+        elapsed = time.monotonic()-start
+        points = sum(r['points'] for r in self.results)
+        return {'tiles':self.results,'points':points,'failed':[r['tile'] for r in self.results if 'error' in r],
+                'seconds':round(elapsed,3),
+                'points_per_sec':round(points/max(elapsed,1e-9),2)}
+
+    def merge(self,name,tolerance=0.5):
+        """
+        Combine the tile points into ../data/<name>-points.csv and the PointStore
+        of name, so the merged set can be read like any region.
+
+        A panorama found from several tiles is kept once, matched by ID or by
+        location within tolerance. Rows without a panorama are dropped. The region
+        column is set to name so images of the merged set share one folder. Each
+        tile is read from its PointStore, or from its CSV if it has none.
+        Returns the number of rows written.
+
+        Parameter name: merged dataset name
+        Parameter tolerance: distance in meters for panoramas to count as the same
+        """
+        seen_ids = set()
+        seen = SpatialIndex(tolerance)
+        written = 0
+        with open("../data/"+name+"-points.csv","w") as out, PointWriter(name) as store:
+            for row in self.tile_rows():
+                if row[5] == "0" or row[5] in seen_ids:
+                    continue
+                if not seen.add_unique(float(row[7]),float(row[8])):
+                    continue
+                seen_ids.add(row[5])
+                row[0] = name
+                print(",".join(row),file=out)
+                store.add_row(name,int(row[1]),float(row[2]),float(row[3]),float(row[4]),row[5],row[6],
+                              float(row[7]),float(row[8]))
+                written += 1
+        return written
+
+    def tile_rows(self):
+        """
+        Generate the points of every tile as lists of CSV column strings.
+        """
+        for tile in self.tiles:
+            if os.path.exists(store_path(tile[0])):
+                for row in PointStore(tile[0]).rows():
+                    yield [str(c) for c in row]
+                continue
+            path = "../data/"+tile[0]+"-points.csv"
+            if not os.path.exists(path):
+                continue # tile failed or has not run
+            with open(path) as f:
+                for line in f:
+                    yield line.rstrip("\n").split(",")
+
+
+if __name__ == "__main__":
+    # downtown LA split into quarter mile tiles
+    scheduler = Scheduler(tile_centers(34.035,-118.255,34.050,-118.235,prefix="DowntownLA"))
+    print(scheduler.run())
+    print(scheduler.merge("DowntownLA-merged"),"panoramas merged")
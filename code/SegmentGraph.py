@@ -0,0 +1,109 @@
+"""
+Module defines the SegmentGraph class. All routes of a region start at the same
+center, so they share long stretches of road, sometimes traversed in opposite
+directions and sometimes only partly overlapping. Interpolating every route's
+segments separately queries those stretches more than once.
+
+The graph snaps segment end points to node ids with a SpatialIndex, stores each
+edge once regardless of direction, and splits edges wherever another node lies
+on them. After splitting, collinear edges that overlapped share identical
+pieces, which are then stored once, so every stretch of road is interpolated a
+single time.
+"""
+
+from SpatialIndex import SpatialIndex, METERS_PER_DEGREE
+from math import cos,radians,sqrt
+
+CELL = 0.0005 # degrees, coarse grid used to find nodes lying on an edge
+
+class SegmentGraph():
+    """
+    A class representing an undirected graph of street segments.
+
+    Attribute tolerance: distance in meters within which coordinates are the
+    same node and a node counts as lying on an edge.
+
+    Attribute nodes: list of (lat,lng) node coordinates, indexed by node id.
+
+    Attribute edges: dictionary mapping the sorted node id pair of an edge to
+    the (a,b) orientation it was first added with, in insertion order.
+    """
+
+    def __init__(self,tolerance=1.0):
+        """
+        Initialize an empty graph.
+
+        Parameter tolerance: snapping distance in meters
+        """
+        self.tolerance = tolerance
+        self.index = SpatialIndex(tolerance)
+        self.nodes = []
+        self.edges = {}
+
+    def node(self,lat,lng):
+        """
+        Returns the id of the node at a coordinate, creating it if there is no
+        node within tolerance.
+
+        Parameters lat,lng: coordinates
+        """
+        found = self.index.find(lat,lng)
+        if found is not None:
+            return found
+        self.nodes.append((lat,lng))
+        self.index.insert(lat,lng,len(self.nodes)-1)
+        return len(self.nodes)-1
+
+    def add(self,A,B):
+        """
+        Add a segment between end points A and B. Reversed and repeated segments
+        are stored once.
+
+        Parameters A,B: [lat,lng] end points
+        """
+        a = self.node(A[0],A[1])
+        b = self.node(B[0],B[1])
+        if a != b and (min(a,b),max(a,b)) not in self.edges:
+            self.edges[(min(a,b),max(a,b))] = (a,b)
+
+    def _project(self,node,lat0):
+        lat,lng = self.nodes[node]
+        return (lng*cos(radians(lat0))*METERS_PER_DEGREE, lat*METERS_PER_DEGREE)
+
+    def merge(self):
+        """
+        Split every edge at the nodes lying on it and de-duplicate the pieces.
+        Collinear edges that overlapped end up sharing pieces and are merged.
+        """
+        grid = {}
+        for n,(lat,lng) in enumerate(self.nodes):
+            grid.setdefault((int(lat//CELL),int(lng//CELL)),[]).append(n)
+        lat0 = self.nodes[0][0] if self.nodes else 0
+        edges = self.edges
+        self.edges = {}
+        for a,b in edges.values():
+            (ax,ay),(bx,by) = self._project(a,lat0),self._project(b,lat0)
+            dx, dy = bx-ax, by-ay
+            length2 = dx*dx + dy*dy
+            lats = sorted((self.nodes[a][0],self.nodes[b][0]))
+            lngs = sorted((self.nodes[a][1],self.nodes[b][1]))
+            inner = []
+            for r in range(int(lats[0]//CELL)-1,int(lats[1]//CELL)+2):
+                for c in range(int(lngs[0]//CELL)-1,int(lngs[1]//CELL)+2):
+                    for n in grid.get((r,c),()):
+                        if n == a or n == b:
+                            continue
+                        px,py = self._project(n,lat0)
+                        t = ((px-ax)*dx + (py-ay)*dy) / length2
+                        if 0 < t < 1 and sqrt((ax+t*dx-px)**2 + (ay+t*dy-py)**2) <= self.tolerance:
+                            inner.append((t,n))
+            chain = [a] + [n for t,n in sorted(inner)] + [b]
+            for u,v in zip(chain,chain[1:]):
+                if u != v and (min(u,v),max(u,v)) not in self.edges:
+                    self.edges[(min(u,v),max(u,v))] = (u,v)
+
+    def segments(self):
+        """
+        Returns unique edges as ([lat1,lng1],[lat2,lng2]) segments.
+        """
+        return [(list(self.nodes[a]),list(self.nodes[b])) for a,b in self.edges.values()]
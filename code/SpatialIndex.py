@@ -0,0 +1,111 @@
+"""
+Module defines the SpatialIndex class, a grid bucket hash map over lat,lng
+coordinates used to de-duplicate points, segments and panoramas.
+
+Space is cut into square cells about as wide as the match tolerance. A lookup
+only compares against entries in the cells around the query, so insert and
+lookup are O(1) on average instead of scanning a list, and two coordinates
+that differ only by float noise still match.
+"""
+
+from math import cos,radians,sqrt,ceil
+
+METERS_PER_DEGREE = 111320.0 # length of one degree of latitude in meters
+
+def meters(lat1,lng1,lat2,lng2):
+    """
+    Returns the approximate distance between points A and B in meters.
+
+    Uses an equirectangular projection, accurate to well under a centimeter at
+    the few meter distances the index works with and much cheaper than haversine.
+
+    Parameters lat1,lng1: coordinates of point A
+    Parameters lat2,lng2: coordinates of point B
+    """
+    x = (lng2-lng1) * cos(radians((lat1+lat2)/2)) * METERS_PER_DEGREE
+    y = (lat2-lat1) * METERS_PER_DEGREE
+    return sqrt(x*x + y*y)
+
+
+class SpatialIndex():
+    """
+    A class representing a grid bucket map of coordinates.
+
+    Attribute tolerance: two coordinates closer than this many meters match.
+
+    Attribute cell: cell size in degrees.
+
+    Attribute buckets: dictionary mapping (row, column) cells to lists of
+    (lat, lng, value) entries.
+    """
+
+    def __init__(self,tolerance=1.0):
+        """
+        Initialize an empty index.
+
+        Parameter tolerance: match distance in meters
+        """
+        self.tolerance = float(tolerance)
+        self.cell = self.tolerance / METERS_PER_DEGREE
+        self.buckets = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _cell(self,lat,lng):
+        return (int(lat // self.cell), int(lng // self.cell))
+
+    def insert(self,lat,lng,value=None):
+        """
+        Add a coordinate with an optional value attached.
+
+        Parameters lat,lng: coordinates
+        Parameter value: anything to return on lookup
+        """
+        self.buckets.setdefault(self._cell(lat,lng),[]).append((lat,lng,value))
+        self.count += 1
+
+    def nearby(self,lat,lng):
+        """
+        Returns all (lat, lng, value) entries within tolerance of a coordinate.
+
+        Parameters lat,lng: coordinates to look around
+        """
+        row, col = self._cell(lat,lng)
+        # a degree of longitude shrinks away from the equator, so look wider
+        span = int(ceil(1 / max(cos(radians(lat)),1e-6)))
+        found = []
+        for r in range(row-1,row+2):
+            for c in range(col-span,col+span+1):
+                for entry in self.buckets.get((r,c),()):
+                    if meters(lat,lng,entry[0],entry[1]) <= self.tolerance:
+                        found.append(entry)
+        return found
+
+    def find(self,lat,lng):
+        """
+        Returns the value of an entry within tolerance of a coordinate, None if
+        there is none.
+
+        Parameters lat,lng: coordinates to look up
+        """
+        found = self.nearby(lat,lng)
+        return found[0][2] if found else None
+
+    def __contains__(self,coordinate):
+        return len(self.nearby(coordinate[0],coordinate[1])) > 0
+
+    def add_unique(self,lat,lng,value=None):
+        """
+        Insert a coordinate unless one within tolerance exists already.
+
+        Returns True if it was inserted, False if it was a duplicate.
+
+        Parameters lat,lng: coordinates
+        Parameter value: anything to return on lookup
+        """
+        if (lat,lng) in self:
+            return False
+        self.insert(lat,lng,value)
+        return True
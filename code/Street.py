@@ -1,6 +1,11 @@
 """
 Module defines Street class. Each Street object contains its end points, A and B,
 as well as points that are 15 meters apart between A and B.
+
+Instead of querying every one of those points, sample_adaptive probes the two
+ends of the street and only bisects stretches whose ends return different
+panoramas. Neighbouring points usually share a panorama, so this finds the
+same panoramas with far fewer metadata calls.
 """
 from Helper import *
 from Point import *
@@ -11,7 +16,7 @@ class Street():
 
     Attribute ID: Unique identifier for records
 
-    Attribute points: List of spatial coordinates 15 meters apart in a street.
+    Attribute points: (N,2) array of spatial coordinates 15 meters apart in a street.
 
     Attribute A: First end point of street.
 
@@ -19,8 +24,12 @@ class Street():
 
     Attribute direction: bearing from A to B. Helps in accessing panorama in the
     precise direction. (90 degrees left, 90 degrees right)
+
+    Attribute calls: metadata calls made by the last sample_adaptive run.
     """
 
+    __slots__ = ('ID','points','A','B','direction','calls')
+
     def __init__(self,ID,A,B):
         """
         Initialize Street object with name and center lat lng.
@@ -33,12 +42,60 @@ class Street():
         self.A = A
         self.B = B
         self.direction = 0
+        self.calls = 0
 
     def populate_points(self):
         """
         Estimate direction using Helper module's direction function. Then find
-        all points that are 15 meters apart using Helper module's interpolate
-        function. Store those in points list.
+        all points that are 15 meters apart using Helper module's interpolate_batch
+        function. Store those in points array.
+
+        Region.populate_routes fills all streets in one batch call instead.
         """
         self.direction = direction(self.A[0],self.A[1],self.B[0],self.B[1])
-        self.points = interpolate(self.A[0],self.A[1],self.B[0],self.B[1])
+        self.points = interpolate_batch(self.A,self.B)[0]
+
+    def sample_adaptive(self,engine,region):
+        """
+        Resolve the street's panoramas by bisection over its 15 meter points.
+
+        Both ends are probed first. Whenever the two ends of a stretch return the
+        same panorama ID the whole stretch is assumed to share it, otherwise the
+        middle point is probed and both halves are checked the same way, down to
+        neighbouring points. Ends without a panorama say nothing about the points
+        between them, so such stretches are always split. Returns the resolved
+        Point at the start of each run of identical panoramas, in street order,
+        which is what the fixed grid keeps after de-duplication. A panorama that
+        appears and disappears again between two probes with the same ID can be
+        missed.
+
+        populate_points must have been called first.
+
+        Parameter engine: MetadataEngine used for single point calls
+        Parameter region: region name for the created points
+        """
+        n = len(self.points)
+        probed = {}
+
+        def probe(i):
+            if i not in probed:
+                pt = Point(None,region,self.ID,float(self.points[i][0]),float(self.points[i][1]),self.direction)
+                probed[i] = engine.fetch(pt)
+            return probed[i].panoramaID
+
+        if n > 0:
+            stack = [(0,n-1)]
+            while stack: # bisect stretches whose ends differ
+                lo, hi = stack.pop()
+                same = probe(lo) == probe(hi) and probe(lo) != 0 # 0 is no coverage, it must be split
+                if same or hi-lo <= 1:
+                    continue
+                mid = (lo+hi)//2
+                stack.append((mid,hi))
+                stack.append((lo,mid))
+        self.calls = len(probed)
+        kept = []
+        for i in sorted(probed):
+            if not kept or probed[i].panoramaID != kept[-1].panoramaID:
+                kept.append(probed[i])
+        return kept
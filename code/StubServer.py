@@ -0,0 +1,169 @@
+"""
+Module defines a local stand-in for the Google services the crawl depends on, so
+the pipeline can be run and timed offline.
+
+StubServer answers StreetView metadata and image requests and Google Maps
+directions pages on a local port. Metadata latency, error rate and panorama
+density are configurable. Panoramas sit on a grid spaced density meters apart,
+and every point resolves to the panorama of its grid cell. Each cell has a
+panorama with probability coverage, otherwise the answer is ZERO_RESULTS.
+Directions pages are read from a folder of recorded pages on disk, which
+record_directions can fill with synthetic routes in the same format.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from SpatialIndex import METERS_PER_DEGREE
+from math import cos,radians
+import threading
+import hashlib
+import random
+import json
+import time
+import os
+
+
+def page_name(path):
+    """
+    Returns the file name a directions page is stored under.
+
+    Parameter path: request path after /maps/dir/, "lat,lng/lat,lng/data=..."
+    """
+    parts = unquote(path).split("/")
+    return hashlib.sha1((parts[0]+"/"+parts[1]).encode()).hexdigest()+".html"
+
+def record_directions(folder,center,destinations):
+    """
+    Write a synthetic directions page for each destination into folder.
+
+    Each route goes from center along the latitude to the destination's latitude
+    and then along the longitude, written as the doubled [null,null,lat,lng]
+    corners Region.get_segments expects.
+
+    Parameter folder: pages folder
+    Parameter center: (lat,lng) tuple
+    Parameter destinations: list of (lat,lng) tuples
+    """
+    os.makedirs(folder,exist_ok=True)
+    for d in destinations:
+        corners = [center,(d[0],center[1]),d]
+        body = "".join("[null,null,%.6f,%.6f]" % c * 2 for c in corners)
+        name = page_name(str(center[0])+","+str(center[1])+"/"+str(d[0])+","+str(d[1]))
+        with open(os.path.join(folder,name),"w") as f:
+            f.write("<html><body><script>window.APP_INITIALIZATION_STATE="+body+"</script></body></html>")
+
+
+class StubServer():
+    """
+    A class running the local stub services in a background thread.
+
+    Attribute latency: seconds added to every metadata and image response.
+
+    Attribute error_rate: fraction of metadata and image requests answered with
+    HTTP 500.
+
+    Attribute density: spacing of panoramas in meters.
+
+    Attribute coverage: fraction of grid cells that have a panorama.
+
+    Attribute image_bytes: size of every image response.
+
+    Attribute pages: folder of recorded directions pages.
+
+    Attribute base: StreetView API root to give MetadataEngine and DownloadManager.
+
+    Attribute maps_base: directions root to give Region.get_routes.
+    """
+
+    def __init__(self,latency=0.0,error_rate=0.0,density=10.0,coverage=0.9,image_bytes=60000,
+                 pages=None,port=0,seed=0):
+        """
+        Start the server.
+
+        Parameter latency: seconds per response
+        Parameter error_rate: fraction of failed responses
+        Parameter density: panorama spacing in meters
+        Parameter coverage: fraction of cells with a panorama
+        Parameter image_bytes: image response size
+        Parameter pages: recorded directions pages folder
+        Parameter port: port to listen on, a free one by default
+        Parameter seed: random seed for errors
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.density = density
+        self.coverage = coverage
+        self.image = b"\xff\xd8" + bytes(max(0,image_bytes-2))
+        self.pages = pages
+        self.random = random.Random(seed)
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, like the real services
+
+            def do_GET(self):
+                stub.requests += 1
+                status, body, kind = stub.respond(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type",kind)
+                self.send_header("Content-Length",str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1",port),Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        root = "http://127.0.0.1:"+str(self.server.server_port)
+        self.base = root+"/maps/api/streetview"
+        self.maps_base = root+"/maps/dir/"
+
+    def panorama(self,lat,lng):
+        """
+        Returns the metadata response for a coordinate.
+
+        Parameters lat,lng: coordinates
+        """
+        cell = self.density / METERS_PER_DEGREE
+        row = int(lat // cell)
+        scale = cos(radians((row+0.5)*cell)) # same for every point in a row of cells
+        col = int(lng*scale // cell)
+        digest = hashlib.sha1((str(row)+","+str(col)).encode()).digest()
+        if digest[0]/256 >= self.coverage:
+            return {'status':'ZERO_RESULTS'}
+        pano_lat = (row+0.5)*cell
+        pano_lng = (col+0.5)*cell/scale
+        year = 2015 + digest[1] % 8
+        return {'status':'OK','pano_id':digest[2:18].hex(),'date':str(year)+"-"+"%02d" % (1+digest[3] % 12),
+                'location':{'lat':pano_lat,'lng':pano_lng}}
+
+    def respond(self,path):
+        """
+        Returns (status, body, content type) for a request path.
+
+        Parameter path: request path with query string
+        """
+        parts = urlsplit(path)
+        if parts.path.startswith("/maps/dir/"):
+            name = page_name(path[len("/maps/dir/"):])
+            if self.pages is None or not os.path.exists(os.path.join(self.pages,name)):
+                return 404, b"not recorded", "text/plain"
+            with open(os.path.join(self.pages,name),"rb") as f:
+                return 200, f.read(), "text/html"
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return 500, b"stub error", "text/plain"
+        query = parse_qs(parts.query)
+        if parts.path.endswith("/metadata"):
+            lat, lng = map(float,query['location'][0].split(","))
+            return 200, json.dumps(self.panorama(lat,lng)).encode(), "application/json"
+        return 200, self.image, "image/jpeg"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
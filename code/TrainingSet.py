@@ -0,0 +1,270 @@
+"""
+Module packs the downloaded side images of one or more regions into a training
+dataset that loaders can read at disk speed.
+
+TrainingSetBuilder decodes every images/<region>/<panoID>-<heading>.jpg in a pool
+of processes, resizes it to a fixed shape and writes it into shards, which are
+uint8 .npy arrays of shape (N, height, width, 3) under ../data/<name>-dataset/.
+An index array holds, for every image, its shard and position, panorama ID,
+heading, date and coordinates from the region's PointStore. Running the builder
+again only adds images that are not in the index yet, in new shards, so it can
+follow a crawl as new panoramas arrive. Images that are not downloaded yet are
+left for the next run.
+
+TrainingSet opens a dataset with every shard memory-mapped. An epoch that reads
+shard after shard is a sequential read with no JPEG decode.
+
+Decoding needs the optional Pillow package.
+
+Example: python TrainingSet.py graffiti DowntownLA --size 224 224
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from PointStore import PointStore
+from Panorama import HEADINGS
+import numpy as np
+import argparse
+import json
+import os
+
+INDEX_DTYPE = np.dtype([('shard','<i4'),('offset','<i4'),('pano','S64'),('heading','<i2'),('region','<i4'),
+                        ('date','<M8[M]'),('lat','<f8'),('lng','<f8'),('direction','<f8')])
+
+def dataset_path(name,root="../data"):
+    """
+    Returns the folder a dataset is stored in.
+
+    Parameter name: dataset name
+    Parameter root: data folder
+    """
+    return root+"/"+name+"-dataset"
+
+def decode_image(task):
+    """
+    Returns an image file decoded to an RGB uint8 array of a fixed size, None if
+    the file cannot be read. Runs in a worker process.
+
+    Parameter task: (path, (width, height)) tuple
+    """
+    from PIL import Image
+    path, size = task
+    try:
+        with Image.open(path) as image:
+            return np.asarray(image.convert("RGB").resize(size,Image.BILINEAR),dtype=np.uint8)
+    except (OSError,ValueError):
+        return None
+
+def _load_meta(path):
+    if not os.path.exists(path+"/meta.json"):
+        return None, np.zeros(0,dtype=INDEX_DTYPE)
+    with open(path+"/meta.json") as f:
+        meta = json.load(f)
+    return meta, np.load(path+"/index.npy")
+
+
+class TrainingSetBuilder():
+    """
+    A class adding downloaded images to a sharded dataset.
+
+    Attribute path: dataset folder.
+
+    Attribute regions: regions whose images are added.
+
+    Attribute size: (width, height) every image is resized to.
+
+    Attribute shard_size: images per shard.
+
+    Attribute processes: decode worker processes.
+    """
+
+    def __init__(self,name,regions,size=(224,224),shard_size=4096,processes=None,root="../data",
+                 images="../images"):
+        """
+        Initialize builder.
+
+        Parameter name: dataset name
+        Parameter regions: list of region names with a PointStore
+        Parameter size: (width, height) of the stored images
+        Parameter shard_size: images per shard
+        Parameter processes: decode processes, all cores by default
+        Parameter root: data folder
+        Parameter images: images folder
+        """
+        self.path = dataset_path(name,root)
+        self.regions = list(regions)
+        self.size = tuple(size)
+        self.shard_size = shard_size
+        self.processes = processes or os.cpu_count()
+        self.root = root
+        self.images = images
+
+    def pending(self,meta,index):
+        """
+        Returns index rows, without shard and offset, and image paths of every
+        downloaded image not in the dataset yet.
+
+        Parameter meta: dataset metadata, region names are added to it
+        Parameter index: current index array
+        """
+        done = set(zip(index['pano'].tolist(),index['heading'].tolist()))
+        rows = []
+        paths = []
+        for region in self.regions:
+            if region not in meta['regions']:
+                meta['regions'].append(region)
+            code = meta['regions'].index(region)
+            store = PointStore(region,self.root)
+            for r in store.panorama_records():
+                panoID = store.pano_id(r['pano'])
+                for heading in HEADINGS:
+                    path = self.images+"/"+region+"/"+panoID+"-"+str(heading)+".jpg"
+                    if (panoID.encode(),heading) in done or not os.path.exists(path):
+                        continue # already packed or not downloaded yet
+                    done.add((panoID.encode(),heading))
+                    rows.append((0,0,panoID,heading,code,r['date'],r['pano_lat'],r['pano_lng'],r['direction']))
+                    paths.append(path)
+        return np.array(rows,dtype=INDEX_DTYPE), paths
+
+    def _save(self,meta,index):
+        """
+        Replace the index and metadata files.
+        """
+        np.save(self.path+"/index.part.npy",index)
+        with open(self.path+"/meta.part.json","w") as f:
+            json.dump(meta,f)
+        os.replace(self.path+"/index.part.npy",self.path+"/index.npy")
+        os.replace(self.path+"/meta.part.json",self.path+"/meta.json")
+
+    def build(self):
+        """
+        Pack every new image into new shards. Returns the number of images added.
+        The index is saved after every shard, so an interrupted run keeps the
+        shards it finished.
+        """
+        try:
+            import PIL
+        except ImportError:
+            raise ImportError("building a training set requires the Pillow package")
+        os.makedirs(self.path,exist_ok=True)
+        meta, index = _load_meta(self.path)
+        if meta is None:
+            meta = {'size':list(self.size),'regions':[],'shards':[]}
+        elif tuple(meta['size']) != self.size:
+            raise ValueError("dataset was built with size "+str(meta['size'])+", not "+str(list(self.size)))
+        rows, paths = self.pending(meta,index)
+        width, height = self.size
+        added = 0
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            for start in range(0,len(paths),self.shard_size):
+                shard = len(meta['shards'])
+                chunk = rows[start:start+self.shard_size]
+                name = self.path+"/shard-%05d.npy" % shard
+                array = np.lib.format.open_memmap(name+".part",mode="w+",dtype=np.uint8,
+                                                  shape=(len(chunk),height,width,3))
+                kept = []
+                tasks = [(p,self.size) for p in paths[start:start+self.shard_size]]
+                for n,image in enumerate(pool.map(decode_image,tasks,chunksize=16)):
+                    if image is None:
+                        continue # unreadable file, e.g. cut off by a crash
+                    array[len(kept)] = image
+                    kept.append(n)
+                array.flush()
+                del array
+                if not kept:
+                    os.remove(name+".part") # nothing readable, retried next run
+                    continue
+                os.replace(name+".part",name)
+                chunk = chunk[kept]
+                chunk['shard'] = shard
+                chunk['offset'] = np.arange(len(kept))
+                index = np.concatenate([index,chunk])
+                meta['shards'].append(len(kept)) # rows past the count are unused
+                meta['count'] = len(index)
+                self._save(meta,index)
+                added += len(kept)
+        return added
+
+
+class TrainingSet():
+    """
+    A class reading a packed dataset.
+
+    Attribute index: structured array with one row per image.
+
+    Attribute regions: region names the region column indexes.
+
+    Attribute size: (width, height) of the images.
+    """
+
+    def __init__(self,name,root="../data"):
+        """
+        Open a dataset. Shards are memory-mapped when first read.
+
+        Parameter name: dataset name
+        Parameter root: data folder
+        """
+        self.path = dataset_path(name,root)
+        meta, self.index = _load_meta(self.path)
+        if meta is None:
+            raise IOError("no dataset at "+self.path)
+        self.regions = meta['regions']
+        self.size = tuple(meta['size'])
+        self.counts = meta['shards']
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def shard(self,number):
+        """
+        Returns the images of a shard as a memory-mapped (N, height, width, 3) array.
+
+        Parameter number: shard number
+        """
+        if number not in self.arrays:
+            array = np.load(self.path+"/shard-%05d.npy" % number,mmap_mode='r')
+            self.arrays[number] = array[:self.counts[number]]
+        return self.arrays[number]
+
+    def entry(self,i):
+        """
+        Returns the index row of image i as a dictionary.
+
+        Parameter i: image number
+        """
+        r = self.index[i]
+        return {'panoID':r['pano'].decode(),'heading':int(r['heading']),'region':self.regions[r['region']],
+                'date':str(r['date']),'lat':float(r['lat']),'lng':float(r['lng']),
+                'direction':float(r['direction'])}
+
+    def __getitem__(self,i):
+        """
+        Returns (image array, entry dictionary) of image i.
+
+        Parameter i: image number
+        """
+        r = self.index[i]
+        return self.shard(int(r['shard']))[r['offset']], self.entry(i)
+
+    def shards(self):
+        """
+        Generate (images, index rows) for every shard in order, for sequential epochs.
+        """
+        for number in range(len(self.counts)):
+            yield self.shard(number), self.index[self.index['shard'] == number]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack downloaded side images into a sharded dataset.")
+    parser.add_argument("name",help="dataset name")
+    parser.add_argument("regions",nargs="+",help="regions to add")
+    parser.add_argument("--size",type=int,nargs=2,default=[224,224],help="width and height")
+    parser.add_argument("--shard-size",type=int,default=4096,help="images per shard")
+    parser.add_argument("--processes",type=int,help="decode processes")
+    options = parser.parse_args(argv)
+    builder = TrainingSetBuilder(options.name,options.regions,options.size,options.shard_size,options.processes)
+    print(builder.build(),"images added")
+
+
+if __name__ == "__main__":
+    main()
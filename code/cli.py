@@ -0,0 +1,240 @@
+"""
+Module runs the crawl of a region one stage at a time.
+
+runner.py goes from routes to images in one process. Here every stage is a
+subcommand that reads the previous stage's output from ../data and writes its
+own, so a stage can be repeated without the ones before it:
+
+    routes     load routes in a browser, ../data/<region>-routes.json
+    segments   intersection segments of the routes, ../data/<region>-segments.json
+    points     streets and resolved points, the points store, CSV and manifest
+    download   side images of every panorama in the points store
+    history    older panoramas of every panorama, ../data/<region>-history.jsonl
+
+routes --osm computes the segments offline and writes the segments file
+itself, so the segments stage is skipped and points follows it directly.
+
+Modules are imported inside the stage that uses them. Selenium and Chrome are
+only loaded by routes and history, and segments, points and download start
+without them.
+
+Example: python cli.py routes DowntownLA 34.041842 -118.244583
+         python cli.py segments DowntownLA
+         python cli.py download DowntownLA
+"""
+
+from Metrics import metrics
+import argparse
+
+
+def routes(options):
+    """
+    Load the routes from the region center to its destinations and store them.
+    With an OSM extract the segments are computed offline and stored instead.
+    Streets in the manifest are built again by the points stage.
+    """
+    from Region import Region, artifact_path
+    import os
+    region = Region(options.region,options.lat,options.lng)
+    if options.osm:
+        from OSMRouter import RoadGraph
+        graph = RoadGraph.load(options.osm)
+        if options.planner:
+            from CoveragePlanner import CoveragePlanner
+            planner = CoveragePlanner(region)
+            planner.run(graph=graph)
+            print(planner.report())
+        else:
+            region.level_routes(options.radii,options.count,options.step)
+            region.get_routes_osm(graph)
+        if os.path.exists(artifact_path(options.region,"routes")):
+            os.remove(artifact_path(options.region,"routes")) # browser routes of an earlier run
+        print(region.save_artifact("segments"))
+        _reset_streets(options.region)
+        return
+    from BrowserPool import BrowserPool
+    from RouteCache import RouteCache
+    cache = RouteCache(options.route_cache) if options.route_cache else None
+    pool = BrowserPool(options.browsers)
+    try:
+        if options.planner:
+            from CoveragePlanner import CoveragePlanner
+            planner = CoveragePlanner(region,batch=options.browsers)
+            planner.run(pool,cache=cache)
+            print(planner.report())
+        else:
+            region.level_routes(options.radii,options.count,options.step)
+            region.get_routes(pool,cache=cache)
+    finally:
+        pool.close()
+        if cache is not None:
+            cache.close()
+    print(region.save_artifact("routes"))
+    _reset_streets(options.region)
+
+
+def _reset_streets(region):
+    from Manifest import Manifest
+    manifest = Manifest(region)
+    manifest.set_stage("streets","pending")
+    manifest.close()
+
+
+def segments(options):
+    """
+    Turn stored routes into intersection segments and store them. Streets in
+    the manifest are built again from the new segments by the points stage.
+    """
+    from Region import Region, artifact_path
+    import os
+    if not os.path.exists(artifact_path(options.region,"routes")):
+        raise SystemExit("no stored routes for "+options.region+", routes --osm stores segments directly")
+    region = Region.from_artifact(options.region,"routes")
+    region.get_segments()
+    print(region.save_artifact("segments"))
+    _reset_streets(options.region)
+
+
+def _quota(options):
+    if not options.daily_limits:
+        return None
+    from Quota import QuotaGuard
+    return QuotaGuard(limits={'metadata':options.daily_limits[0],'image':options.daily_limits[1]})
+
+
+def points(options):
+    """
+    Build streets from the stored segments and resolve their points. With
+    --download images are fetched while points are resolved, as in runner.py.
+    """
+    from Region import Region
+    from MetadataEngine import MetadataEngine
+    from MetadataCache import MetadataCache
+    from Manifest import Manifest
+    from Quota import plan_region
+    cache = MetadataCache()
+    manifest = Manifest(options.region,cache=cache,max_age=options.refresh_age)
+    region = Region.from_artifact(options.region,"segments")
+    if manifest.stage("streets") == "done":
+        region.load_streets(manifest)
+    else:
+        region.populate_routes()
+        if not options.dry_run: # a dry run leaves the manifest as it was
+            manifest.save_streets(region.streets)
+    print(plan_region(region,manifest))
+    if options.dry_run:
+        manifest.close()
+        cache.close()
+        return
+    quota = _quota(options)
+    engine = MetadataEngine(cache=manifest,quota=quota)
+    if options.download:
+        from Pipeline import Pipeline
+        from Downloader import DownloadManager
+        from ImageDedup import ImageDedup
+        dedup = ImageDedup()
+        manager = DownloadManager(quota=quota,dedup=dedup)
+        print(Pipeline(region,engine,manager,sampling=options.sampling,manifest=manifest,
+                       formats=options.formats).run())
+        dedup.close()
+    else:
+        manifest.set_stage("points","running")
+        print(region.write_region(engine,sampling=options.sampling,formats=options.formats,manifest=manifest),
+              "points written")
+        manifest.set_stage("points","done")
+    print(cache.stats(),manifest.progress())
+    manifest.close()
+    cache.close()
+
+
+def download(options):
+    """
+    Download the images of every panorama in the points store that is new or
+    has a newer date than the images on disk.
+    """
+    from PointStore import load_dataset
+    from Downloader import DownloadManager
+    from Panorama import Panorama, HEADINGS
+    from Manifest import Manifest
+    from ImageDedup import ImageDedup
+    import os
+    store = load_dataset([options.region])[options.region]
+    manifest = Manifest(options.region)
+    dedup = ImageDedup()
+    manager = DownloadManager(workers=options.workers,quota=_quota(options),dedup=dedup)
+    manager.cleanup(options.region) # leftovers from an interrupted run
+
+    def panoramas():
+        seen = set()
+        for r in store.panorama_records():
+            p = Panorama(options.region,store.pano_id(r['pano']),str(r['date']),r['pano_lat'],r['pano_lng'],
+                         r['direction'])
+            if p.ID in seen:
+                continue
+            seen.add(p.ID)
+            change = manifest.needs_download(p.ID,p.date)
+            if change is None:
+                continue # images up to date
+            if change == "newer": # stale images under the same ID
+                for heading in HEADINGS:
+                    if os.path.exists(p.image_path(heading,manager.root)):
+                        os.remove(p.image_path(heading,manager.root))
+            yield p
+
+    print(manager.run(panoramas(),manifest.downloaded))
+    manifest.set_stage("download","done")
+    manifest.close()
+    dedup.close()
+
+
+def history(options):
+    """
+    Harvest older panoramas of every panorama in the points store.
+    """
+    import HistoricalPanoramas
+    HistoricalPanoramas.main(options.region,options.browsers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one stage of a region's crawl.")
+    sub = parser.add_subparsers(dest="command",required=True)
+    stage = sub.add_parser("routes",help="load routes from the center in a browser")
+    stage.add_argument("region")
+    stage.add_argument("lat",type=float)
+    stage.add_argument("lng",type=float)
+    stage.add_argument("--browsers",type=int,default=4,help="headless drivers")
+    stage.add_argument("--radii",type=float,nargs="+",default=[0.25],help="destination distances in miles")
+    stage.add_argument("--count",type=int,default=4,help="destinations per distance")
+    stage.add_argument("--step",type=int,default=4,help="degrees between destinations")
+    stage.add_argument("--planner",action="store_true",help="choose destinations by expected new road")
+    stage.add_argument("--osm",help="OpenStreetMap extract to route offline instead")
+    stage.add_argument("--route-cache",help="RouteCache file shared between runs")
+    stage.set_defaults(run=routes)
+    stage = sub.add_parser("segments",help="intersection segments of the stored routes")
+    stage.add_argument("region")
+    stage.set_defaults(run=segments)
+    stage = sub.add_parser("points",help="resolve the points of the stored segments")
+    stage.add_argument("region")
+    stage.add_argument("--sampling",choices=["fixed","adaptive"],default="fixed")
+    stage.add_argument("--formats",nargs="+",choices=["npy","csv"],default=["npy","csv"])
+    stage.add_argument("--download",action="store_true",help="download images at the same time")
+    stage.add_argument("--refresh-age",type=float,help="seconds before a stored point is queried again")
+    stage.add_argument("--daily-limits",type=int,nargs=2,metavar=("METADATA","IMAGE"))
+    stage.add_argument("--dry-run",action="store_true",help="only print the planned API calls")
+    stage.set_defaults(run=points)
+    stage = sub.add_parser("download",help="download images of the stored points")
+    stage.add_argument("region")
+    stage.add_argument("--workers",type=int,default=8)
+    stage.add_argument("--daily-limits",type=int,nargs=2,metavar=("METADATA","IMAGE"))
+    stage.set_defaults(run=download)
+    stage = sub.add_parser("history",help="older panoramas of the stored points")
+    stage.add_argument("region")
+    stage.add_argument("--browsers",type=int,default=4)
+    stage.set_defaults(run=history)
+    options = parser.parse_args(argv)
+    options.run(options)
+    metrics.write("../data/"+options.region+"-"+options.command+"-metrics.json")
+
+
+if __name__ == "__main__":
+    main()
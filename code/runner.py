@@ -5,39 +5,79 @@ Given a region name and center coordinates, the code will fetch all panorama
 related info for all points 15 meters apart that are within a mile radius of
 the region center.
 
-After generating a CSV file with panorama info, the program will then download
+While the CSV file with panorama info is being written, the program downloads
 images for each unique panorama of the left and right side of the street.
+
+cli.py runs the same stages one at a time.
 """
 
 
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
 from Region import *
 from Panorama import *
+from MetadataCache import MetadataCache
+from Downloader import DownloadManager
+from Pipeline import Pipeline
+from Manifest import Manifest
+from Metrics import metrics
+from Quota import QuotaGuard, plan_region
+from ImageDedup import ImageDedup
+from CoveragePlanner import CoveragePlanner
+
+REFRESH_AGE = None # seconds, e.g. 30*86400 to re-query points older than a month
+METRICS_PORT = None # e.g. 9108 to watch metrics live on http://127.0.0.1:9108/metrics
+DAILY_LIMITS = None # e.g. {'metadata':25000,'image':25000} to pause at the daily quota
+DRY_RUN = False # only print the planned API calls
+COVERAGE_PLANNER = False # choose destinations by expected new road instead of full circles
+
+
+def main():
+    """
+    Route, resolve and download the DowntownLA region in one run.
+    """
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    cache = MetadataCache() # reuse metadata from earlier runs
+    manifest = Manifest("DowntownLA",cache=cache,max_age=REFRESH_AGE)
+
+    # define region and run all functions
+    region = Region("DowntownLA",34.041842, -118.244583)
+    if manifest.stage("streets") == "done": # resume without routing again
+        region.load_streets(manifest)
+    else:
+        from BrowserPool import BrowserPool # selenium only loads when routing
+        pool = BrowserPool(4) # headless drivers loading routes in parallel
+        if COVERAGE_PLANNER:
+            planner = CoveragePlanner(region,batch=4) # one route per browser per batch
+            planner.run(pool)
+            print(planner.report())
+        else:
+            region.level_routes()
+            region.get_routes(pool)
+        pool.close() # browsers are only needed for routes
+        region.save_artifact("routes") # cli.py segments can start from here
+        region.get_segments()
+        region.save_artifact("segments")
+        region.populate_routes()
+        manifest.save_streets(region.streets)
+
+    print(plan_region(region,manifest)) # expected API calls before spending any
+    if DRY_RUN:
+        return
+
+    # resolve points, write CSV rows and download images for each unique panorama
+    # of the left and right side of the street, all at the same time
+    quota = QuotaGuard(limits=DAILY_LIMITS) if DAILY_LIMITS else None
+    engine = MetadataEngine(cache=manifest,quota=quota) # manifest answers finished points, then the cache
+    dedup = ImageDedup() # placeholders are not stored, identical images are hard links
+    print(Pipeline(region,engine,DownloadManager(quota=quota,dedup=dedup),manifest=manifest).run())
+    print(cache.stats(),manifest.progress())
+    manifest.close()
+    cache.close()
+    dedup.close()
+    metrics.write("../data/DowntownLA-metrics.json")
+    metrics.write("../data/DowntownLA-metrics.prom")
+
 
-options = Options()
-options.add_argument("--disable-extensions")
-options.add_argument("--disable-gpu")
-#options.add_argument("--headless") # run in background
-driver = webdriver.Chrome('../miscellaneous/chromedriver')
-
-# define region and run all functions
-region = Region("DowntownLA",34.041842, -118.244583)
-region.level_routes()
-region.get_routes(driver)
-region.get_segments()
-region.populate_routes()
-region.write_region()
-driver.close()
-
-
-# open newly generated file for region
-with open("../data/DowntownLA-points.csv","r") as file:
-    data = file.readlines()
-data = [i.split(",") for i in data]
-
-# for each panorama point, create panorama object and download 2 images for it
-for point in data:
-    #Panorama(region,panoIS,date,lat,lng,direction)
-    p = Panorama(point[0],point[5],point[6],point[7],point[8],point[4])
-    p.download()
+if __name__ == "__main__":
+    main()